@@ -2,25 +2,38 @@
 # -*- coding: utf-8 -*-
 
 
+import os
 import queue
+import re
+import socket
+import time
 
-from scapy.all import *
-
+from myason.agent.conf import AGENT_SCHEMA
 from myason.agent.conf import conf_is_ok
 from myason.agent.exporter import Exporter
 from myason.agent.processor import Processor
+from myason.agent.reader import Reader
+from myason.agent.shards import ShardedQueue
 from myason.agent.sniffer import Sniffer
+from myason.helpers import compression
+from myason.helpers import metrics
 from myason.helpers.conf import conf_loader
+from myason.helpers.endpoint import Endpoint
 from myason.helpers.logging import logger_conf_loader
 from myason.helpers.messenger import Messenger
+from myason.helpers.profiler import ProfilerSwitch
+from myason.helpers.reloader import Reloader
+from myason.helpers.ring import create_ring
+from myason.helpers.spool import Spool
+from myason.helpers.worker import stop_workers
 
 
-def agent(logger_conf_fn, agent_conf_fn):
+def agent(logger_conf_fn, agent_conf_fn, pcap_fns=None, pcap_timestamps=False):
     if not conf_is_ok(logger_conf_fn, agent_conf_fn):
         return
     # Load configurations
     logger_conf = logger_conf_loader(logger_conf_fn)
-    agent_conf = conf_loader(agent_conf_fn)
+    agent_conf = conf_loader(agent_conf_fn, AGENT_SCHEMA)
     # Create the messages queue
     msg_queue = queue.Queue()
     # Create the messenger worker
@@ -28,57 +41,232 @@ def agent(logger_conf_fn, agent_conf_fn):
         logger_conf,
         msg_queue
     )
-    # Start a stack of workers for each interface
-    interfaces = agent_conf["interfaces"]
+    # Create the endpoint worker, serving the metrics
+    endpoint = None
+    if agent_conf.get("endpoint_port") is not None:
+        endpoint = Endpoint(
+            msg_queue,
+            agent_conf.get("endpoint_address", "127.0.0.1"),
+            agent_conf.get("endpoint_port"),
+        )
+    # Let the sampling profiler be toggled by SIGUSR1 or through the endpoint
+    ProfilerSwitch(
+        msg_queue,
+        "agent",
+        duration=agent_conf.get("profiler_duration", 30),
+        interval=agent_conf.get("profiler_interval", 0.01),
+        output_dir=agent_conf.get("profiler_dir", "log"),
+        output_format=agent_conf.get("profiler_format", "collapsed"),
+    ).install(endpoint)
+    metrics.registry.gauge("myason_agent_queue_depth", "Items waiting in a queue", function=msg_queue.qsize,
+                           queue="messages")
+    # Start a stack of workers for each interface, or for each pcap file when replaying captures
+    interfaces = pcap_fns if pcap_fns else agent_conf["interfaces"]
     workers_stack = dict()
     for interface in interfaces:
-        pkt_queue = queue.Queue()
-        ent_queue = queue.Queue()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        workers_stack[interface] = {
-            "sniffer": Sniffer(
-                pkt_queue,
-                msg_queue,
-                ifname=interface,
-            ),
-            "processor": Processor(
-                pkt_queue,
-                ent_queue,
-                msg_queue,
-                agent_conf.get("cache_limit", 1024),
-                agent_conf.get("cache_active_timeout", 1800),
-                agent_conf.get("cache_inactive_timeout", 15),
-            ),
-            "exporter": Exporter(
-                ent_queue,
-                msg_queue,
-                sock,
-                agent_conf.get("collector_address", "127.0.0.1"),
-                agent_conf.get("collector_port", 9999),
-            ),
-        }
+        workers_stack[interface] = create_stack(interface, agent_conf, msg_queue, pcap_fns, pcap_timestamps)
+    # Let the configuration be reloaded by SIGHUP, through the endpoint, or when its files are modified
+    reloader = None
+    if not pcap_fns:
+        reloader = Reloader(
+            msg_queue,
+            messenger,
+            "agent",
+            logger_conf_fn,
+            agent_conf_fn,
+            conf_is_ok,
+            interval=agent_conf.get("reload_interval"),
+            schema=AGENT_SCHEMA,
+        )
+        reloader.install(endpoint)
+        reloader.subscribe(lambda conf: reconfigure(conf, workers_stack, msg_queue))
     # Start the messenger worker
     messenger.start()
+    # Start the endpoint worker
+    if endpoint is not None:
+        endpoint.start()
     # Start the stack of workers
     for interface in interfaces:
-        workers_stack[interface]["exporter"].start()
-        workers_stack[interface]["processor"].start()
-        workers_stack[interface]["sniffer"].start()
-    # Infinite loop until KeyBoardInterrupt
+        start_stack(workers_stack[interface])
+    # Start the reloader worker
+    if reloader is not None:
+        reloader.start()
+    # Infinite loop until KeyBoardInterrupt, or until every pcap file has been read
     try:
-        while True:
-            time.sleep(100)
+        while not pcap_fns or any(workers_stack[interface]["sniffer"].is_alive() for interface in interfaces):
+            time.sleep(1 if pcap_fns else 100)
+        msg_queue.put(("DEBUG", "All pcap files read. Stopping agent..."))
     except KeyboardInterrupt:
         msg_queue.put(("DEBUG", "KeyBoardInterrupt received. Stopping agent..."))
-        # Stop The stack of workers
-        for interface in interfaces:
-            workers_stack[interface]["sniffer"].join()
-            if workers_stack[interface]["sniffer"].isAlive():
-                workers_stack[interface]["sniffer"].socket.close()
-            workers_stack[interface]["processor"].join()
-            workers_stack[interface]["exporter"].join()
-        # Stop the messenger worker
-        messenger.join()
+    # Stop the reloader worker, before the stacks it may start or stop
+    if reloader is not None:
+        reloader.join()
+    # Stop the stacks of workers stage by stage, each stage draining its queue before the next one stops
+    stacks = list(workers_stack.values())
+    for stack in stacks:
+        stack["sniffer"].join()
+    stop_workers([processor for stack in stacks for processor in stack["processors"]])
+    stop_workers([stack["exporter"] for stack in stacks])
+    # Stop the endpoint worker
+    if endpoint is not None:
+        endpoint.join()
+    # Stop the messenger worker
+    messenger.join()
+
+
+def create_stack(interface, agent_conf, msg_queue, pcap_fns=None, pcap_timestamps=False):
+    """Creates the sniffer (or pcap reader), processors and exporter workers of an interface
+
+    With several processors, the flow table of the interface is sharded: the packets are dispatched
+    to the processors by flow, each processor caching the flows of its shard.
+    """
+    # Load the compression dictionary shared with the collector
+    codec = agent_conf.get("compression", "none")
+    dictionary = None
+    if agent_conf.get("compression_dictionary") is not None:
+        dictionary = compression.load_dictionary(agent_conf.get("compression_dictionary"))
+    ent_queue = queue.Queue()
+    transport = agent_conf.get("collector_transport", "udp")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if transport == "udp" else None
+    metrics.registry.gauge("myason_agent_queue_depth", "Items waiting in a queue", function=ent_queue.qsize,
+                           queue="entries", interface=interface)
+    # One packets queue per processor, bounded when reading captures: the reader must not get ahead
+    processors_number = max(1, agent_conf.get("processors_number", 1))
+    shard_queues = [
+        queue.Queue(maxsize=agent_conf.get("pcap_queue_size", 4096) if pcap_fns else 0)
+        for _ in range(processors_number)
+    ]
+    pkt_queue = shard_queues[0] if processors_number == 1 else ShardedQueue(shard_queues)
+    if pcap_fns:
+        sniffer = Reader(
+            pkt_queue,
+            msg_queue,
+            pcap_fn=interface,
+        )
+    else:
+        sniffer = Sniffer(
+            pkt_queue,
+            msg_queue,
+            ifname=interface,
+        )
+    metrics.registry.gauge("myason_agent_queue_depth", "Items waiting in a queue", function=pkt_queue.qsize,
+                           queue="packets", interface=interface)
+    # One spool per interface, in a directory named after it
+    spool = None
+    if agent_conf.get("spool_dir") is not None:
+        spool = Spool(
+            os.path.join(agent_conf.get("spool_dir"), re.sub(r"[^\w.-]", "_", os.path.basename(interface))),
+            segment_size=agent_conf.get("spool_segment_size", 16 * 1024 * 1024),
+            max_bytes=agent_conf.get("spool_max_bytes", 1024 * 1024 * 1024),
+        )
+    return {
+        "sniffer": sniffer,
+        "processors": [
+            Processor(
+                shard_queue,
+                ent_queue,
+                msg_queue,
+                shard_cache_limit(agent_conf, processors_number),
+                agent_conf.get("cache_active_timeout", 1800),
+                agent_conf.get("cache_inactive_timeout", 15),
+                packet_time=bool(pcap_fns) and pcap_timestamps,
+                biflow=agent_conf.get("cache_biflow", False),
+                interim_interval=agent_conf.get("cache_interim_interval"),
+            )
+            for shard_queue in shard_queues
+        ],
+        "exporter": Exporter(
+            ent_queue,
+            msg_queue,
+            sock,
+            agent_conf.get("collector_address", "127.0.0.1"),
+            agent_conf.get("collector_port", 9999),
+            agent_conf.get("key"),
+            spool=spool,
+            replay_rate=agent_conf.get("spool_replay_rate", 1000),
+            retry_interval=agent_conf.get("retry_interval", 5),
+            transport=transport,
+            batch_flows=agent_conf.get("batch_flows", 1),
+            batch_delay=agent_conf.get("batch_delay", 1),
+            window=agent_conf.get("window", 64),
+            compressor=None if codec == "none" else compression.Compressor(
+                codec,
+                dictionary=dictionary,
+                level=agent_conf.get("compression_level"),
+            ),
+            ring=create_ring(agent_conf),
+            route_key=route_key(agent_conf, interface),
+            failback_interval=agent_conf.get("collectors_failback_interval", 60),
+        ),
+    }
+
+
+def route_key(agent_conf, interface):
+    """The key routing the records of an interface to a node of the collector cluster"""
+    return f"{agent_conf.get('agent_name') or socket.gethostname()}/{os.path.basename(interface)}"
+
+
+def shard_cache_limit(agent_conf, shards):
+    """The cache size limit of a processor, the cache_limit of an interface being shared by its shards"""
+    return max(1, agent_conf.get("cache_limit", 1024) // shards)
+
+
+def start_stack(stack):
+    stack["exporter"].start()
+    for processor in stack["processors"]:
+        processor.start()
+    stack["sniffer"].start()
+
+
+def stop_stack(interface, stack):
+    """Stops the workers of an interface, the flows of its cache being exported first"""
+    stack["sniffer"].join()
+    stop_workers(stack["processors"])
+    stack["exporter"].join()
+    # The gauges read from the stopped workers
+    for queue_name in ("entries", "packets"):
+        metrics.registry.unregister("myason_agent_queue_depth", queue=queue_name, interface=interface)
+    for processor in stack["processors"]:
+        metrics.registry.unregister("myason_agent_cache_flows", worker=processor.name)
+    metrics.registry.unregister("myason_agent_spool_bytes", worker=stack["exporter"].name)
+    metrics.registry.unregister("myason_agent_spool_dropped_segments", worker=stack["exporter"].name)
+
+
+def reconfigure(agent_conf, workers_stack, msg_queue):
+    """Applies a reloaded configuration to the running stacks of workers
+
+    The cache and batching settings are updated in place, so that the flow caches survive the
+    reload. Stacks are started for the interfaces added and stopped for the interfaces removed, the
+    others are left running. The collectors of the cluster ring are updated in place, the records of
+    the interfaces whose node changed being routed to their new node. The collector address,
+    transport, compression, spool, biflow and processors_number settings only apply to the stacks
+    started afterwards.
+    """
+    interfaces = agent_conf["interfaces"]
+    for interface in [interface for interface in workers_stack if interface not in interfaces]:
+        msg_queue.put(("INFO", f"Interface {interface} removed from the configuration. Stopping its workers..."))
+        stop_stack(interface, workers_stack.pop(interface))
+    for interface, stack in workers_stack.items():
+        for processor in stack["processors"]:
+            processor.cache_limit = shard_cache_limit(agent_conf, len(stack["processors"]))
+            processor.active_timeout = agent_conf.get("cache_active_timeout", 1800)
+            processor.inactive_timeout = agent_conf.get("cache_inactive_timeout", 15)
+            processor.interim_interval = agent_conf.get("cache_interim_interval")
+        exporter = stack["exporter"]
+        exporter.set_key(agent_conf.get("key"))
+        exporter.set_batching(agent_conf.get("batch_flows", 1), agent_conf.get("batch_delay", 1))
+        exporter.window = agent_conf.get("window", 64)
+        exporter.retry_interval = agent_conf.get("retry_interval", 5)
+        exporter.replay_rate = agent_conf.get("spool_replay_rate", 1000)
+        exporter.failback_interval = agent_conf.get("collectors_failback_interval", 60)
+        if exporter.ring is not None or agent_conf.get("collectors"):
+            exporter.set_ring(create_ring(agent_conf), route_key(agent_conf, interface))
+    for interface in interfaces:
+        if interface not in workers_stack:
+            msg_queue.put(("INFO", f"Interface {interface} added to the configuration. Starting its workers..."))
+            stack = create_stack(interface, agent_conf, msg_queue)
+            start_stack(stack)
+            workers_stack[interface] = stack
 
 
 def main():
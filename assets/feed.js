@@ -0,0 +1,67 @@
+/*
+ * Live feed of the dashboard
+ *
+ * The seconds published by the collector (/events of its endpoint, topic "flows") are buffered as
+ * they arrive, then appended to the graphs on each refresh: an update costs the new points only.
+ * The browser reconnects by itself when the stream is lost, the collector resending the seconds
+ * missed meanwhile.
+ */
+
+var METRICS = ["flows", "bytes", "packets"];
+
+function pad(n) {
+    return (n < 10 ? "0" : "") + n;
+}
+
+function formatSecond(seconds) {
+    var date = new Date(seconds * 1000);
+    return date.getFullYear() + "-" + pad(date.getMonth() + 1) + "-" + pad(date.getDate()) + " " +
+        pad(date.getHours()) + ":" + pad(date.getMinutes()) + ":" + pad(date.getSeconds());
+}
+
+function emptyBuffer() {
+    var buffer = {t: []};
+    METRICS.forEach(function (metric) {
+        buffer[metric] = [];
+    });
+    return buffer;
+}
+
+function connect(feed) {
+    var state = {buffer: emptyBuffer(), last: 0};
+    var source = new EventSource(feed.url + "?topics=flows");
+    source.addEventListener("flows", function (event) {
+        var point = JSON.parse(event.data);
+        // The seconds already received, when the stream is resumed
+        if (point.t <= state.last) {
+            return;
+        }
+        state.last = point.t;
+        state.buffer.t.push(formatSecond(point.t));
+        METRICS.forEach(function (metric) {
+            state.buffer[metric].push(point[metric]);
+        });
+    });
+    return state;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    feed: {
+        extend: function (n_intervals, feed) {
+            var noUpdate = window.dash_clientside.no_update;
+            if (!window.myasonFeed) {
+                window.myasonFeed = connect(feed);
+            }
+            var buffer = window.myasonFeed.buffer;
+            if (buffer.t.length === 0) {
+                return METRICS.map(function () {
+                    return noUpdate;
+                });
+            }
+            window.myasonFeed.buffer = emptyBuffer();
+            return METRICS.map(function (metric) {
+                return [{x: [buffer.t], y: [buffer[metric]]}, [0], feed.max_points];
+            });
+        }
+    }
+});
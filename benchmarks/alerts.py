@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the collector alerter, for 10 to 10000 rules and 1000 to 100000 flows per second
+
+The rules watch agents, interfaces, ports and prefixes, a third of them of each kind (threshold,
+change, ewma), a few watching every port (the source ports being random, up to 1000 series each).
+Synthetic seconds of flows are rolled up then the rules evaluated, as the alerter does with the
+flows it receives, measuring:
+
+- rollup_us_per_flow: the time to roll a flow up, by the number of rules, the flows lasting a second
+- evaluate_ms_per_second: the time to evaluate the rules on a second, by the number of rules and
+  of flows per second
+
+Usage:
+
+    python -m benchmarks.alerts [--rules N [N ...]] [--flows N [N ...]] [--seconds N] [--output FILE]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import write_results
+from myason.collector.alerter import Alerter
+from myason.collector.alerter import Rule
+from myason.collector.alerter import KINDS
+
+AGENTS = [f"192.0.2.{n}" for n in range(1, 33)]
+IFNAMES = ["eth0", "eth1"]
+
+
+def make_rules(count):
+    rules = []
+    for n in range(count):
+        kind = KINDS[n % len(KINDS)]
+        dimension = ("agent", "interface", "port", "prefix")[n // len(KINDS) % 4]
+        match = {
+            "agent": AGENTS[n % len(AGENTS)],
+            "interface": f"{AGENTS[n % len(AGENTS)]}/{IFNAMES[n % 2]}",
+            "port": str(1 + n % 2048),
+            "prefix": f"10.{n % 256}.{n // 256 % 256}.0/24",
+        }[dimension]
+        # A few rules watch every port
+        if dimension == "port" and n % 500 == 2:
+            match = None
+        rules.append(Rule(f"rule-{n}", kind, dimension, metric="packets", match=match, window=10,
+                          threshold=1e9, change=10., factor=10., minimum=1e9))
+    return rules
+
+
+def make_entries(flows, seed=0):
+    """A second of flows, as entries of 10 flows"""
+    generator = random.Random(seed)
+    entries = []
+    for _ in range(flows // 10):
+        agent = generator.choice(AGENTS)
+        entries.append(((agent, 0), {
+            f"{generator.choice(IFNAMES)},10.{generator.randrange(256)}.{generator.randrange(256)}.1,"
+            f"10.{generator.randrange(256)}.0.{generator.randrange(256)},6,{generator.randrange(1024, 65536)},"
+            f"{generator.randrange(1, 2048)},0,2048": {
+                "bytes": 1500, "packets": 3, "start_time": 0., "end_time": 0., "flags": "A"}
+            for _ in range(10)
+        }))
+    return entries
+
+
+def measure(rules, flows, seconds):
+    alerter = Alerter(NullQueue(), NullQueue(), rules, [], lateness=0)
+    entries = make_entries(flows)
+    rollup_s = 0.
+    evaluate_s = []
+    for _ in range(seconds):
+        # The flows of the second open
+        second = alerter.rollup.first
+        for _, flow in entries:
+            for values in flow.values():
+                values["start_time"] = values["end_time"] = second + 0.5
+        start = time.perf_counter()
+        for entry in entries:
+            alerter.rollup_entry(entry)
+        rollup_s += time.perf_counter() - start
+        start = time.perf_counter()
+        for closed, bucket in alerter.rollup.close(second + 1):
+            alerter.evaluate(closed, bucket)
+        evaluate_s.append(time.perf_counter() - start)
+    # The first seconds fill the series of the rules watching every value
+    steady = evaluate_s[len(evaluate_s) // 2:]
+    return {
+        "rollup_us_per_flow": rollup_s / (seconds * len(entries) * 10) * 1e6,
+        "evaluate_ms_per_second": sum(steady) / len(steady) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.alerts")
+    parser.add_argument("-r", "--rules", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("-f", "--flows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="flows per second")
+    parser.add_argument("-s", "--seconds", type=int, default=20)
+    parser.add_argument("-o", "--output", default="bench_alerts.json")
+    arguments = parser.parse_args()
+    results = {"seconds": arguments.seconds, "rules": {}}
+    for count in arguments.rules:
+        results["rules"][count] = {}
+        for flows in arguments.flows:
+            result = measure(make_rules(count), flows, arguments.seconds)
+            results["rules"][count][flows] = result
+            print(json.dumps({"rules": count, "flows_per_sec": flows, **result}))
+    write_results(results, arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
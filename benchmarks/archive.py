@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the collector flows archive: writing it, its size, and the queries of a day
+
+A day of synthetic flows from several agents is archived by hourly windows, then the day is
+scanned whole, by agent, by address, and by address within an hour. The scans of the address
+predicates show what the pruning of the directories and of the Parquet row groups saves.
+
+Usage:
+
+    python -m benchmarks.archive [--flows N] [--agents N] [--hosts N] [--format {parquet,arrow}]
+                                 [--directory DIR] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import peak_rss_kb
+from benchmarks.common import write_results
+from myason.archive.query import query
+from myason.collector.archiver import Archiver
+
+# The archived day, 2024-01-01 UTC
+DAY = 1704067200
+
+
+def day_entries(flows, agents, hosts, seed):
+    """Builds a day of flow entries, one flow each, in end time order"""
+    rng = random.Random(seed)
+    agents = [f"192.0.2.{n + 1}" for n in range(agents)]
+    hosts = [f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}" for n in range(hosts)]
+    servers = [f"198.51.100.{n}" for n in range(1, 255)]
+    for n in range(flows):
+        end_time = DAY + n * 86400 / flows
+        flow_id = (f"eth{rng.randrange(4)},{rng.choice(hosts)},{rng.choice(servers)},6,"
+                   f"{rng.randrange(1024, 65536)},{rng.choice((80, 443, 53, 22))},0,2048")
+        yield (rng.choice(agents), 9999), {
+            flow_id: {
+                "bytes": rng.randrange(60, 1500000),
+                "packets": rng.randrange(1, 1000),
+                "start_time": end_time - rng.random() * 30,
+                "end_time": end_time,
+                "flags": rng.choice(("S", "SA", "PA", "FA")),
+            }
+        }
+
+
+def scan(archive_dir, file_format, **predicates):
+    start = time.perf_counter()
+    table = query(archive_dir, file_format=file_format, **predicates)
+    elapsed = time.perf_counter() - start
+    return {"flows": table.num_rows, "elapsed_s": elapsed, "flows_per_sec": table.num_rows / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.archive")
+    parser.add_argument("-f", "--flows", type=int, default=2000000, help="flows of the day")
+    parser.add_argument("-a", "--agents", type=int, default=4)
+    parser.add_argument("-n", "--hosts", type=int, default=50000, help="source addresses of the flows")
+    parser.add_argument("-ff", "--format", default="parquet", choices=["parquet", "arrow"])
+    parser.add_argument("-d", "--directory", help="archive directory (a temporary one by default)")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_archive.json")
+    arguments = parser.parse_args()
+    archive_dir = arguments.directory or tempfile.mkdtemp(prefix="myason_archive_")
+    archiver = Archiver(None, NullQueue(), archive_dir, window=3600, delay=0, file_format=arguments.format)
+    entries = list(day_entries(arguments.flows, arguments.agents, arguments.hosts, arguments.seed))
+    start = time.perf_counter()
+    for entry in entries:
+        archiver.archive_entry(entry)
+    archiver.close_windows(flush=True)
+    write_s = time.perf_counter() - start
+    archive_bytes = sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(archive_dir)
+        for name in names
+    )
+    agent, flow = entries[len(entries) // 2]
+    src_ip = next(iter(flow)).split(",")[1]
+    hour = DAY + 12 * 3600
+    results = {
+        "format": arguments.format,
+        "flows": arguments.flows,
+        "files": archiver.files.value,
+        "write": {"elapsed_s": write_s, "flows_per_sec": arguments.flows / write_s},
+        "archive_bytes": archive_bytes,
+        "bytes_per_flow": archive_bytes / arguments.flows,
+        "day": scan(archive_dir, arguments.format, start=DAY, end=DAY + 86400),
+        "agent": scan(archive_dir, arguments.format, start=DAY, end=DAY + 86400, agent=agent[0]),
+        "ip": scan(archive_dir, arguments.format, start=DAY, end=DAY + 86400, ip=src_ip),
+        "ip_hour": scan(archive_dir, arguments.format, start=hour, end=hour + 3600, ip=src_ip),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    if arguments.directory is None:
+        shutil.rmtree(archive_dir)
+    write_results(results, arguments.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
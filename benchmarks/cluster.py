@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the routing of the agents records across a collector cluster
+
+The ring: route keys (agent name / interface) are placed on consistent hashing rings of 2 to 16
+collector nodes, measuring:
+
+- balance: the keys of the busiest node over the keys of an even split
+- moved_on_join, moved_on_leave: the share of the keys changing of node when a node joins or leaves
+  the ring, against the ideal shares (the share of the node joining or leaving)
+
+The cluster: collector nodes listen on loopback TCP ports, and exporters (one per agent interface,
+with a spool) send their records through the ring. A node is stopped, then restarted with a new
+node joining, measuring for each phase the records received by each node against the ring, the
+records lost, and the time until every record is received.
+
+Usage:
+
+    python -m benchmarks.cluster [--keys N] [--nodes N [N ...]] [--cluster-nodes N] [--agents N]
+                                 [--records N] [--output FILE]
+"""
+
+import argparse
+import json
+import queue
+import shutil
+import socket
+import tempfile
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import write_results
+from myason.agent.exporter import Exporter
+from myason.collector.listener import StreamListener
+from myason.collector.processor import Processor as CollectorProcessor
+from myason.helpers.ring import HashRing
+from myason.helpers.spool import Spool
+from myason.helpers.worker import stop_workers
+
+# The key the agent exporters encrypt with
+KEY = "raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI="
+
+
+class CountingQueue(NullQueue):
+    """A queue counting the records received by a node"""
+
+    def __init__(self):
+        self.items = 0
+
+    def put(self, item, block=True, timeout=None):
+        self.items += 1
+
+
+def free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def ring_stats(keys, nodes):
+    members = [("127.0.0.1", 10000 + n) for n in range(nodes + 1)]
+    ring = HashRing(members[:nodes])
+    joined = HashRing(members)
+    left = HashRing(members[1:nodes])
+    owners = [ring.node(key) for key in keys]
+    counts = {}
+    for owner in owners:
+        counts[owner] = counts.get(owner, 0) + 1
+    return {
+        "balance": max(counts.values()) / (len(keys) / nodes),
+        "moved_on_join": sum(owner != joined.node(key) for owner, key in zip(owners, keys)) / len(keys),
+        "moved_on_leave": sum(owner != left.node(key) for owner, key in zip(owners, keys)) / len(keys)
+        if nodes > 1 else None,
+        "ideal_on_join": 1 / (nodes + 1),
+        "ideal_on_leave": 1 / nodes,
+    }
+
+
+class Node:
+    """A collector node of the cluster, counting the records it receives"""
+
+    def __init__(self, port):
+        self.port = port
+        self.received = CountingQueue()
+        self.listener = None
+
+    def start(self):
+        self.listener = StreamListener(self.received, NullQueue(), "127.0.0.1", self.port)
+        self.listener.start()
+
+    def stop(self):
+        self.listener.join()
+        self.listener = None
+
+
+def run_phase(exporters, nodes, records, expected, timeout=60.):
+    """Sends records through every exporter, until the nodes have received them or timeout"""
+    before = {node.port: node.received.items for node in nodes}
+    start = time.perf_counter()
+    for n, (exporter, entries) in enumerate(exporters):
+        for seq in range(records):
+            entries.put({f"bench,10.0.{n // 250}.{n % 250},10.1.0.1,6,{seq},80,0,2048": {
+                "bytes": 100, "packets": 1, "start_time": 0., "end_time": 0., "flags": "A"}})
+    total = records * len(exporters)
+    received = {}
+    while time.perf_counter() - start < timeout:
+        received = {node.port: node.received.items - before[node.port] for node in nodes}
+        if sum(received.values()) >= total:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    return {
+        "records": total,
+        "received": sum(received.values()),
+        "elapsed_s": elapsed,
+        # Records received by a node other than the one owning their exporter (duplicates included)
+        "misrouted": sum(abs(received.get(port, 0) - expected.get(port, 0)) for port in received) // 2,
+        "by_node": {str(port): count for port, count in received.items()},
+    }
+
+
+def expected_counts(ring, keys, records, exclude=()):
+    counts = {}
+    for key in keys:
+        port = ring.node(key, exclude=exclude)[1]
+        counts[port] = counts.get(port, 0) + records
+    return counts
+
+
+def run_cluster(cluster_nodes, agents, records):
+    CollectorProcessor.configure({"127.0.0.1": KEY})
+    nodes = [Node(free_port()) for _ in range(cluster_nodes + 1)]
+    for node in nodes[:cluster_nodes]:
+        node.start()
+    ring = HashRing([("127.0.0.1", node.port) for node in nodes[:cluster_nodes]])
+    keys = [f"agent-{n}/eth0" for n in range(agents)]
+    spool_dir = tempfile.mkdtemp(prefix="bench_cluster_")
+    exporters = []
+    for n, key in enumerate(keys):
+        entries = queue.Queue()
+        exporter = Exporter(entries, NullQueue(), None, "127.0.0.1", 0, KEY, spool=Spool(f"{spool_dir}/{n}"),
+                            replay_rate=100000, retry_interval=0.5, transport="tcp", ring=ring, route_key=key,
+                            failback_interval=3600)
+        exporter.start()
+        exporters.append((exporter, entries))
+    results = {}
+    try:
+        results["steady"] = run_phase(exporters, nodes, records, expected_counts(ring, keys, records))
+        # A node leaves: its exporters fail over to the next nodes of the ring
+        down = ("127.0.0.1", nodes[0].port)
+        nodes[0].stop()
+        results["node_down"] = run_phase(exporters, nodes, records,
+                                         expected_counts(ring, keys, records, exclude=(down,)))
+        # The node is back and a new one joins: the exporters are given the new ring
+        nodes[0].start()
+        nodes[-1].start()
+        joined = HashRing([("127.0.0.1", node.port) for node in nodes])
+        for (exporter, _), key in zip(exporters, keys):
+            exporter.set_ring(joined, key)
+        results["node_joined"] = run_phase(exporters, nodes, records, expected_counts(joined, keys, records))
+        results["node_joined"]["moved"] = sum(ring.node(key) != joined.node(key) for key in keys) / len(keys)
+    finally:
+        stop_workers([exporter for exporter, _ in exporters])
+        for node in nodes:
+            if node.listener is not None:
+                node.stop()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.cluster")
+    parser.add_argument("-k", "--keys", type=int, default=10000, help="route keys placed on the rings")
+    parser.add_argument("-n", "--nodes", type=int, nargs="+", default=[2, 4, 8, 16])
+    parser.add_argument("-cn", "--cluster-nodes", type=int, default=3, help="collector nodes on loopback")
+    parser.add_argument("-a", "--agents", type=int, default=24, help="exporters sending to the cluster")
+    parser.add_argument("-r", "--records", type=int, default=200, help="records sent by an exporter per phase")
+    parser.add_argument("-o", "--output", default="bench_cluster.json")
+    arguments = parser.parse_args()
+    keys = [f"agent-{n}/eth{n % 4}" for n in range(arguments.keys)]
+    results = {"keys": arguments.keys, "ring": {}}
+    for nodes in arguments.nodes:
+        results["ring"][nodes] = ring_stats(keys, nodes)
+        print(json.dumps({"nodes": nodes, **results["ring"][nodes]}))
+    results["cluster"] = run_cluster(arguments.cluster_nodes, arguments.agents, arguments.records)
+    print(json.dumps(results["cluster"], indent=2))
+    write_results(results, arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from myason.collector.writer import Writer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class NullQueue:
+    """A queue swallowing everything put into it
+
+    Used in place of the messages queue so that logging doesn't skew the measures.
+    """
+
+    def put(self, item, block=True, timeout=None):
+        pass
+
+    def qsize(self):
+        return 0
+
+
+class Stage:
+    """Timings of a pipeline stage
+
+    """
+
+    def __init__(self, name):
+        """Initialization
+
+        Args:
+            name: The name of the measured stage
+        """
+        self.name = name
+        self.samples = []
+        self.cpu_time = 0.
+        self.peak_rss_kb = 0
+
+    def call(self, function, *args):
+        """Calls function(*args) and records its latency and CPU time"""
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        result = function(*args)
+        self.samples.append(time.perf_counter() - start)
+        self.cpu_time += time.thread_time() - cpu_start
+        return result
+
+    def close(self):
+        """Records the peak RSS reached at the end of the stage"""
+        self.peak_rss_kb = peak_rss_kb()
+
+    def summary(self):
+        wall_time = sum(self.samples)
+        return {
+            "calls": len(self.samples),
+            "wall_s": wall_time,
+            "cpu_s": self.cpu_time,
+            "calls_per_sec": len(self.samples) / wall_time if wall_time else 0.,
+            "latency_us": {
+                "p50": percentile(self.samples, 50) * 1e6,
+                "p90": percentile(self.samples, 90) * 1e6,
+                "p99": percentile(self.samples, 99) * 1e6,
+                "max": max(self.samples, default=0.) * 1e6,
+            },
+            "peak_rss_kb": self.peak_rss_kb,
+        }
+
+
+class StubWriter(Writer):
+    """A writer counting the points instead of storing them"""
+
+    def __init__(self, entries, messages, on_write=None):
+        """Initialization
+
+        Args:
+            entries: The thread safe FIFO queue to consume with flow entries
+            messages: The thread safe FIFO queue to feed with logging messages
+            on_write: Called with the points of every write
+        """
+        super().__init__(entries, messages, dbname=None, influx_params={})
+        self.stored = 0
+        self.on_write = on_write
+
+    def write_points(self, points):
+        self.stored += len(points)
+        if self.on_write is not None:
+            self.on_write(points)
+        return True
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples"""
+    if not samples:
+        return 0.
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100. * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS reports bytes, Linux reports kilobytes
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def synthetic_packets(flows, packets_per_flow, ifname="synthetic", seed=0, replies=False):
+    """Generates Ethernet frames for a number of TCP and UDP flows
+
+    TCP flows are closed by a FIN on their last packet so that they age out of the agent cache.
+    With replies, every other packet of a flow goes the other way: TCP flows open with a handshake
+    and are closed by a FIN from both sides, and the packets of a flow are kept in order.
+
+    Args:
+        flows: The number of flows to generate
+        packets_per_flow: The number of packets in each flow
+        ifname: The interface name the frames are attributed to
+        seed: The random generator seed
+        replies: Generate the packets of both directions of the flows
+
+    Returns:
+        A list of (frame, ifname) tuples, as produced by the agent sniffer
+    """
+    from scapy.layers.l2 import Ether
+    from scapy.layers.inet import IP
+    from scapy.layers.inet import TCP
+    from scapy.layers.inet import UDP
+    rnd = random.Random(seed)
+    flows_frames = []
+    for n in range(flows):
+        src = f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+        dst = f"192.168.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+        sport = rnd.randint(1024, 65535)
+        dport = rnd.choice([53, 80, 123, 443, 8080])
+        payload = b"x" * rnd.randint(0, 1400)
+        flow_frames = []
+        for i in range(packets_per_flow):
+            reply = replies and i % 2 == 1
+            if n % 4 == 0:
+                l4 = UDP(sport=dport, dport=sport) if reply else UDP(sport=sport, dport=dport)
+            elif replies:
+                flags = "S" if i == 0 else "SA" if i == 1 else "FA" if i >= packets_per_flow - 2 else "A"
+                l4 = TCP(sport=dport, dport=sport, flags=flags) if reply else TCP(sport=sport, dport=dport, flags=flags)
+            else:
+                l4 = TCP(sport=sport, dport=dport, flags="FA" if i == packets_per_flow - 1 else "A")
+            ip = IP(src=dst, dst=src) if reply else IP(src=src, dst=dst)
+            frame = Ether(bytes(Ether() / ip / l4 / payload))
+            flow_frames.append((frame, ifname))
+        flows_frames.append(flow_frames)
+    if not replies:
+        frames = [frame for flow_frames in flows_frames for frame in flow_frames]
+        rnd.shuffle(frames)
+        return frames
+    # Interleave the flows, keeping the packets of each flow in order
+    order = [n for n, flow_frames in enumerate(flows_frames) for _ in flow_frames]
+    rnd.shuffle(order)
+    for flow_frames in flows_frames:
+        flow_frames.reverse()
+    return [flows_frames[n].pop() for n in order]
+
+
+def pcap_packets(pcap_fns):
+    """Loads the Ethernet frames of pcap files
+
+    Returns:
+        A list of (frame, ifname) tuples, the interface name being the pcap file name
+    """
+    from scapy.utils import PcapReader
+    from scapy.layers.l2 import Ether
+    frames = []
+    for pcap_fn in pcap_fns:
+        ifname = os.path.basename(pcap_fn)
+        with PcapReader(pcap_fn) as reader:
+            for frame in reader:
+                if Ether in frame:
+                    frames.append((frame, ifname))
+    return frames
+
+
+def write_results(results, results_fn):
+    results = dict(results)
+    results.update({
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    })
+    with open(results_fn, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the compression ratio and CPU cost per flow of the record codecs
+
+Synthetic flows are exported through the agent exporter with each available codec, with and
+without a dictionary trained on a distinct set of flows, and the records are decoded by the
+collector processor. The bytes on the wire are those of the encrypted records.
+
+Usage:
+
+    python -m benchmarks.compression [--flows N] [--batch-flows N] [--dictionary-size BYTES]
+                                     [--output FILE]
+"""
+
+import argparse
+import json
+
+from benchmarks.common import NullQueue
+from benchmarks.common import Stage
+from benchmarks.common import synthetic_packets
+from benchmarks.common import write_results
+from myason.agent.exporter import Exporter
+from myason.agent.exporter import envelope
+from myason.agent.processor import Processor as AgentProcessor
+from myason.collector.processor import Processor as CollectorProcessor
+from myason.helpers import compression
+
+# The key the agent exporter encrypts with
+KEY = "raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI="
+AGENT = ("127.0.0.1", 9999)
+
+
+class CaptureSocket:
+    """A socket keeping the datagrams sent instead of sending them"""
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendto(self, data, address):
+        self.datagrams.append(data)
+
+    def close(self):
+        pass
+
+
+class ListQueue(list):
+    """A list standing for the entries queue of the agent processor"""
+
+    def put(self, item, block=True, timeout=None):
+        self.append(item)
+
+
+def flow_entries(flows, seed):
+    entries = ListQueue()
+    processor = AgentProcessor(None, entries, NullQueue(), flows * 2, 1800, 15)
+    for frame in synthetic_packets(flows, 4, seed=seed):
+        processor.process_packet(frame)
+    processor.age_cache(flush=True)
+    return entries
+
+
+def run(codec, dictionary, entries, batch_flows):
+    messages = NullQueue()
+    compressor = None if codec == "none" else compression.Compressor(codec, dictionary=dictionary)
+    sock = CaptureSocket()
+    exporter = Exporter(None, messages, sock, AGENT[0], AGENT[1], KEY, batch_flows=batch_flows,
+                        compressor=compressor)
+    agent_stage = Stage("agent_exporter")
+    for entry in entries:
+        agent_stage.call(exporter.export_entry, entry)
+    if exporter.batch:
+        agent_stage.call(exporter.flush)
+    processor = CollectorProcessor({AGENT[0]: KEY}, None, None, messages, token_ttl=3600,
+                                   dictionaries={AGENT[0]: dictionary} if dictionary else None)
+    collector_stage = Stage("collector_processor")
+    decoded = 0
+    for datagram in sock.datagrams:
+        decoded += len(collector_stage.call(processor.decode_record, (datagram, AGENT)))
+    wire_bytes = sum(len(datagram) for datagram in sock.datagrams)
+    return {
+        "records": len(sock.datagrams),
+        "flows": decoded,
+        "wire_bytes": wire_bytes,
+        "bytes_per_flow": wire_bytes / len(entries),
+        "agent_cpu_us_per_flow": agent_stage.cpu_time / len(entries) * 1e6,
+        "collector_cpu_us_per_flow": collector_stage.cpu_time / len(entries) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.compression")
+    parser.add_argument("-f", "--flows", type=int, default=2000)
+    parser.add_argument("-b", "--batch-flows", type=int, default=16)
+    parser.add_argument("-d", "--dictionary-size", type=int, default=16384)
+    parser.add_argument("-o", "--output", default="bench_compression.json")
+    arguments = parser.parse_args()
+    entries = flow_entries(arguments.flows, seed=0)
+    # Train the dictionaries on other flows than the measured ones
+    training = [json.dumps(entry)[1:-1] for entry in flow_entries(arguments.flows, seed=1)]
+    samples = [
+        envelope(0, seq, training[n:n + arguments.batch_flows]).encode()
+        for seq, n in enumerate(range(0, len(training), arguments.batch_flows), 1)
+    ]
+    codecs = {"none": run("none", None, entries, arguments.batch_flows)}
+    for codec in ("zlib", "zstd", "lz4"):
+        if not compression.available(codec):
+            continue
+        codecs[codec] = run(codec, None, entries, arguments.batch_flows)
+        if codec != "lz4":
+            dictionary = compression.train_dictionary(samples, arguments.dictionary_size, codec)
+            codecs[f"{codec}_dictionary"] = run(codec, dictionary, entries, arguments.batch_flows)
+    for result in codecs.values():
+        result["ratio"] = codecs["none"]["wire_bytes"] / result["wire_bytes"]
+    results = {
+        "flows": len(entries),
+        "batch_flows": arguments.batch_flows,
+        "dictionary_size": arguments.dictionary_size,
+        "codecs": codecs,
+    }
+    write_results(results, arguments.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the end-to-end latency from a captured packet to a stored point
+
+The agent processor and exporter, and the collector listener, processor and writer (with a
+stubbed storage) run as threads, as in production. TCP packets carrying a FIN, which are exported
+as soon as they are processed, are injected at a steady rate into the packets queue, and the time
+until the writer stores the matching point is recorded.
+
+Usage:
+
+    python -m benchmarks.latency [--flows N] [--rate PACKETS_PER_SEC] [--output FILE]
+"""
+
+import argparse
+import json
+import queue
+import re
+import socket
+import threading
+import time
+
+from scapy.layers.inet import IP
+from scapy.layers.inet import TCP
+from scapy.layers.l2 import Ether
+
+from benchmarks.common import NullQueue
+from benchmarks.common import StubWriter
+from benchmarks.common import percentile
+from benchmarks.common import write_results
+from myason.agent.exporter import Exporter
+from myason.agent.processor import Processor as AgentProcessor
+from myason.collector.listener import Listener
+from myason.collector.processor import Processor as CollectorProcessor
+from myason.helpers.worker import stop_workers
+
+# The key the agent exporter encrypts with
+KEY = "raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI="
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.latency")
+    parser.add_argument("-f", "--flows", type=int, default=200)
+    parser.add_argument("-r", "--rate", type=float, default=50., help="packets injected per second")
+    parser.add_argument("-o", "--output", default="bench_latency.json")
+    arguments = parser.parse_args()
+    messages = NullQueue()
+    injected = {}
+    stored = {}
+    all_stored = threading.Event()
+
+    def on_write(points):
+        now = time.perf_counter()
+        for point in points:
+            src_port = int(re.search(r",src_port=(\d+)", point).group(1))
+            stored.setdefault(src_port, now)
+        if len(stored) >= arguments.flows:
+            all_stored.set()
+
+    # Collector, listening on a free port
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    address, port = probe.getsockname()
+    probe.close()
+    rec_queue = queue.Queue()
+    ent_queue = queue.Queue()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    collector_processor = CollectorProcessor({address: KEY}, rec_queue, ent_queue, messages)
+    listener = Listener(rec_queue, messages, sock, address, port)
+    writer = StubWriter(ent_queue, messages, on_write)
+    # Agent
+    pkt_queue = queue.Queue()
+    exp_queue = queue.Queue()
+    agent_processor = AgentProcessor(pkt_queue, exp_queue, messages, 1024, 1800, 15)
+    exporter = Exporter(exp_queue, messages, socket.socket(socket.AF_INET, socket.SOCK_DGRAM), address, port, KEY)
+    workers = [writer, collector_processor, listener, exporter, agent_processor]
+    for worker in workers:
+        worker.start()
+    time.sleep(0.5)
+    # Inject one FIN packet per flow
+    for n in range(arguments.flows):
+        src_port = 10000 + n
+        frame = Ether(bytes(Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=src_port, dport=80, flags="FA")))
+        injected[src_port] = time.perf_counter()
+        pkt_queue.put((frame, "bench"))
+        time.sleep(1. / arguments.rate)
+    all_stored.wait(timeout=30)
+    agent_processor.join()
+    exporter.join()
+    listener.join()
+    stop_workers([collector_processor, writer])
+    latencies = [stored[src_port] - injected[src_port] for src_port in stored if src_port in injected]
+    results = {
+        "flows": arguments.flows,
+        "stored": len(latencies),
+        "rate": arguments.rate,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1e3,
+            "p90": percentile(latencies, 90) * 1e3,
+            "p99": percentile(latencies, 99) * 1e3,
+            "max": max(latencies, default=0.) * 1e3,
+        },
+    }
+    write_results(results, arguments.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the overhead of the metrics instrumentation on the hot paths
+
+The instrumentation of each hot path is timed in a tight loop and compared to the cost of the
+work it instruments:
+
+- agent_packet: a packet processed by the agent (two perf_counter() calls, one histogram
+  observation and a couple of counter increments)
+- collector_listener: a datagram read by the UDP listener, the datagrams and wakeups counters being
+  updated once per wakeup of batch datagrams
+- collector_record: a record decrypted and decoded by the collector processor (two perf_counter()
+  calls, one histogram observation and a counter increment for its flows)
+
+Usage:
+
+    python -m benchmarks.metrics [--flows N] [--packets-per-flow N] [--iterations N] [--batch N] [--output FILE]
+"""
+
+import argparse
+import json
+import socket
+import timeit
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import synthetic_packets
+from benchmarks.common import write_results
+from benchmarks.receive import KEY
+from benchmarks.receive import sample_record
+from myason.agent.processor import Processor
+from myason.collector.listener import Listener
+from myason.collector.processor import Processor as CollectorProcessor
+from myason.helpers.metrics import Registry
+
+def timed(function, iterations):
+    """Seconds spent in function, less the cost of calling it"""
+
+    def empty():
+        pass
+
+    cost = min(timeit.repeat(function, number=iterations, repeat=5)) / iterations
+    return max(cost - min(timeit.repeat(empty, number=iterations, repeat=5)) / iterations, 0.)
+
+
+def instrumentation_cost(iterations):
+    """Seconds spent instrumenting a packet of the agent"""
+    registry = Registry()
+    histogram = registry.histogram("bench_seconds", "Benchmark histogram", worker="bench")
+    counter = registry.counter("bench_total", "Benchmark counter", worker="bench")
+    perf_counter = time.perf_counter
+
+    def instrument():
+        start = perf_counter()
+        counter.inc()
+        counter.inc()
+        histogram.observe(perf_counter() - start)
+
+    return timed(instrument, iterations)
+
+
+def listener_instrumentation_cost(iterations, batch):
+    """Seconds spent instrumenting a datagram of the listener, the counters being updated per wakeup"""
+    registry = Registry()
+    wakeups = registry.counter("bench_wakeups_total", "Benchmark counter", worker="bench")
+    datagrams = registry.counter("bench_datagrams_total", "Benchmark counter", worker="bench")
+
+    def instrument():
+        wakeups.inc()
+        datagrams.inc(batch)
+
+    return timed(instrument, iterations) / batch
+
+
+def record_instrumentation_cost(iterations):
+    """Seconds spent instrumenting a record of the collector processor"""
+    registry = Registry()
+    histogram = registry.histogram("bench_seconds", "Benchmark histogram", worker="bench")
+    counter = registry.counter("bench_total", "Benchmark counter", worker="bench")
+    perf_counter = time.perf_counter
+
+    def instrument():
+        start = perf_counter()
+        counter.inc(3)
+        histogram.observe(perf_counter() - start)
+
+    return timed(instrument, iterations)
+
+
+def processing_cost(frames):
+    """Seconds spent by the agent processor on a packet"""
+    processor = Processor(None, NullQueue(), NullQueue(), 1024, 1800, 15)
+    start = time.perf_counter()
+    for frame in frames:
+        processor.process_packet(frame)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def listener_cost(record, datagrams, batch):
+    """Seconds spent by the collector UDP listener on a datagram, read on wakeups of batch datagrams"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(False)
+    address, port = sock.getsockname()
+    CollectorProcessor.configure({address: KEY})
+    listener = Listener(NullQueue(), NullQueue(), sock, address, port, batch=batch)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    elapsed = 0.
+    for _ in range(datagrams // batch):
+        for _ in range(batch):
+            sender.sendto(record, (address, port))
+        start = time.perf_counter()
+        listener.receive(sock)
+        elapsed += time.perf_counter() - start
+    sock.close()
+    sender.close()
+    return elapsed / (datagrams // batch * batch)
+
+
+def record_cost(record, records):
+    """Seconds spent by the collector processor decoding a record"""
+    processor = CollectorProcessor(agents={"127.0.0.1": KEY}, records=None, entries=NullQueue(),
+                                   messages=NullQueue(), token_ttl=3600)
+    ip = ("127.0.0.1", 0)
+    start = time.perf_counter()
+    for _ in range(records):
+        processor.decode_record((record, ip))
+    return (time.perf_counter() - start) / records
+
+
+def overhead(instrumentation, processing):
+    return {
+        "instrumentation_ns": instrumentation * 1e9,
+        "processing_ns": processing * 1e9,
+        "overhead_percent": instrumentation / processing * 100,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.metrics")
+    parser.add_argument("-f", "--flows", type=int, default=200)
+    parser.add_argument("-n", "--packets-per-flow", type=int, default=10)
+    parser.add_argument("-i", "--iterations", type=int, default=200000)
+    parser.add_argument("-b", "--batch", type=int, default=64, help="datagrams read per wakeup of the listener")
+    parser.add_argument("-o", "--output", default="bench_metrics.json")
+    arguments = parser.parse_args()
+    frames = synthetic_packets(arguments.flows, arguments.packets_per_flow)
+    record = sample_record()
+    results = {
+        "batch": arguments.batch,
+        "agent_packet": overhead(instrumentation_cost(arguments.iterations), processing_cost(frames)),
+        "collector_listener": overhead(
+            listener_instrumentation_cost(arguments.iterations, arguments.batch),
+            listener_cost(record, 20000, arguments.batch)),
+        "collector_record": overhead(record_instrumentation_cost(arguments.iterations), record_cost(record, 5000)),
+    }
+    write_results(results, arguments.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
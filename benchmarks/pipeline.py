@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replays traffic through the agent and collector stages without live capture
+
+Each stage is driven in turn from a single thread so that its latency, CPU time and
+memory footprint can be measured in isolation:
+
+    agent processor -> agent exporter -> (loopback UDP) -> collector listener
+    -> collector processor -> collector writer (stubbed storage)
+
+Usage:
+
+    python -m benchmarks.pipeline [--pcap FILE [FILE ...]] [--flows N] [--packets-per-flow N]
+                                  [--replies] [--biflow] [--output FILE]
+"""
+
+import argparse
+import json
+import queue
+import socket
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import Stage
+from benchmarks.common import StubWriter
+from benchmarks.common import pcap_packets
+from benchmarks.common import peak_rss_kb
+from benchmarks.common import synthetic_packets
+from benchmarks.common import write_results
+from myason.agent.exporter import Exporter
+from myason.agent.processor import Processor as AgentProcessor
+from myason.collector.listener import Listener
+from myason.collector.processor import Processor as CollectorProcessor
+
+# The key the agent exporter encrypts with
+KEY = "raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI="
+
+
+def drain(fifo):
+    items = []
+    while True:
+        try:
+            items.append(fifo.get(block=False))
+        except queue.Empty:
+            return items
+
+
+def run(frames, cache_limit, cache_active_timeout, cache_inactive_timeout, biflow=False):
+    messages = NullQueue()
+    stages = {name: Stage(name) for name in (
+        "agent_processor",
+        "agent_exporter",
+        "collector_listener",
+        "collector_processor",
+        "collector_writer",
+    )}
+    start = time.perf_counter()
+    #
+    # Agent processor
+    #
+    ent_queue = queue.Queue()
+    agent_processor = AgentProcessor(
+        None,
+        ent_queue,
+        messages,
+        cache_limit,
+        cache_active_timeout,
+        cache_inactive_timeout,
+        biflow=biflow,
+    )
+    stage = stages["agent_processor"]
+    for frame in frames:
+        stage.call(agent_processor.process_packet, frame)
+    # Flush the flows remaining in the cache as the agent does when exiting
+    stage.call(agent_processor.age_cache, True)
+    stage.close()
+    entries = drain(ent_queue)
+    #
+    # Agent exporter and collector listener, over loopback
+    #
+    rec_queue = queue.Queue()
+    collector_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    collector_sock.bind(("127.0.0.1", 0))
+    address, port = collector_sock.getsockname()
+    exporter = Exporter(None, messages, socket.socket(socket.AF_INET, socket.SOCK_DGRAM), address, port, KEY)
+    # The agents white list the listener shares with the processors
+    CollectorProcessor.configure({address: KEY})
+    listener = Listener(rec_queue, messages, collector_sock, address, port)
+    for entry in entries:
+        stages["agent_exporter"].call(exporter.export_entry, entry)
+        data, ip = collector_sock.recvfrom(65535)
+        stages["collector_listener"].call(listener.process_data, data, ip)
+    exporter.sock.close()
+    collector_sock.close()
+    stages["agent_exporter"].close()
+    stages["collector_listener"].close()
+    #
+    # Collector processor
+    #
+    ent_queue = queue.Queue()
+    collector_processor = CollectorProcessor(
+        agents={address: KEY},
+        records=None,
+        entries=ent_queue,
+        messages=messages,
+        token_ttl=3600,
+    )
+    stage = stages["collector_processor"]
+    for record in drain(rec_queue):
+        stage.call(collector_processor.process_record, record)
+    stage.close()
+    #
+    # Collector writer
+    #
+    writer = StubWriter(None, messages)
+    stage = stages["collector_writer"]
+    flows = drain(ent_queue)
+    for flow in flows:
+        stage.call(writer.process_entry, flow)
+    stage.close()
+    elapsed = time.perf_counter() - start
+    return {
+        "packets": len(frames),
+        "flows": len(flows),
+        "points": writer.stored,
+        "elapsed_s": elapsed,
+        "packets_per_sec": len(frames) / elapsed,
+        "flows_per_sec": len(flows) / elapsed,
+        "peak_rss_kb": peak_rss_kb(),
+        "stages": {name: stage.summary() for name, stage in stages.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.pipeline")
+    parser.add_argument("-p", "--pcap", nargs="+", help="pcap files to replay instead of synthetic traffic")
+    parser.add_argument("-f", "--flows", type=int, default=1000)
+    parser.add_argument("-n", "--packets-per-flow", type=int, default=10)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--cache-limit", type=int, default=1024)
+    parser.add_argument("--cache-active-timeout", type=int, default=1800)
+    parser.add_argument("--cache-inactive-timeout", type=int, default=15)
+    parser.add_argument("-r", "--replies", action="store_true", help="synthetic traffic in both directions")
+    parser.add_argument("-b", "--biflow", action="store_true", help="agent processor in biflow mode")
+    parser.add_argument("-o", "--output", default="bench_pipeline.json")
+    arguments = parser.parse_args()
+    if arguments.pcap:
+        frames = pcap_packets(arguments.pcap)
+        source = {"pcap": arguments.pcap}
+    else:
+        frames = synthetic_packets(arguments.flows, arguments.packets_per_flow, seed=arguments.seed,
+                                   replies=arguments.replies)
+        source = {"synthetic": {"flows": arguments.flows, "packets_per_flow": arguments.packets_per_flow,
+                                "replies": arguments.replies}}
+    results = run(
+        frames,
+        arguments.cache_limit,
+        arguments.cache_active_timeout,
+        arguments.cache_inactive_timeout,
+        biflow=arguments.biflow,
+    )
+    results["source"] = source
+    results["biflow"] = arguments.biflow
+    write_results(results, arguments.output)
+    print(json.dumps({key: results[key] for key in ("packets", "flows", "packets_per_sec", "flows_per_sec")}))
+    for name, summary in results["stages"].items():
+        latency = summary["latency_us"]
+        print(
+            f"{name:<20} calls={summary['calls']:<8} cpu={summary['cpu_s']:.3f}s "
+            f"p50={latency['p50']:.1f}us p99={latency['p99']:.1f}us rss={summary['peak_rss_kb']}kB"
+        )
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
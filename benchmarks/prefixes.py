@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the lookups per second of the collector prefix index
+
+A prefix table of random nested IPv4 prefixes is indexed, then addresses are looked up:
+uncached (every lookup searches the index), with a hot set of addresses (as real traffic,
+mostly answered by the cache), and through the enricher tagging flow entries.
+
+Usage:
+
+    python -m benchmarks.prefixes [--prefixes N] [--lookups N] [--hot N] [--cache-size N]
+                                  [--output FILE]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import peak_rss_kb
+from benchmarks.common import write_results
+from myason.collector.enricher import Enricher
+from myason.collector.prefixes import PrefixIndex
+
+
+def random_prefixes(count, rng):
+    prefixes = []
+    for n in range(count):
+        length = rng.choice((8, 12, 16, 20, 22, 24, 24, 24, 28, 32))
+        address = rng.getrandbits(32) >> (32 - length) << (32 - length)
+        network = ".".join(str(address >> shift & 255) for shift in (24, 16, 8, 0))
+        tags = {"label": f"prefix_{n}", "asn": str(64512 + n % 1000)}
+        prefixes.append((f"{network}/{length}", ({f"src_{k}": v for k, v in tags.items()},
+                                                 {f"dst_{k}": v for k, v in tags.items()})))
+    return prefixes
+
+
+def random_addresses(count, rng):
+    return [".".join(str(rng.getrandbits(8)) for _ in range(4)) for _ in range(count)]
+
+
+def rate(function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    elapsed = time.perf_counter() - start
+    return {"lookups": len(items), "elapsed_s": elapsed, "lookups_per_sec": len(items) / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.prefixes")
+    parser.add_argument("-p", "--prefixes", type=int, default=500000)
+    parser.add_argument("-l", "--lookups", type=int, default=500000)
+    parser.add_argument("-t", "--hot", type=int, default=10000, help="number of addresses of the hot set")
+    parser.add_argument("-c", "--cache-size", type=int, default=65536)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_prefixes.json")
+    arguments = parser.parse_args()
+    rng = random.Random(arguments.seed)
+    prefixes = random_prefixes(arguments.prefixes, rng)
+    start = time.perf_counter()
+    index = PrefixIndex(prefixes, cache_size=arguments.cache_size)
+    build_s = time.perf_counter() - start
+    uncached = random_addresses(arguments.lookups, rng)
+    hot_set = random_addresses(arguments.hot, rng)
+    hot = [rng.choice(hot_set) for _ in range(arguments.lookups)]
+    results = {
+        "prefixes": len(index),
+        "ranges": sum(len(starts) for starts in index.starts.values()),
+        "build_s": build_s,
+        "cache_size": arguments.cache_size,
+        "uncached": rate(index.search, uncached),
+        "hot": rate(index.lookup, hot),
+    }
+    # Enriching flow entries, two lookups per flow
+    Enricher.configure(index)
+    enricher = Enricher(None, None, NullQueue())
+    entries = [
+        (("127.0.0.1", 9999), {f"eth0,{src},{dst},6,1234,80,0,2048": {"bytes": 1, "packets": 1}})
+        for src, dst in zip(hot, reversed(hot))
+    ]
+    results["enricher"] = rate(enricher.enrich_entry, entries)
+    results["enricher"]["lookups"] *= 2
+    results["enricher"]["lookups_per_sec"] *= 2
+    results["cache"] = index.lookup.cache_info()._asdict()
+    results["peak_rss_kb"] = peak_rss_kb()
+    write_results(results, arguments.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
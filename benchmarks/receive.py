@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the receive path of the collector UDP listener
+
+The listener runs in its thread, as in production, while datagrams carrying encrypted records are sent
+to it over loopback as fast as possible, for each number of datagrams read per wakeup (1 being the
+former select per datagram), measuring:
+
+- datagrams_per_sec: the datagrams queued by the listener per second
+- lost: the datagrams dropped by the kernel, the socket buffer being full
+- per_wakeup: the datagrams read on each wakeup of the listener
+
+The receive buffer: the time to read a datagram with recvfrom, into a new bytes, against recvfrom_into
+a preallocated buffer of a pool, then copied out, the Fernet tokens being bytes. Then, traced with
+tracemalloc, the allocations of each read: the blocks and bytes it leaves allocated per datagram, and
+the most memory it allocates at once, the transient blocks included.
+
+Usage:
+
+    python -m benchmarks.receive [--datagrams N] [--batches N [N ...]] [--output FILE]
+"""
+
+import argparse
+import base64
+import collections
+import json
+import socket
+import time
+import tracemalloc
+
+from cryptography.fernet import Fernet
+
+from benchmarks.common import NullQueue
+from benchmarks.common import write_results
+from myason.collector.listener import Listener
+from myason.collector.processor import Processor
+
+# The key of the agent sending the records
+KEY = "raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI="
+
+
+class CountingQueue(NullQueue):
+    """A queue counting the records queued by the listener"""
+
+    def __init__(self):
+        self.items = 0
+
+    def put(self, item, block=True, timeout=None):
+        self.items += 1
+
+
+def sample_record():
+    flows = {
+        f"bench,10.0.0.{n},10.1.0.1,6,{40000 + n},443,0,2048": {
+            "bytes": 1500 * n, "packets": n, "start_time": 1e9, "end_time": 1e9 + n, "flags": "SA"}
+        for n in range(1, 4)
+    }
+    return Fernet(KEY.encode()).encrypt(base64.b64encode(json.dumps(flows).encode()))
+
+
+def run_listener(record, datagrams, batch):
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    address, port = probe.getsockname()
+    probe.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    records = CountingQueue()
+    Processor.configure({address: KEY})
+    listener = Listener(records, NullQueue(), sock, address, port, batch=batch)
+    listener.start()
+    time.sleep(0.2)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.perf_counter()
+    for _ in range(datagrams):
+        sender.sendto(record, (address, port))
+    # Until the listener is done with the datagrams waiting in its socket buffer
+    received = -1
+    while received != records.items:
+        received = records.items
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start - 0.05
+    wakeups = listener.wakeups.value
+    listener.join()
+    sock.close()
+    sender.close()
+    return {
+        "datagrams_per_sec": received / elapsed,
+        "lost": datagrams - received,
+        "per_wakeup": received / max(1, wakeups),
+    }
+
+
+def readers(receiver, pool_size=256):
+    """Returns the two ways of reading a datagram: recvfrom, and recvfrom_into a buffer of a pool"""
+    pool = collections.deque(bytearray(65535) for _ in range(pool_size))
+
+    def recvfrom():
+        return receiver.recvfrom(65535)[0]
+
+    def recvfrom_into():
+        buffer = pool.popleft()
+        size, _ = receiver.recvfrom_into(buffer)
+        view = memoryview(buffer)[:size]
+        data = view.tobytes()
+        view.release()
+        pool.append(buffer)
+        return data
+
+    return recvfrom, recvfrom_into
+
+
+def run_buffers(record, datagrams):
+    """Reads datagrams with recvfrom, then with recvfrom_into a buffer of a pool, in nanoseconds per datagram"""
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    results = {}
+    # Fewer datagrams than the socket buffer holds: every one is read, none waited for
+    burst = min(datagrams, 1000)
+    for read in readers(receiver):
+        elapsed = 0.
+        for _ in range(datagrams // burst):
+            for _ in range(burst):
+                sender.sendto(record, receiver.getsockname())
+            start = time.perf_counter()
+            for _ in range(burst):
+                read()
+            elapsed += time.perf_counter() - start
+        results[read.__name__] = elapsed / (datagrams // burst * burst) * 1e9
+    receiver.close()
+    sender.close()
+    return results
+
+
+def run_allocations(record, datagrams):
+    """Traces the memory allocated reading a datagram with recvfrom, then with recvfrom_into a buffer of a pool
+
+    Apart from the timings, tracemalloc slowing the allocations down. The datagrams read are kept, so
+    that the blocks left allocated by each read are counted, and the traces are cleared before each
+    read, so that its peak is the memory it allocated at most, the transient blocks included.
+
+    Returns:
+        {read: {"blocks", "bytes", "peak_bytes"}}, per datagram
+    """
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    burst = min(datagrams, 1000)
+    results = {}
+    for read in readers(receiver):
+        for _ in range(burst):
+            sender.sendto(record, receiver.getsockname())
+        # Preallocated, not to be traced growing
+        kept = [None] * burst
+        peak = 0
+        tracemalloc.start()
+        for n in range(burst):
+            tracemalloc.clear_traces()
+            kept[n] = read()
+            peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        for _ in range(burst):
+            sender.sendto(record, receiver.getsockname())
+        kept = [None] * burst
+        tracemalloc.start()
+        for n in range(burst):
+            kept[n] = read()
+        statistics = tracemalloc.take_snapshot().statistics("filename")
+        tracemalloc.stop()
+        results[read.__name__] = {
+            "blocks": sum(statistic.count for statistic in statistics) / burst,
+            "bytes": sum(statistic.size for statistic in statistics) / burst,
+            "peak_bytes": peak / burst,
+        }
+    receiver.close()
+    sender.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.receive")
+    parser.add_argument("-d", "--datagrams", type=int, default=20000)
+    parser.add_argument("-b", "--batches", type=int, nargs="+", default=[1, 8, 64],
+                        help="datagrams read per wakeup of the listener")
+    parser.add_argument("-o", "--output", default="bench_receive.json")
+    arguments = parser.parse_args()
+    record = sample_record()
+    results = {"datagrams": arguments.datagrams, "record_bytes": len(record), "batches": {}}
+    for batch in arguments.batches:
+        results["batches"][batch] = run_listener(record, arguments.datagrams, batch)
+        print(json.dumps({"batch": batch, **results["batches"][batch]}))
+    results["receive_ns"] = run_buffers(record, arguments.datagrams)
+    print(json.dumps({"receive_ns": results["receive_ns"]}))
+    results["receive_allocations"] = run_allocations(record, arguments.datagrams)
+    print(json.dumps({"receive_allocations": results["receive_allocations"]}))
+    write_results(results, arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the agent packet processing of an interface sharded across processors
+
+The frames of an interface are dispatched by flow to 1 to 16 shards, each one owning its flows in
+the cache of its processor. Every shard count is measured with the processors as threads (as the
+agent runs them, sharing the interpreter lock), and as processes (each one dissecting the frames of
+its shard, as the building block of a multi-process agent):
+
+- dispatch: the time spent computing the shard of every frame, in the sniffer thread
+- packets_per_sec: the packets processed per second, from the first frame dispatched to the last
+  flow exported
+- balance: the packets of the busiest shard over the packets of an even split
+
+Usage:
+
+    python -m benchmarks.shards [--flows N] [--packets-per-flow N] [--shards N [N ...]] [--replies]
+                                [--biflow] [--cache-limit N] [--modes {threads,processes} ...]
+                                [--output FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import queue
+import time
+
+from benchmarks.common import NullQueue
+from benchmarks.common import peak_rss_kb
+from benchmarks.common import synthetic_packets
+from benchmarks.common import write_results
+from myason.agent.processor import Processor
+from myason.agent.shards import ShardedQueue
+from myason.agent.shards import shard_of
+from myason.helpers.worker import stop_workers
+
+
+class CountingQueue(NullQueue):
+    """A queue counting the flows exported into it"""
+
+    def __init__(self):
+        self.items = 0
+
+    def put(self, item, block=True, timeout=None):
+        self.items += 1
+
+
+def run_threads(frames, shards, cache_limit, biflow):
+    entries = CountingQueue()
+    fifos = [queue.Queue() for _ in range(shards)]
+    processors = [
+        Processor(fifo, entries, NullQueue(), max(1, cache_limit // shards), 1800, 15, biflow=biflow)
+        for fifo in fifos
+    ]
+    packets = ShardedQueue(fifos) if shards > 1 else fifos[0]
+    for processor in processors:
+        processor.start()
+    start = time.perf_counter()
+    for frame in frames:
+        packets.put(frame)
+    stop_workers(processors)
+    elapsed = time.perf_counter() - start
+    return elapsed, entries.items
+
+
+def process_shard(arguments):
+    """Processes the frames of a shard in a child process"""
+    from scapy.layers.l2 import Ether
+    frames, cache_limit, biflow = arguments
+    entries = CountingQueue()
+    processor = Processor(None, entries, NullQueue(), cache_limit, 1800, 15, biflow=biflow)
+    for data, ifname in frames:
+        processor.process_packet((Ether(data), ifname))
+    processor.age_cache(flush=True)
+    return entries.items
+
+
+def run_processes(frames, shards, cache_limit, biflow, pool):
+    start = time.perf_counter()
+    shard_frames = [[] for _ in range(shards)]
+    for pkt, ifname in frames:
+        data = pkt.original
+        shard_frames[shard_of(data, shards)].append((data, ifname))
+    exported = pool.map(process_shard, [(part, max(1, cache_limit // shards), biflow) for part in shard_frames])
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(exported)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.shards")
+    parser.add_argument("-f", "--flows", type=int, default=2000)
+    parser.add_argument("-n", "--packets-per-flow", type=int, default=10)
+    parser.add_argument("-sh", "--shards", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("-r", "--replies", action="store_true", help="synthetic traffic in both directions")
+    parser.add_argument("-b", "--biflow", action="store_true", help="processors in biflow mode")
+    parser.add_argument("-c", "--cache-limit", type=int, default=65536, help="cache limit of the interface")
+    parser.add_argument("-m", "--modes", nargs="+", default=["threads", "processes"],
+                        choices=["threads", "processes"])
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_shards.json")
+    arguments = parser.parse_args()
+    frames = synthetic_packets(arguments.flows, arguments.packets_per_flow, seed=arguments.seed,
+                               replies=arguments.replies)
+    results = {
+        "packets": len(frames),
+        "flows": arguments.flows,
+        "replies": arguments.replies,
+        "biflow": arguments.biflow,
+        "cpus": multiprocessing.cpu_count(),
+        "shards": {},
+    }
+    pool = None
+    if "processes" in arguments.modes:
+        pool = multiprocessing.Pool(max(arguments.shards))
+    for shards in arguments.shards:
+        # The dispatch cost and the balance of the shards
+        counts = [0] * shards
+        start = time.perf_counter()
+        for pkt, _ in frames:
+            counts[shard_of(pkt.original, shards)] += 1
+        dispatch_s = time.perf_counter() - start
+        result = {
+            "dispatch_us_per_packet": dispatch_s / len(frames) * 1e6,
+            "balance": max(counts) / (len(frames) / shards),
+        }
+        for mode in arguments.modes:
+            if mode == "threads":
+                elapsed, exported = run_threads(frames, shards, arguments.cache_limit, arguments.biflow)
+            else:
+                elapsed, exported = run_processes(frames, shards, arguments.cache_limit, arguments.biflow, pool)
+            result[mode] = {
+                "elapsed_s": elapsed,
+                "packets_per_sec": len(frames) / elapsed,
+                "flows_exported": exported,
+            }
+        results["shards"][shards] = result
+        print(json.dumps({"shards": shards, **result}))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    results["peak_rss_kb"] = peak_rss_kb()
+    write_results(results, arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
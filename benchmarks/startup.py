@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the cold start of each myason.py subcommand
+
+Every subcommand imports its modules in a fresh interpreter, as when a container restarts it,
+measuring:
+
+- process_ms: the time to start an interpreter, import the modules of the subcommand and exit
+  (the median of the runs), against python_ms, the same with no import
+- import_ms: the time spent importing the modules of the subcommand (python -X importtime)
+- heaviest: the packages taking the longest to import, in milliseconds
+
+Usage:
+
+    python -m benchmarks.startup [--runs N] [--subcommands NAME [NAME ...]] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import percentile
+from benchmarks.common import write_results
+
+# The modules imported by each subcommand of myason.py
+SUBCOMMANDS = {
+    "agent": ["agent"],
+    "collector": ["collector"],
+    "collector_asyncio": ["collector", "myason.collector.aio"],
+    "query": ["myason.archive.query"],
+    "ifconfig": ["myason.ifconfig.adapters"],
+    "keygen": ["myason.crypto.keygen"],
+    "dictionary": ["myason.dictionary.trainer"],
+}
+# The modules of the repository, left out of the slowest packages
+OWN_PACKAGES = ("myason", "agent", "collector")
+# The repository, the working directory of the subcommands
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code, importtime=False):
+    """Runs code in a fresh interpreter, returns its wall time (in seconds) and its standard error"""
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               universal_newlines=True, check=True)
+    return time.perf_counter() - start, completed.stderr
+
+
+def import_times(stderr, modules):
+    """Parses python -X importtime: the import time of modules and the slowest packages (in milliseconds)"""
+    total = 0.
+    packages = {}
+    started = False
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1]) / 1e3
+        except ValueError:
+            # The header line
+            continue
+        # Nested imports are indented by two spaces per level
+        name = fields[2][1:].rstrip()
+        if not started:
+            # The modules imported by the interpreter startup come first, site last
+            started = name == "site"
+            continue
+        if name in modules:
+            total += cumulative
+        package = name.strip().split(".")[0]
+        packages[package] = max(packages.get(package, 0.), cumulative)
+    heaviest = sorted(
+        ((package, cumulative) for package, cumulative in packages.items() if package not in OWN_PACKAGES),
+        key=lambda item: -item[1],
+    )[:5]
+    return total, {package: round(cumulative, 1) for package, cumulative in heaviest}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.startup")
+    parser.add_argument("-r", "--runs", type=int, default=10, help="fresh interpreters per subcommand")
+    parser.add_argument("-s", "--subcommands", nargs="+", default=list(SUBCOMMANDS), choices=list(SUBCOMMANDS))
+    parser.add_argument("-o", "--output", default="bench_startup.json")
+    arguments = parser.parse_args()
+    python_s = [run("pass")[0] for _ in range(arguments.runs)]
+    results = {
+        "runs": arguments.runs,
+        "python_ms": percentile(python_s, 50) * 1e3,
+        "subcommands": {},
+    }
+    for subcommand in arguments.subcommands:
+        modules = SUBCOMMANDS[subcommand]
+        code = "; ".join(f"import {module}" for module in modules)
+        process_s = [run(code)[0] for _ in range(arguments.runs)]
+        import_s = []
+        heaviest = {}
+        for _ in range(arguments.runs):
+            total, heaviest = import_times(run(code, importtime=True)[1], modules)
+            import_s.append(total)
+        result = {
+            "process_ms": percentile(process_s, 50) * 1e3,
+            "import_ms": percentile(import_s, 50),
+            "heaviest": heaviest,
+        }
+        results["subcommands"][subcommand] = result
+        print(json.dumps({"subcommand": subcommand, **result}))
+    write_results(results, arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,31 @@ import queue
 import socket
 import time
 
+from myason.collector.alerter import create_alerter
+from myason.collector.archiver import create_archiver
+from myason.collector.feed import create_feed
+from myason.collector.conf import COLLECTOR_SCHEMA
 from myason.collector.conf import conf_is_ok
+from myason.collector.conf import reconfigure
+from myason.collector.enricher import Enricher
+from myason.collector.enricher import configure_enrichers
+from myason.collector.enricher import enrichment_enabled
 from myason.collector.listener import Listener
+from myason.collector.listener import StreamListener
 from myason.collector.processor import Processor
 from myason.collector.writer import Writer
+from myason.collector.writer import wal_options
+from myason.helpers import compression
+from myason.helpers import metrics
 from myason.helpers.conf import conf_loader
+from myason.helpers.bus import Bus
+from myason.helpers.endpoint import Endpoint
 from myason.helpers.logging import logger_conf_loader
 from myason.helpers.messenger import Messenger
+from myason.helpers.profiler import ProfilerSwitch
+from myason.helpers.reloader import Reloader
+from myason.helpers.worker import Tee
+from myason.helpers.worker import stop_workers
 
 
 def collector(logger_conf_fn, collector_conf_fn):
@@ -20,7 +38,7 @@ def collector(logger_conf_fn, collector_conf_fn):
         return
     # Load configurations
     logger_conf = logger_conf_loader(logger_conf_fn)
-    collector_conf = conf_loader(collector_conf_fn)
+    collector_conf = conf_loader(collector_conf_fn, COLLECTOR_SCHEMA)
     # Create socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     # Create the messages queue
@@ -31,6 +49,67 @@ def collector(logger_conf_fn, collector_conf_fn):
     rec_queue = queue.Queue()
     # Create the messenger worker
     messenger = Messenger(logger_conf, msg_queue)
+    # Create the endpoint worker, serving the metrics
+    endpoint = None
+    if collector_conf.get("endpoint_port") is not None:
+        endpoint = Endpoint(
+            msg_queue,
+            collector_conf.get("endpoint_address", "127.0.0.1"),
+            collector_conf.get("endpoint_port"),
+        )
+    # Let the sampling profiler be toggled by SIGUSR1 or through the endpoint
+    ProfilerSwitch(
+        msg_queue,
+        "collector",
+        duration=collector_conf.get("profiler_duration", 30),
+        interval=collector_conf.get("profiler_interval", 0.01),
+        output_dir=collector_conf.get("profiler_dir", "log"),
+        output_format=collector_conf.get("profiler_format", "collapsed"),
+    ).install(endpoint)
+    # Let the configuration be reloaded by SIGHUP, through the endpoint, or when its files are modified
+    reloader = Reloader(
+        msg_queue,
+        messenger,
+        "collector",
+        logger_conf_fn,
+        collector_conf_fn,
+        conf_is_ok,
+        interval=collector_conf.get("reload_interval"),
+        schema=COLLECTOR_SCHEMA,
+    )
+    reloader.install(endpoint)
+    # Publish the live feed and the alerts on a bus, streamed by the endpoint
+    bus = None
+    if endpoint is not None:
+        bus = Bus("collector")
+        bus.install(endpoint)
+    metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=msg_queue.qsize,
+                           queue="messages")
+    if collector_conf.get("runtime", "threads") == "asyncio":
+        # The event loop is only loaded by the asyncio runtime
+        import asyncio
+        from myason.collector import aio
+        # Start the messenger worker
+        messenger.start()
+        # Start the endpoint worker
+        if endpoint is not None:
+            endpoint.start()
+        # Start the reloader worker
+        reloader.start()
+        # Run the asyncio collector until SIGINT or SIGTERM
+        asyncio.run(aio.serve(collector_conf, msg_queue, reloader, bus))
+        # Stop the reloader worker
+        reloader.join()
+        # Stop the endpoint worker, once its streams are ended
+        if endpoint is not None:
+            bus.close()
+            endpoint.join()
+        # Stop the messenger worker
+        messenger.join()
+        return
+    for name, fifo in (("entries", ent_queue), ("records", rec_queue)):
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=fifo.qsize,
+                               queue=name)
     # Create a stack of workers
     writers_number = collector_conf.get("writers_number", 1)
     writers = []
@@ -43,53 +122,150 @@ def collector(logger_conf_fn, collector_conf_fn):
                 entries=ent_queue,
                 messages=msg_queue,
                 dbname=collector_conf.get("db_name"),
-                influx_params=collector_conf.get("influx_params")
+                influx_params=collector_conf.get("influx_params"),
+                cache_size=collector_conf.get("writer_cache_size", 65536),
+                node=collector_conf.get("node_name"),
+                **wal_options(collector_conf, n)
             )
         )
-    # Create processors
+    # Create the archiver, fed with the same entries as the writers, with an archive directory
+    archivers = []
+    out_queues = [ent_queue]
+    arc_queue = queue.Queue()
+    archive = create_archiver(collector_conf, arc_queue, msg_queue)
+    if archive is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=arc_queue.qsize,
+                               queue="archive")
+        archivers.append(archive)
+        out_queues.append(arc_queue)
+    # Create the alerter, fed with the same entries as the writers, with alerting rules
+    alerters = []
+    alr_queue = queue.Queue()
+    alerter = create_alerter(collector_conf, alr_queue, msg_queue, bus)
+    if alerter is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=alr_queue.qsize,
+                               queue="alerts")
+        alerters.append(alerter)
+        out_queues.append(alr_queue)
+    # Create the live feed, fed with the same entries as the writers, with a feed history and an endpoint
+    feeds = []
+    fd_queue = queue.Queue()
+    feed = create_feed(collector_conf, fd_queue, msg_queue, bus)
+    if feed is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=fd_queue.qsize,
+                               queue="feed")
+        feeds.append(feed)
+        out_queues.append(fd_queue)
+    out_queue = Tee(*out_queues) if len(out_queues) > 1 else ent_queue
+    # Create the enrichers, between the processors and the writers, with a prefix table or a resolver
+    enrichers = []
+    flow_queue = out_queue
+    if enrichment_enabled(collector_conf):
+        flow_queue = queue.Queue()
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=flow_queue.qsize,
+                               queue="flows")
+        configure_enrichers(collector_conf)
+        for n in range(collector_conf.get("enrichers_number", 1)):
+            enrichers.append(
+                Enricher(
+                    flows=flow_queue,
+                    entries=out_queue,
+                    messages=msg_queue,
+                )
+            )
+    # Create processors, sharing the compression dictionaries of the agents
+    dictionaries = compression.load_dictionaries(collector_conf.get("dictionaries"))
     for n in range(processors_number):
         processors.append(
             Processor(
                 agents=collector_conf.get("agents"),
                 records=rec_queue,
-                entries=ent_queue,
+                entries=flow_queue,
                 messages=msg_queue,
-                token_ttl=collector_conf.get("token_ttl", 5)
+                token_ttl=collector_conf.get("token_ttl", 5),
+                dictionaries=dictionaries,
+            )
+        )
+    # Create the listener workers, one per transport
+    transports = collector_conf.get("transports", ["udp"])
+    listeners = []
+    if "udp" in transports:
+        listeners.append(
+            Listener(
+                records=rec_queue,
+                messages=msg_queue,
+                sock=sock,
+                address=collector_conf.get("bind_address", "127.0.0.1"),
+                port=collector_conf.get("bind_port", 9999),
+                batch=collector_conf.get("receive_batch", 64),
+            )
+        )
+    if "tcp" in transports:
+        listeners.append(
+            StreamListener(
+                records=rec_queue,
+                messages=msg_queue,
+                address=collector_conf.get("bind_address", "127.0.0.1"),
+                port=collector_conf.get("bind_port", 9999),
             )
         )
-    # Create the listener worker
-    listener = Listener(
-        records=rec_queue,
-        messages=msg_queue,
-        sock=sock,
-        address=collector_conf.get("bind_address", "127.0.0.1"),
-        port=collector_conf.get("bind_port", 9999),
-        agents=collector_conf.get("agents", {}),
-    )
     # Start the messenger worker
     messenger.start()
+    # Start the endpoint worker
+    if endpoint is not None:
+        endpoint.start()
     # Start writers
     for writer in writers:
         writer.start()
+    # Start the archiver
+    for archive in archivers:
+        archive.start()
+    # Start the alerter
+    for alerter in alerters:
+        alerter.start()
+    # Start the live feed
+    for feed in feeds:
+        feed.start()
+    # Start enrichers
+    for enricher in enrichers:
+        enricher.start()
     # Start processors
     for processor in processors:
         processor.start()
-    # Start the listener worker
-    listener.start()
+    # Start the listener workers
+    for listener in listeners:
+        listener.start()
+    # Start the reloader worker, updating the running workers
+    reloader.subscribe(lambda conf: reconfigure(conf, processors, writers, enrichers, archivers, alerters))
+    reloader.start()
     # Infinite loop until KeyBoardInterrupt
     try:
         while True:
             time.sleep(100)
     except KeyboardInterrupt:
         msg_queue.put(("DEBUG", "KeyBoardInterrupt received. Stopping agent..."))
-        # Stop the listener worker
-        listener.join()
-        # Stop the processor workers
-        for processor in processors:
-            processor.join()
-        # Stop the writer workers
-        for writer in writers:
-            writer.join()
+        # Stop the reloader worker
+        reloader.join()
+        # Stop the listener workers
+        for listener in listeners:
+            listener.join()
+        # Stop the processor workers, once they have processed the queued records
+        stop_workers(processors)
+        # Stop the enricher workers, once they have enriched the queued flows
+        stop_workers(enrichers)
+        Enricher.set_resolver(None)
+        # Stop the writer workers, once they have written the queued entries
+        stop_workers(writers)
+        # Stop the archiver, once it has archived the queued entries and the open windows
+        stop_workers(archivers)
+        # Stop the alerter, once it has rolled up the queued entries
+        stop_workers(alerters)
+        # Stop the live feed, once it has published the queued entries
+        stop_workers(feeds)
+        # Stop the endpoint worker, once its streams are ended
+        if endpoint is not None:
+            bus.close()
+            endpoint.join()
         # Stop the messenger worker
         messenger.join()
 
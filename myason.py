@@ -4,11 +4,6 @@
 
 import argparse
 
-import agent
-import collector
-from myason.ifconfig import adapters
-from myason.crypto import keygen
-
 
 def main():
     # Create the top-level parser
@@ -19,6 +14,9 @@ def main():
     parser_agent = subparsers.add_parser(name="agent", help="agent help")
     parser_agent.add_argument("-lc", "--agent-logger-conf", default="config/agent_logger.yml")
     parser_agent.add_argument("-ac", "--agent-conf", default="config/agent.yml")
+    parser_agent.add_argument("-p", "--pcap", nargs="+", help="pcap files to read instead of sniffing interfaces")
+    parser_agent.add_argument("-pt", "--pcap-timestamps", action="store_true",
+                              help="age the flows with the timestamps of the pcap files")
     # Create the parser for "collector" command
     parser_collector = subparsers.add_parser(name="collector", help="collector help")
     parser_collector.add_argument("-lc", "--collector-logger-conf", default="config/collector_logger.yml")
@@ -27,26 +25,81 @@ def main():
     parser_ifconfig = subparsers.add_parser(name="ifconfig", help="Prints list of available adapters")
     # Create the parser for keygen
     parser_keygen = subparsers.add_parser(name="keygen", help="Generates a Fernet key")
+    # Create the parser for dictionary
+    parser_dictionary = subparsers.add_parser(name="dictionary", help="Trains a compression dictionary")
+    parser_dictionary.add_argument("-o", "--output", default="config/flows.dict")
+    parser_dictionary.add_argument("-c", "--codec", default="zstd", choices=["zstd", "zlib"])
+    parser_dictionary.add_argument("-s", "--size", type=int, default=16384, help="dictionary size in bytes")
+    parser_dictionary.add_argument("-p", "--pcap", nargs="+", help="pcap files to sample flows from")
+    parser_dictionary.add_argument("-sd", "--spool", nargs="+", help="agent spool directories to sample records from")
+    parser_dictionary.add_argument("-bf", "--batch-flows", type=int, default=1,
+                                   help="flows per record, as in the agent configuration")
+    # Create the parser for query
+    parser_query = subparsers.add_parser(name="query", help="Queries the flows archive")
+    parser_query.add_argument("-d", "--archive-dir", nargs="+", default=["archive"],
+                              help="archive directories, one per node of a collector cluster")
+    parser_query.add_argument("-f", "--format", default="parquet", choices=["parquet", "arrow"])
+    parser_query.add_argument("-s", "--start", help="UTC time from which the flows end (YYYY-MM-DD[THH:MM[:SS]])")
+    parser_query.add_argument("-e", "--end", help="UTC time before which the flows end (YYYY-MM-DD[THH:MM[:SS]])")
+    parser_query.add_argument("-a", "--agent", help="address of the agent")
+    parser_query.add_argument("-ip", "--ip", help="source or destination address of the flows")
+    parser_query.add_argument("-src", "--src-ip", help="source address of the flows")
+    parser_query.add_argument("-dst", "--dst-ip", help="destination address of the flows")
+    parser_query.add_argument("-c", "--columns", nargs="+", help="columns to print")
+    parser_query.add_argument("-l", "--limit", type=int, help="maximum number of flows to print")
     # Parse arguments
     arguments = parser.parse_args()
+    # Only the modules of the subcommand are imported: the collector never loads scapy, nor keygen anything
     if arguments.app == "agent":
         # Start agent
+        import agent
         agent.agent(
             agent_conf_fn=arguments.agent_conf,
             logger_conf_fn=arguments.agent_logger_conf,
+            pcap_fns=arguments.pcap,
+            pcap_timestamps=arguments.pcap_timestamps,
         )
     elif arguments.app == "collector":
         # Start collector
+        import collector
         collector.collector(
             collector_conf_fn=arguments.collector_conf,
             logger_conf_fn=arguments.collector_logger_conf,
         )
     elif arguments.app == "ifconfig":
         # Starts ifconfig
+        from myason.ifconfig import adapters
         adapters.get_adapters()
     elif arguments.app == "keygen":
         # Starts keygen
+        from myason.crypto import keygen
         keygen.get_key()
+    elif arguments.app == "dictionary":
+        # Starts the dictionary training
+        from myason.dictionary import trainer
+        trainer.train(
+            output_fn=arguments.output,
+            codec=arguments.codec,
+            size=arguments.size,
+            pcap_fns=arguments.pcap,
+            spool_dirs=arguments.spool,
+            batch_flows=arguments.batch_flows,
+        )
+    elif arguments.app == "query":
+        # Starts the archive query
+        from myason.archive import query
+        query.print_flows(
+            archive_dir=arguments.archive_dir,
+            start=arguments.start,
+            end=arguments.end,
+            agent=arguments.agent,
+            ip=arguments.ip,
+            src_ip=arguments.src_ip,
+            dst_ip=arguments.dst_ip,
+            columns=arguments.columns,
+            file_format=arguments.format,
+            limit=arguments.limit,
+        )
 
 
 if __name__ == '__main__':
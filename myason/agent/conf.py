@@ -7,37 +7,56 @@ import socket
 import ifaddr
 import yaml
 
-from myason.helpers.logging import create_logger
+from myason.helpers import compression
+from myason.helpers.conf import COMMON_SCHEMA
+from myason.helpers.conf import ConfError
+from myason.helpers.conf import Option
+from myason.helpers.conf import read_yaml
+from myason.helpers.conf import unknown_items
+from myason.helpers.conf import validate
+from myason.helpers.logging import checks_logger
+from myason.helpers.logging import logger_conf_loader
+from myason.helpers.logging import validate_logger_conf
+from myason.helpers.ring import parse_node
 
 from cryptography.fernet import Fernet
 
+# The items of the agent configuration, with their types and defaults
+AGENT_SCHEMA = COMMON_SCHEMA + (
+    Option("interfaces", list),
+    Option("cache_limit", int, 1024, minimum=1),
+    Option("cache_active_timeout", float, 1800, minimum=0),
+    Option("cache_inactive_timeout", float, 15, minimum=0),
+    Option("cache_interim_interval", float, minimum=1),
+    Option("cache_biflow", bool, False),
+    Option("processors_number", int, 1, minimum=1),
+    Option("pcap_queue_size", int, 4096, minimum=1),
+    Option("collector_address", str, "127.0.0.1"),
+    Option("collector_port", int, 9999, minimum=0),
+    Option("collectors", list),
+    Option("agent_name", str),
+    Option("collectors_failback_interval", float, 60, minimum=0),
+    Option("collector_transport", str, "udp", choices=("udp", "tcp")),
+    Option("batch_flows", int, 1, minimum=1),
+    Option("batch_delay", float, 1, minimum=0),
+    Option("window", int, 64, minimum=1),
+    Option("retry_interval", float, 5, minimum=0),
+    Option("compression", str, "none"),
+    Option("compression_dictionary", str),
+    Option("compression_level", int),
+    Option("spool_dir", str),
+    Option("spool_segment_size", int, 16 * 1024 * 1024, minimum=1),
+    Option("spool_max_bytes", int, 1024 * 1024 * 1024, minimum=1),
+    Option("spool_replay_rate", float, 1000, minimum=1),
+    Option("key", str),
+)
+
 
 def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
     #
-    # Basic logging configuration
-    #
-    default_logging = {
-        "version": 1,
-        "formatters": {
-            "simple": {
-                "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-            }
-        },
-        "handlers": {
-            "file": {
-                "class": "logging.FileHandler",
-                "level": "DEBUG",
-                "formatter": "simple",
-                'filename': "log/agent_error.log"
-            }
-        },
-        "root": {
-            "level": "DEBUG",
-            "handlers": ["file"]
-        },
-        'disable_existing_loggers': False
-    }
-    log = create_logger('root', default_logging)
+    # Sanity checks logging, the running logger configuration being left alone
+    #
+    log = checks_logger("agent")
     #
     # Configurations sanity chacks
     #
@@ -59,10 +78,8 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
     #
     log.info(f"Parsing agent logger configuration file ({agent_logger_conf_fn})...")
     try:
-        with open(agent_logger_conf_fn) as conf_fn:
-            agent_logger_conf = conf_fn.read()
-        agent_logger_conf = yaml.load(agent_logger_conf)
-    except yaml.YAMLError as e:
+        agent_logger_conf = logger_conf_loader(agent_logger_conf_fn)
+    except (OSError, yaml.YAMLError) as e:
         log.error(f"Error parsing agent logger configuration file ({agent_logger_conf_fn})... exiting!")
         log.error(e)
         return False
@@ -72,12 +89,10 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
     #
     log.info(f"Verifying if agent logger configuration file ({agent_logger_conf_fn}) is valid...")
     try:
-        create_logger("myason_agent", agent_logger_conf)
+        validate_logger_conf(agent_logger_conf)
     except ValueError as e:
-        log = create_logger('root', default_logging)
         log.error(f"Agent logger configuration file ({agent_logger_conf_fn}): {e}... exiting!")
         return False
-    log = create_logger('root', default_logging)
     log.info(f"Agent logger configuration file ({agent_logger_conf_fn}) is valid...")
     #
     # Agent configuration sanity checks
@@ -96,18 +111,23 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
     #
     log.info(f"Parsing agent configuration file ({agent_conf_fn})...")
     try:
-        with open(agent_conf_fn) as conf_fn:
-            agent_conf = conf_fn.read()
-        agent_conf = yaml.load(agent_conf)
-    except yaml.YAMLError as e:
+        content = read_yaml(agent_conf_fn)
+    except (OSError, yaml.YAMLError) as e:
         log.error(f"Error parsing agent configuration file ({agent_conf_fn})... exiting!")
         log.error(e)
         return False
     log.info(f"Successfully parsed agent configuration file ({agent_conf_fn})...")
     #
-    # Ckeck agent configuration items
+    # Ckeck agent configuration items against the schema
     #
     log.info(f"Checking agent configuration file ({agent_conf_fn}) items...")
+    try:
+        agent_conf = validate(content, AGENT_SCHEMA)
+    except ConfError as e:
+        log.error(f"Agent configuration file ({agent_conf_fn}), {e}... exiting!")
+        return False
+    for name in unknown_items(content, AGENT_SCHEMA):
+        log.warning(f"Unknown item {name} in agent configuration file ({agent_conf_fn}), ignored...")
     #
     # Check interfaces item
     #
@@ -116,9 +136,6 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
     if iflist is None:
         log.error(f"Missing interfaces in agent configuration file ({agent_conf_fn})... Exiting!")
         return False
-    if not isinstance(iflist, list):
-        log.error(f"Interfaces in agent configuration file ({agent_conf_fn}) must be a list... Exiting!")
-        return False
     #
     # Check interfaces names
     #
@@ -150,6 +167,17 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
         )
         return False
     #
+    # Check the collectors of the cluster
+    #
+    collectors = agent_conf.get("collectors")
+    if collectors is not None:
+        for node in collectors:
+            try:
+                parse_node(node)
+            except ValueError:
+                log.error(f"Collector in agent configuration file ({agent_conf_fn}), {node} is not address:port...")
+                return False
+    #
     # Check fernet key presence
     #
     key = agent_conf.get("key", None)
@@ -165,6 +193,19 @@ def conf_is_ok(agent_logger_conf_fn, agent_conf_fn):
         log.error(f"Fernet key in agent configuration file ({agent_conf_fn}), is not valid... {e}")
         return False
     #
+    # Check compression codec availability
+    #
+    codec = agent_conf.get("compression", "none")
+    if not compression.available(codec):
+        log.error(f"Compression in agent configuration file ({agent_conf_fn}), {codec} is not available...")
+        return False
+    dictionary_fn = agent_conf.get("compression_dictionary")
+    if dictionary_fn is not None and not os.path.exists(dictionary_fn):
+        log.error(
+            f"Compression dictionary in agent configuration file ({agent_conf_fn}), {dictionary_fn} doesn't exist..."
+        )
+        return False
+    #
     # Exiting sanity checks with the relevant message
     #
     log.info("Agent configuration checks passed...")
@@ -1,85 +1,361 @@
 # -*- coding: utf-8 -*-
 
-import queue
-import threading
+import collections
+import random
+import select
+import socket
 import time
 import json
 import base64
 from cryptography.fernet import Fernet
 
+from myason.helpers import compression
+from myason.helpers import framing
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
 
-class Exporter(threading.Thread):
+# Largest json batch sent in a datagram, leaving room for the base 64 and Fernet overheads
+MAX_DATAGRAM_BATCH = 32 * 1024
+# Largest json batch sent in a stream frame
+MAX_FRAME_BATCH = 1024 * 1024
+
+
+def envelope(epoch, seq, fragments):
+    """Builds the json record of flow entries marshalled to json fragments, without their braces"""
+    return f'{{"epoch": {epoch}, "seq": {seq}, "flows": {{{", ".join(fragments)}}}}}'
+
+
+class Exporter(Worker):
     """The exporter
 
+    Flow entries are batched into records carrying the exporter epoch and a sequence number, so
+    that the collector can count the records lost on the way. Records are sent as datagrams (UDP),
+    or as frames over a persistent connection (TCP) acknowledged by the collector.
+
+    With the ring of a collector cluster, the records are sent to the node owning the route key of
+    the exporter. A node found unreachable is skipped for failback_interval seconds, the records
+    going to the next node of the ring meanwhile, with a new epoch.
     """
     worker_group = "exporter"
     worker_number = 0
 
-    def __init__(self, entries, messages, sock, address, port):
+    def __init__(self, entries, messages, sock, address, port, key, spool=None, replay_rate=1000, retry_interval=5.,
+                 transport="udp", batch_flows=1, batch_delay=1., window=64, ack_timeout=10., compressor=None,
+                 ring=None, route_key=None, failback_interval=60.):
         """Initialization
 
         Args:
             entries: The thread safe FIFO queue to consume with processed flows
             messages: The thread safe FIFO queue to feed with logging messages
-            sock: The socket to send datagrams to
+            sock: The socket to send datagrams to, None with the TCP transport
             address: The collector IP address
             port: The collector application port
+            key: The Fernet key shared with the collector
+            spool: The disk spool the records go through, None to send them directly
+            replay_rate: The maximum number of spooled records sent per second
+            retry_interval: The delay before sending again after a send failure (in seconds)
+            transport: "udp" or "tcp"
+            batch_flows: The maximum number of flows in a record
+            batch_delay: The maximum time a flow waits for its record to be sent (in seconds)
+            window: The maximum number of frames waiting for an acknowledgement (TCP)
+            ack_timeout: The maximum time to wait for an acknowledgement when the window is full (in seconds)
+            compressor: The compressor of the records, None to send them uncompressed
+            ring: The consistent hashing ring of the collectors, None to send to address and port
+            route_key: The key routing the records on the ring
+            failback_interval: The time an unreachable collector of the ring is skipped (in seconds)
         """
-        super().__init__()
-        Exporter.worker_number += 1
-        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        super().__init__(entries, messages)
         self.entries = entries
-        self.messages = messages
         self.sock = sock
         self.address = address
         self.port = port
-        self.stop = threading.Event()
+        self.set_key(key)
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.retry_interval = retry_interval
+        self.retry_at = 0.
+        self.tokens = float(replay_rate)
+        self.refilled_at = time.monotonic()
+        self.unreachable = False
+        self.transport = transport
+        self.compressor = compressor
+        # Records sequence
+        self.epoch = random.getrandbits(32)
+        self.seq = 0
+        # Flows waiting to be sent, as json fragments
+        self.batch = []
+        self.batch_size = 0
+        self.batch_started = 0.
+        self.set_batching(batch_flows, batch_delay)
+        self.batch_limit = MAX_FRAME_BATCH if transport == "tcp" else MAX_DATAGRAM_BATCH
+        # Stream connection, and the frames not acknowledged yet as (frame number, spool position) tuples
+        self.connection = None
+        self.frame_number = 0
+        self.in_flight = collections.deque()
+        self.acks = bytearray()
+        self.window = window
+        self.ack_timeout = ack_timeout
+        # Collector cluster, and the unreachable nodes as {(address, port): time until which they're skipped}
+        self.ring = ring
+        self.route_key = route_key
+        self.failback_interval = failback_interval
+        self.down = {}
+        self.next_ring = None
+        if ring is not None:
+            self.address, self.port = ring.node(route_key)
+        if spool is not None and transport == "udp":
+            # A connected socket reports the datagrams refused by the collector host
+            self.sock.connect((self.address, self.port))
+        self.export_seconds = metrics.registry.histogram(
+            "myason_agent_export_seconds", "Time spent exporting a flow entry", worker=self.name)
+        self.exported_bytes = metrics.registry.counter(
+            "myason_agent_exported_bytes_total", "Bytes sent to the collector", worker=self.name)
+        self.records = metrics.registry.counter(
+            "myason_agent_exported_records_total", "Records sent to the collector", worker=self.name)
+        self.lost = metrics.registry.counter(
+            "myason_agent_lost_records_total", "Records which couldn't be sent nor spooled", worker=self.name)
+        if spool is not None:
+            self.spooled = metrics.registry.counter(
+                "myason_agent_spooled_records_total", "Records appended to the spool", worker=self.name)
+            metrics.registry.gauge(
+                "myason_agent_spool_bytes", "Disk space used by the spool", function=spool.size, worker=self.name)
+            metrics.registry.gauge(
+                "myason_agent_spool_dropped_segments", "Spool segments dropped as the spool was full",
+                function=lambda: spool.dropped_segments, worker=self.name)
 
-    def run(self):
-        self.messages.put(("INFO", f"{self.name}: up and running..."))
-        while not self.stop.isSet():
-            try:
-                entry = self.entries.get(block=False)
-                if entry is not None:
-                    self.export_entry(entry)
-            except queue.Empty:
-                time.sleep(0.5)
+    def set_key(self, key):
+        self.fernet = Fernet(key.encode())
+
+    def set_batching(self, batch_flows, batch_delay):
+        self.batch_flows = batch_flows
+        self.batch_delay = batch_delay
+        # Wake up in time to send a batch waiting for more flows
+        self.idle_timeout = min(Worker.idle_timeout, batch_delay) if batch_flows > 1 else Worker.idle_timeout
+
+    def process(self, entry):
+        if self.next_ring is not None:
+            self.switch_ring()
+        start = time.perf_counter()
+        self.export_entry(entry)
+        self.export_seconds.observe(time.perf_counter() - start)
 
     def export_entry(self, entry):
         self.messages.put(("DEBUG", f"{self.name}: Processing flow entry {entry}"))
-        # Marshall entry (a dict()) to a json string
-        data = json.dumps(entry)
-        self.messages.put(("DEBUG", f"{self.name}: Sending flow entry to ({self.address}, {self.port}): json {data}"))
+        # Marshall entry (a dict()) to a json fragment, without the braces
+        fragment = json.dumps(entry)[1:-1]
+        if self.batch and self.batch_size + len(fragment) > self.batch_limit:
+            self.flush()
+        if not self.batch:
+            self.batch_started = time.monotonic()
+        self.batch.append(fragment)
+        self.batch_size += len(fragment)
+        if len(self.batch) >= self.batch_flows or time.monotonic() - self.batch_started >= self.batch_delay:
+            self.flush()
+
+    def flush(self):
+        """Sends the batched flows as a record"""
+        self.seq += 1
+        data = envelope(self.epoch, self.seq, self.batch)
+        self.batch = []
+        self.batch_size = 0
+        self.messages.put(("DEBUG", f"{self.name}: Sending record to ({self.address}, {self.port}): json {data}"))
         # Encode string
         data = data.encode()
-        self.messages.put(
-            ("DEBUG", f"{self.name}: Sending flow entry to ({self.address}, {self.port}): encoded {data}"))
-        # Encode bytes to base 64
-        data = base64.b64encode(data)
-        self.messages.put(("DEBUG", f"{self.name}: Sending flow entry to ({self.address}, {self.port}): base64 {data}"))
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if self.spool is None:
+            # Send to collector
+            self.send(self.encrypt(data))
+            return
+        # Spool, then send what the collector can take. Records are encrypted when sent, so that the
+        # tokens of a replayed backlog are still within the collector token_ttl
+        self.spool.append(data)
+        self.spooled.inc()
+        self.replay()
+
+    def encrypt(self, data):
+        # Encode bytes to base 64, unless compressed: the collector tells them apart by their marker
+        if not compression.is_compressed(data):
+            data = base64.b64encode(data)
         # Crypt the data
-        key = 'raQHLAAWepWDA9rxUCH5sP-FEMnMZ419B4zO7YmyeMI='.encode()
-        fernet = Fernet(key)
-        data = fernet.encrypt(data)
-        self.messages.put(("DEBUG", f"{self.name}: Sending flow entry to ({self.address}, {self.port}): fernet {data}"))
-        # Send to collector
-        self.sock.sendto(data, (self.address, self.port))
-
-    def join(self, timeout=None):
-        self.stop.set()
-        self.messages.put(("INFO", f"{self.name}: stopping..."))
-        self.clean_up()
-        super().join(timeout)
-        self.messages.put(("INFO", f"{self.name}: stopped..."))
-
-    def clean_up(self):
-        self.messages.put(("INFO", f"{self.name}: cleaning up the entries queue..."))
+        data = self.fernet.encrypt(data)
+        self.messages.put(("DEBUG", f"{self.name}: Sending record to ({self.address}, {self.port}): fernet {data}"))
+        return data
+
+    def send(self, data):
+        if time.monotonic() < self.retry_at:
+            self.lost.inc()
+            return
+        try:
+            self.transmit(data)
+        except OSError as e:
+            self.lost.inc()
+            self.disconnect(e)
+            return
+        if self.transport == "tcp":
+            # The frames in flight are counted as lost when disconnecting
+            try:
+                self.wait_acks()
+            except OSError as e:
+                self.disconnect(e)
+
+    def replay(self):
+        """Sends the spooled records, at most replay_rate per second"""
+        now = time.monotonic()
+        if now < self.retry_at:
+            return
+        # Refill the token bucket, holding up to one second of records
+        self.tokens = min(float(self.replay_rate), self.tokens + (now - self.refilled_at) * self.replay_rate)
+        self.refilled_at = now
+        try:
+            while self.tokens >= 1:
+                if self.transport == "tcp":
+                    self.wait_acks()
+                record = self.spool.read()
+                if record is None:
+                    break
+                position, data = record
+                self.transmit(self.encrypt(data), position)
+                if self.transport == "udp":
+                    self.spool.commit(position)
+                self.tokens -= 1
+        except OSError as e:
+            # Keep the records spooled and try again later
+            self.disconnect(e)
+
+    def transmit(self, data, position=None):
+        if self.transport == "udp":
+            if self.spool is None:
+                self.sock.sendto(data, (self.address, self.port))
+            else:
+                self.sock.send(data)
+        else:
+            if self.connection is None:
+                self.connect()
+            self.frame_number += 1
+            self.connection.sendall(framing.frame(self.frame_number, data))
+            self.in_flight.append((self.frame_number, position))
+        self.exported_bytes.inc(len(data))
+        self.records.inc()
+        if self.unreachable:
+            self.unreachable = False
+            self.log("INFO", f"collector ({self.address}, {self.port}) reachable again...")
+
+    def connect(self):
+        self.connection = socket.create_connection((self.address, self.port), timeout=self.ack_timeout)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.frame_number = 0
+        self.acks = bytearray()
+
+    def wait_acks(self, limit=None):
+        """Reads the acknowledgements received, waiting for them while limit frames or more are in flight"""
+        if self.connection is None:
+            return
+        limit = self.window if limit is None else limit
         while True:
+            full = len(self.in_flight) >= limit
+            readable, _, _ = select.select([self.connection], [], [], self.ack_timeout if full else 0)
+            if not readable:
+                if full:
+                    raise TimeoutError("no acknowledgement received from the collector")
+                return
+            data = self.connection.recv(4096)
+            if not data:
+                raise ConnectionError("connection closed by the collector")
+            position = None
+            for ack in framing.read_acks(self.acks, data):
+                while self.in_flight and self.in_flight[0][0] <= ack:
+                    position = self.in_flight.popleft()[1]
+            if position is not None:
+                self.spool.commit(position)
+
+    def disconnect(self, e):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.spool is not None:
+            self.spool.rewind()
+        elif self.in_flight:
+            self.lost.inc(len(self.in_flight))
+            self.log("WARNING", f"{len(self.in_flight)} records not acknowledged by the collector were lost...")
+        self.in_flight.clear()
+        self.retry_at = time.monotonic() + self.retry_interval
+        if not self.unreachable:
+            self.unreachable = True
+            self.log("WARNING", f"collector ({self.address}, {self.port}) unreachable ({e}), retrying...")
+        if self.ring is not None and len(self.ring) > 1:
+            self.down[(self.address, self.port)] = time.monotonic() + self.failback_interval
+            self.route()
+
+    def set_ring(self, ring, route_key):
+        """Replaces the ring of the collectors, from another thread: the exporter thread switches to it"""
+        self.next_ring = (ring, route_key)
+
+    def switch_ring(self):
+        self.ring, self.route_key = self.next_ring
+        self.next_ring = None
+        self.down = {}
+        if self.ring is not None:
+            self.route()
+
+    def route(self):
+        """Switches to the node of the ring owning the route key, skipping the unreachable ones"""
+        now = time.monotonic()
+        self.down = {node: until for node, until in self.down.items() if until > now}
+        node = self.ring.node(self.route_key, exclude=self.down) or self.ring.node(self.route_key)
+        if node == (self.address, self.port):
+            return
+        self.log("INFO", f"records routed from collector ({self.address}, {self.port}) to {node}...")
+        if self.connection is not None:
+            # Let the collector acknowledge the frames in flight, the others are sent again or lost
+            try:
+                self.wait_acks(limit=1)
+            except OSError:
+                pass
+            self.connection.close()
+            self.connection = None
+        if self.spool is not None:
+            self.spool.rewind()
+        elif self.in_flight:
+            self.lost.inc(len(self.in_flight))
+        self.in_flight.clear()
+        self.address, self.port = node
+        if self.spool is not None and self.transport == "udp":
+            self.sock.connect(node)
+        # A new stream for the sequence tracking of the collector
+        self.epoch = random.getrandbits(32)
+        self.seq = 0
+        self.unreachable = False
+        self.retry_at = 0.
+
+    def idle(self):
+        if self.next_ring is not None:
+            self.switch_ring()
+        if self.ring is not None and self.down:
+            # Fail back to the nodes reachable again
+            self.route()
+        if self.batch:
+            self.flush()
+        if self.spool is not None:
+            self.replay()
+        elif self.connection is not None:
+            try:
+                self.wait_acks()
+            except OSError as e:
+                self.disconnect(e)
+
+    def finish(self):
+        if self.batch:
+            self.flush()
+        if self.connection is not None:
+            # Let the collector acknowledge the last frames
             try:
-                entry = self.entries.get(block=False)
-                if entry is not None:
-                    self.export_entry(entry)
-            except queue.Empty:
-                break
-        self.messages.put(("INFO", f"{self.name}: entries queue has been cleaned..."))
-        self.sock.close()
+                self.wait_acks(limit=1)
+            except OSError as e:
+                self.disconnect(e)
+        if self.spool is not None:
+            self.spool.close()
+        if self.connection is not None:
+            self.connection.close()
+        if self.sock is not None:
+            self.sock.close()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+
+import mmap
+import os
+import struct
+
+# Link type of Ethernet frames
+LINKTYPE_ETHERNET = 1
+
+# Classic pcap magic numbers: (byte order, timestamp resolution)
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+# Pcapng block types
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_TSRESOL = 9
+# Smallest lengths of the blocks holding their fixed fields
+PCAPNG_MIN_LENGTHS = {
+    PCAPNG_INTERFACE_DESCRIPTION: 20,
+    PCAPNG_SIMPLE_PACKET: 16,
+    PCAPNG_ENHANCED_PACKET: 32,
+}
+
+
+def read_frames(pcap_fn):
+    """Streams the frames of a pcap or pcapng file
+
+    The file is memory-mapped and parsed in place: only the frame currently yielded is copied.
+
+    Args:
+        pcap_fn: The pcap or pcapng file name
+
+    Yields:
+        (timestamp, linktype, frame) tuples
+
+    Raises:
+        ValueError: The file is neither a pcap nor a pcapng file, or is truncated or malformed
+    """
+    with open(pcap_fn, "rb") as pcap_file:
+        if os.fstat(pcap_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(pcap_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic = buf[:4]
+            if magic in PCAP_MAGICS:
+                yield from read_pcap(buf, *PCAP_MAGICS[magic])
+            elif magic == struct.pack("<I", PCAPNG_SECTION_HEADER):
+                yield from read_pcapng(buf)
+            else:
+                raise ValueError(f"{pcap_fn} is not a pcap or pcapng file")
+
+
+def read_pcap(buf, byte_order, resolution):
+    if len(buf) < 24:
+        raise ValueError("Truncated pcap global header")
+    linktype = struct.unpack_from(f"{byte_order}I", buf, 20)[0] & 0x0FFFFFFF
+    record_header = struct.Struct(f"{byte_order}IIII")
+    offset = 24
+    end = len(buf)
+    while offset + record_header.size <= end:
+        ts_sec, ts_frac, caplen, _ = record_header.unpack_from(buf, offset)
+        offset += record_header.size
+        if offset + caplen > end:
+            raise ValueError("Truncated pcap record")
+        yield ts_sec + ts_frac * resolution, linktype, buf[offset:offset + caplen]
+        offset += caplen
+
+
+def read_pcapng(buf):
+    end = len(buf)
+    offset = 0
+    byte_order = "<"
+    interfaces = []
+    timestamp = 0.
+    while offset + 12 <= end:
+        block_type = struct.unpack_from(f"{byte_order}I", buf, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # The byte order may change at every section
+            magic = struct.unpack_from("<I", buf, offset + 8)[0]
+            byte_order = "<" if magic == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            interfaces = []
+        block_length = struct.unpack_from(f"{byte_order}I", buf, offset + 4)[0]
+        if block_length < 12 or offset + block_length > end:
+            raise ValueError("Truncated pcapng block")
+        if block_length < PCAPNG_MIN_LENGTHS.get(block_type, 12):
+            raise ValueError(f"Short pcapng block (type {block_type:#x}, length {block_length})")
+        body = offset + 8
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack_from(f"{byte_order}H", buf, body)[0]
+            resolution = pcapng_resolution(buf, body + 8, offset + block_length - 4, byte_order)
+            interfaces.append((linktype, resolution))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            if_id, ts_high, ts_low, caplen, _ = struct.unpack_from(f"{byte_order}IIIII", buf, body)
+            if if_id >= len(interfaces):
+                raise ValueError(f"Pcapng packet of an undescribed interface ({if_id})")
+            caplen = min(caplen, block_length - 32)
+            linktype, resolution = interfaces[if_id]
+            timestamp = ((ts_high << 32) | ts_low) * resolution
+            data = body + 20
+            yield timestamp, linktype, buf[data:data + caplen]
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # Simple packet blocks carry no timestamp: reuse the last one seen
+            origlen = struct.unpack_from(f"{byte_order}I", buf, body)[0]
+            caplen = min(origlen, block_length - 16)
+            if not interfaces:
+                raise ValueError("Pcapng packet before any interface description")
+            linktype, _ = interfaces[0]
+            data = body + 4
+            yield timestamp, linktype, buf[data:data + caplen]
+        offset += block_length
+
+
+def pcapng_resolution(buf, offset, end, byte_order):
+    # Walk the interface description options looking for if_tsresol
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(f"{byte_order}HH", buf, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1 and offset + 4 < end:
+            tsresol = buf[offset + 4]
+            if tsresol & 0x80:
+                return 2. ** -(tsresol & 0x7F)
+            return 10. ** -tsresol
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
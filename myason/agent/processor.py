@@ -1,25 +1,40 @@
 # -*- coding: utf-8 -*-
 
-import queue
-import threading
+import math
 import time
-import arrow
 
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
 from scapy.layers.l2 import Ether
 from scapy.layers.inet import IP
 from scapy.layers.inet import TCP
 from scapy.layers.inet import UDP
 from scapy.layers.inet6 import IPv6
 
+# The time a closed biflow stays in the cache, for the last ACK of the connection (in seconds)
+CLOSED_LINGER = 1.0
 
-class Processor(threading.Thread):
+
+class Processor(Worker):
     """The packets processor
 
+    In biflow mode, the two directions of a connection share a single cache entry, keyed by the
+    direction of its first packet (the initiator). The packets of the other direction are counted
+    in the rev_bytes, rev_packets and rev_flags fields. The TCP connection state is tracked, so that
+    the connection is aged once both sides have sent a FIN or either has sent a RST, and its
+    handshake round trip time (SYN to the ACK of the SYN-ACK) is exported as rtt.
+
+    With an interim interval, the flows staying in the cache longer than it are exported every
+    interval as interim records, holding the packets counted since the previous record: the flows
+    are exported as consecutive deltas, the last one, not interim and empty when nothing is left,
+    when they're aged. The delta boundaries are whole seconds, so that the seconds of consecutive
+    deltas never overlap. The round trip time is exported once, on the first record holding it.
     """
     worker_group = "processor"
     worker_number = 0
 
-    def __init__(self, packets, entries, messages, cache_limit, cache_active_timeout, cache_inactive_timeout):
+    def __init__(self, packets, entries, messages, cache_limit, cache_active_timeout, cache_inactive_timeout,
+                 packet_time=False, biflow=False, interim_interval=None):
         """Initialization
 
         Args:
@@ -29,52 +44,54 @@ class Processor(threading.Thread):
             cache_limit: The cache size limit (in number of flows)
             cache_active_timeout: The cache maximum active time for a flow
             cache_inactive_timeout: The cache maximum inactive time for a flow
+            packet_time: Use the packets timestamps instead of the wall clock (pcap replays)
+            biflow: Track both directions of a connection in a single flow
+            interim_interval: The interval of the interim records of the cached flows (in seconds), None for none
         """
-        super().__init__()
-        Processor.worker_number += 1
-        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        super().__init__(packets, messages)
         self.packets = packets
-        self.messages = messages
         self.entries = entries
-        self.stop = threading.Event()
         self.cache = {}
         self.cache_limit = cache_limit
         self.active_timeout = cache_active_timeout
         self.inactive_timeout = cache_inactive_timeout
+        self.packet_time = packet_time
+        self.biflow = biflow
+        self.interim_interval = interim_interval
+        self.last_time = 0.
+        self.packet_seconds = metrics.registry.histogram(
+            "myason_agent_packet_seconds", "Time spent processing a packet", worker=self.name)
+        self.flows_exported = metrics.registry.counter(
+            "myason_agent_flows_aged_total", "Flows aged out of the cache", worker=self.name)
+        self.interim_records = metrics.registry.counter(
+            "myason_agent_interim_records_total", "Interim records of cached flows", worker=self.name)
+        metrics.registry.gauge(
+            "myason_agent_cache_flows", "Flows in the cache", function=lambda: len(self.cache), worker=self.name)
+
+    def process(self, pkt):
+        start = time.perf_counter()
+        self.process_packet(pkt)
+        self.packet_seconds.observe(time.perf_counter() - start)
 
-    def run(self):
-        self.messages.put(("INFO", f"{self.name}: up and running..."))
-        while not self.stop.isSet():
-            try:
-                pkt = self.packets.get(block=False)
-                if pkt is not None:
-                    self.process_packet(pkt)
-            except queue.Empty:
-                time.sleep(0.5)
-
-    def join(self, timeout=None):
-        self.stop.set()
-        self.messages.put(("INFO", f"{self.name}: stopping..."))
-        self.clean_up()
-        super().join(timeout)
-        self.messages.put(("INFO", f"{self.name}: stopped..."))
-
-    def clean_up(self):
-        self.messages.put(("INFO", f"{self.name}: cleaning up the packets queue..."))
-        while True:
-            try:
-                pkt = self.packets.get(block=False)
-                if pkt is not None:
-                    self.process_packet(pkt)
-            except queue.Empty:
-                break
-        self.messages.put(("INFO", f"{self.name}: packets queue has been cleaned..."))
+    def idle(self):
+        # Age the flows even when no packet comes in
+        self.age_cache()
+
+    def finish(self):
+        # Export the flows remaining in the cache
+        self.log("INFO", "exporting the flows remaining in the cache...")
+        self.age_cache(flush=True)
 
     def process_packet(self, packet):
         # Separate data and interface name
         pkt = packet[0]
         ifname = packet[1]
         ethertype = pkt[Ether].type
+        if self.packet_time:
+            timestamp = float(pkt.time)
+            self.last_time = max(self.last_time, timestamp)
+        else:
+            timestamp = time.time()
         # Packets dissection
         if IP in pkt:
             self.messages.put(("DEBUG", f"{self.name}: Packet is IPv4..."))
@@ -110,12 +127,15 @@ class Processor(threading.Thread):
         # Construct the dictionary key field
         key_field = f"{ifname},{src_ip},{dst_ip},{proto},{sport},{dport},{tos},{ethertype}"
         # Cache management
-        if key_field in self.cache:
+        if self.biflow:
+            reverse_key_field = f"{ifname},{dst_ip},{src_ip},{proto},{dport},{sport},{tos},{ethertype}"
+            self.update_biflow(key_field, reverse_key_field, length, timestamp, str(flags))
+        elif key_field in self.cache:
             # Update cache entry
             self.messages.put(("DEBUG", f"{self.name}: Update entry in the cache..."))
             self.cache[key_field]["bytes"] += length
             self.cache[key_field]["packets"] += 1
-            self.cache[key_field]["end_time"] = arrow.utcnow().float_timestamp
+            self.cache[key_field]["end_time"] = timestamp
             self.cache[key_field]["flags"] = str(flags)
         else:
             # Add cache entry
@@ -123,41 +143,141 @@ class Processor(threading.Thread):
             non_key_fields = {
                 "bytes": length,
                 "packets": 1,
-                "start_time": arrow.utcnow().float_timestamp,
-                "end_time": arrow.utcnow().float_timestamp,
+                "start_time": timestamp,
+                "end_time": timestamp,
                 "flags": str(flags),
             }
             self.cache[key_field] = non_key_fields
+        self.age_cache()
+
+    def update_biflow(self, key_field, reverse_key_field, length, timestamp, flags):
+        """Counts a packet in the biflow of its connection, in the direction it goes"""
+        flow = self.cache.get(key_field)
+        prefix = ""
+        if flow is None:
+            flow = self.cache.get(reverse_key_field)
+            prefix = "rev_"
+        if flow is None:
+            # Add cache entry, keyed by the initiator: a SYN-ACK comes from the other side
+            self.messages.put(("DEBUG", f"{self.name}: Add biflow entry in the cache..."))
+            flow = {
+                "bytes": 0,
+                "packets": 0,
+                "start_time": timestamp,
+                "end_time": timestamp,
+                "flags": "None",
+                "rev_bytes": 0,
+                "rev_packets": 0,
+                "rev_flags": "None",
+                # Connection state, not exported
+                "_syn_time": None,
+                "_synack_time": None,
+                "_fins": set(),
+                "_closed": False,
+            }
+            if "S" in flags and "A" in flags:
+                self.cache[reverse_key_field] = flow
+            else:
+                self.cache[key_field] = flow
+                prefix = ""
+        # Update cache entry
+        flow[f"{prefix}bytes"] += length
+        flow[f"{prefix}packets"] += 1
+        flow[f"{prefix}flags"] = flags
+        flow["end_time"] = timestamp
+        # Connection state
+        if "S" in flags:
+            if "A" not in flags and not prefix and flow["_syn_time"] is None:
+                flow["_syn_time"] = timestamp
+            elif "A" in flags and prefix and flow["_syn_time"] is not None and flow["_synack_time"] is None:
+                flow["_synack_time"] = timestamp
+        elif "A" in flags and not prefix and flow["_synack_time"] is not None and "rtt" not in flow:
+            flow["rtt"] = timestamp - flow["_syn_time"]
+        if "F" in flags:
+            # The directions which have sent a FIN
+            flow["_fins"].add(prefix)
+        if "R" in flags or len(flow["_fins"]) == 2:
+            flow["_closed"] = True
+
+    def export_flow(self, key_field):
+        flow = self.cache.pop(key_field, None)
+        self.flows_exported.inc()
+        if self.biflow or "_first_time" in flow:
+            record = {name: value for name, value in flow.items() if not name.startswith("_")}
+            if flow.get("_rtt_sent"):
+                record.pop("rtt", None)
+            # Nothing left since the last interim record: the final record is sent empty, the flow counted by it
+            record["end_time"] = max(record["end_time"], record["start_time"])
+            flow = record
+        entry = {key_field: flow}
+        self.messages.put(("DEBUG", f"{self.name}: Sending entry to exporter..."))
+        self.entries.put(entry)
+
+    def export_interim(self, key_field, now):
+        """Exports the packets of a cached flow counted since its previous record, up to a whole second"""
+        flow = self.cache[key_field]
+        boundary = min(math.floor(now), math.ceil(flow["end_time"]))
+        if boundary <= flow["start_time"]:
+            # No packet since the previous record
+            return
+        if flow["packets"] or flow.get("rev_packets"):
+            record = {name: value for name, value in flow.items() if not name.startswith("_")}
+            record["end_time"] = min(flow["end_time"], boundary)
+            record["interim"] = True
+            # The round trip time, once per connection
+            if flow.get("_rtt_sent"):
+                record.pop("rtt", None)
+            elif "rtt" in record:
+                flow["_rtt_sent"] = True
+            self.messages.put(("DEBUG", f"{self.name}: Sending interim entry to exporter..."))
+            self.entries.put({key_field: record})
+            self.interim_records.inc()
+        # The next record starts at the boundary, the flow staying in the cache
+        flow.setdefault("_first_time", flow["start_time"])
+        flow["start_time"] = boundary
+        flow["bytes"] = 0
+        flow["packets"] = 0
+        if "rev_bytes" in flow:
+            flow["rev_bytes"] = 0
+            flow["rev_packets"] = 0
+
+    def age_cache(self, flush=False):
         # Cache aging
         if len(self.cache) > self.cache_limit:
             # Export oldest entry
             self.messages.put(("WARNING", f"{self.name}: Cache size exceeded. Verify settings..."))
             cache_temp = sorted(((self.cache[key]["start_time"], key) for key in self.cache.keys()))
-            entry = {cache_temp[0][1]: self.cache.pop(cache_temp[0][1], None)}
-            self.messages.put(("DEBUG", f"{self.name}: {entry}"))
+            self.export_flow(cache_temp[0][1])
+        # Current time, as seen by the packets when replaying a capture
+        now = self.last_time if self.packet_time else time.time()
         cache_temp = dict(self.cache)
         for key_field in cache_temp.keys():
             start_time = cache_temp[key_field]["start_time"]
             end_time = cache_temp[key_field]["end_time"]
             flags = cache_temp[key_field]["flags"]
             aged = False
-            if self.stop.isSet():
+            if flush:
                 # Export the entry as the agent exits
                 self.messages.put(("DEBUG", f"{self.name}: Deleting entry from cache. Agent ending..."))
                 aged = True
-            elif "F" in flags or "R" in flags:
+            elif self.biflow and cache_temp[key_field]["_closed"]:
+                # Export the entry once the last packets of the closed TCP session are in
+                if now - end_time > CLOSED_LINGER:
+                    self.messages.put(("DEBUG", f"{self.name}: Deleting entry from cache. TCP session ended..."))
+                    aged = True
+            elif not self.biflow and ("F" in flags or "R" in flags):
                 # Export the entry as TCP session is closed
                 self.messages.put(("DEBUG", f"{self.name}: Deleting entry from cache. TCP session ended..."))
                 aged = True
-            elif end_time - start_time > self.active_timeout:
+            elif end_time - cache_temp[key_field].get("_first_time", start_time) > self.active_timeout:
                 # Export the entry because of max activity
                 self.messages.put(("DEBUG", f"{self.name}: Deleting entry from cache. Flow max active timeout..."))
                 aged = True
-            elif time.time() - end_time > self.inactive_timeout:
+            elif now - end_time > self.inactive_timeout:
                 # Export the entry because of max inactivity
                 self.messages.put(("DEBUG", f"{self.name}: Deleting entry from cache. Flow max inactive timeout..."))
                 aged = True
             if aged:
-                entry = {key_field: self.cache.pop(key_field, None)}
-                self.messages.put(("DEBUG", f"{self.name}: Sending entry to exporter..."))
-                self.entries.put(entry)
+                self.export_flow(key_field)
+            elif self.interim_interval and now - start_time >= self.interim_interval:
+                self.export_interim(key_field, now)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import threading
+
+from scapy.layers.l2 import Ether
+
+from myason.agent.pcap import LINKTYPE_ETHERNET
+from myason.agent.pcap import read_frames
+from myason.helpers import metrics
+
+
+class Reader(threading.Thread):
+    """The pcap reader
+
+    Feeds the packets queue with the frames of pcap files instead of a live interface.
+    """
+    worker_group = "reader"
+    worker_number = 0
+
+    def __init__(self, pkts, messages, pcap_fn):
+        """Initialization
+
+        Args:
+            pkts: The thread safe FIFO queue to feed with read packets
+            messages: The thread safe FIFO queue to feed with logging messages
+            pcap_fn: The pcap or pcapng file to read
+        """
+        super().__init__()
+        Reader.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.pcap_fn = pcap_fn
+        self.ifname = os.path.basename(pcap_fn)
+        self.stop = threading.Event()
+        self.pkts = pkts
+        self.messages = messages
+        self.frames = metrics.registry.counter(
+            "myason_agent_frames_total", "Frames captured", worker=self.name, interface=self.ifname)
+
+    def run(self):
+        self.messages.put(("INFO", f"{self.name}: up and running, reading {self.pcap_fn}..."))
+        try:
+            for timestamp, linktype, data in read_frames(self.pcap_fn):
+                if self.stop.isSet():
+                    break
+                if linktype != LINKTYPE_ETHERNET:
+                    self.messages.put(("DEBUG", f"{self.name}: Frame is NOT Ethernet. Ignoring it..."))
+                    continue
+                pkt = Ether(data)
+                pkt.time = timestamp
+                # Put packet and interface name in the queue
+                self.pkts.put((pkt, self.ifname))
+                self.frames.inc()
+        except (OSError, ValueError) as e:
+            self.messages.put(("ERROR", f"{self.name}: Error reading {self.pcap_fn}: {e}"))
+        self.messages.put(("INFO", f"{self.name}: {self.frames.value} frames read from {self.pcap_fn}..."))
+
+    def join(self, timeout=None):
+        self.stop.set()
+        self.messages.put(("INFO", f"{self.name}: stopping..."))
+        super().join(timeout)
+        self.messages.put(("INFO", f"{self.name}: stopped..."))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+
+# Ethertypes of the VLAN tags skipped to find the network layer
+VLAN_ETHERTYPES = (b"\x81\x00", b"\x88\xa8")
+IPV4_ETHERTYPE = b"\x08\x00"
+IPV6_ETHERTYPE = b"\x86\xdd"
+# Protocols whose ports are part of the flow key
+PORTS_PROTOCOLS = (b"\x06", b"\x11")
+
+
+def shard_key(frame):
+    """The bytes of an Ethernet frame identifying its flow, the same in both directions
+
+    The protocol followed by the (address, port) endpoints of the flow, the lower one first, read
+    from the frame without dissecting it. The frames of a flow key always have the same shard key,
+    so that a flow, and a biflow, is never split across shards.
+    """
+    offset = 12
+    ethertype = frame[offset:offset + 2]
+    while ethertype in VLAN_ETHERTYPES:
+        offset += 4
+        ethertype = frame[offset:offset + 2]
+    offset += 2
+    if ethertype == IPV4_ETHERTYPE:
+        header_length = (frame[offset] & 15) * 4 if len(frame) > offset else 0
+        proto = frame[offset + 9:offset + 10]
+        src = frame[offset + 12:offset + 16]
+        dst = frame[offset + 16:offset + 20]
+        # Only the first fragment holds the ports
+        fragment_offset = int.from_bytes(frame[offset + 6:offset + 8], "big") & 0x1fff
+        ports = frame[offset + header_length:offset + header_length + 4] if not fragment_offset else b""
+    elif ethertype == IPV6_ETHERTYPE:
+        proto = frame[offset + 6:offset + 7]
+        src = frame[offset + 8:offset + 24]
+        dst = frame[offset + 24:offset + 40]
+        ports = frame[offset + 40:offset + 44]
+    else:
+        return ethertype
+    if proto not in PORTS_PROTOCOLS:
+        ports = b""
+    src = src + ports[:2]
+    dst = dst + ports[2:]
+    return proto + (src + dst if src <= dst else dst + src)
+
+
+def shard_of(frame, shards):
+    return hash(shard_key(frame)) % shards
+
+
+class ShardedQueue:
+    """The packets queue of an interface processed by several processors
+
+    Dispatches the packets to the queues of the shards by flow: each processor owns the flows of its
+    shard, in its own cache, aged and exported by its own thread, without any lock.
+    """
+
+    def __init__(self, fifos):
+        """Initialization
+
+        Args:
+            fifos: The thread safe FIFO queues of the shards, one per processor
+        """
+        self.fifos = fifos
+        self.shards = len(fifos)
+
+    def put(self, item, block=True, timeout=None):
+        pkt = item[0]
+        frame = getattr(pkt, "original", None) or bytes(pkt)
+        self.fifos[shard_of(frame, self.shards)].put(item, block, timeout)
+
+    def qsize(self):
+        return sum(fifo.qsize() for fifo in self.fifos)
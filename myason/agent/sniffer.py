@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
 
-from scapy.all import *
+import threading
+
+# Sets the layer 2 sockets of the platform in conf, without loading every layer as scapy.all does
+import scapy.arch  # noqa: F401
+from scapy.config import conf
+from scapy.data import ETH_P_ALL
 from scapy.layers.l2 import Ether
 
+from myason.helpers import metrics
+
 
 class Sniffer(threading.Thread):
     """The Sniffer
@@ -11,6 +18,7 @@ class Sniffer(threading.Thread):
     """
     worker_group = "sniffer"
     worker_number = 0
+    idle_timeout = 1.0
 
     def __init__(self, pkts, messages, ifname):
         """Initialization
@@ -29,6 +37,8 @@ class Sniffer(threading.Thread):
         self.stop = threading.Event()
         self.pkts = pkts
         self.messages = messages
+        self.frames = metrics.registry.counter(
+            "myason_agent_frames_total", "Frames captured", worker=self.name, interface=ifname)
 
     def run(self):
         self.socket = conf.L2listen(
@@ -36,16 +46,18 @@ class Sniffer(threading.Thread):
             iface=self.ifname,
         )
         self.messages.put(("INFO", f"{self.name}: up and running..."))
-        while True:
-            sniff(
-                opened_socket=self.socket,
-                prn=self.process_packet,
-                stop_filter=self.should_stop_sniffer,
-                timeout=1.0,
-                monitor=False
-            )
-            if self.stop.isSet():
-                break
+        while not self.stop.isSet():
+            # Wait for a frame, waking up every idle_timeout to check whether to stop
+            ready = self.socket.select([self.socket], self.idle_timeout)
+            if isinstance(ready, tuple):
+                # Scapy < 2.4.3 returns (ready sockets, receive function)
+                ready = ready[0]
+            if not ready:
+                continue
+            pkt = self.socket.recv()
+            if pkt is not None:
+                self.process_packet(pkt)
+        self.socket.close()
 
     def join(self, timeout=None):
         self.stop.set()
@@ -53,10 +65,8 @@ class Sniffer(threading.Thread):
         super().join(timeout)
         self.messages.put(("INFO", f"{self.name}: stopped..."))
 
-    def should_stop_sniffer(self, _):
-        return self.stop.isSet()
-
     def process_packet(self, pkt):
+        self.frames.inc()
         self.messages.put(("DEBUG", f"{self.name}: Received a frame... {pkt.summary()} on '{self.ifname}'"))
         if Ether in pkt:
             self.messages.put(("DEBUG", f"{self.name}: Frame is Ethernet..."))
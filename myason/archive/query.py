@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import calendar
+import csv
+import os
+import sys
+import time
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+from myason.collector import archiver
+
+# Dataset formats of the archive formats
+DATASET_FORMATS = {
+    "parquet": "parquet",
+    "arrow": "ipc",
+}
+
+
+def parse_time(value):
+    """Parses a UTC time, as seconds since the epoch or YYYY-MM-DD[THH:MM[:SS]]"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return float(calendar.timegm(time.strptime(value, time_format)))
+        except ValueError:
+            continue
+    raise ValueError(f"{value} is not a time")
+
+
+def archive_files(archive_dir, start=None, end=None, agent=None, file_format="parquet"):
+    """Lists the files of the archive which may hold flows of agent ending within [start, end)
+
+    The day and agent directories out of the predicates are skipped without being listed.
+    """
+    extension = f".{archiver.EXTENSIONS[file_format]}"
+    files = []
+    if not os.path.isdir(archive_dir):
+        return files
+    for day in sorted(os.listdir(archive_dir)):
+        try:
+            day_start = calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+        except ValueError:
+            continue
+        if (start is not None and day_start + archiver.SECONDS_PER_DAY <= start) or \
+                (end is not None and day_start >= end):
+            continue
+        day_dir = os.path.join(archive_dir, day)
+        agents = [archiver.partition_name(agent)] if agent is not None else sorted(os.listdir(day_dir))
+        for agent_name in agents:
+            agent_dir = os.path.join(day_dir, agent_name)
+            if not os.path.isdir(agent_dir):
+                continue
+            files.extend(
+                os.path.join(agent_dir, name)
+                for name in sorted(os.listdir(agent_dir))
+                # Files being written are hidden
+                if name.endswith(extension) and not name.startswith(".")
+            )
+    return files
+
+
+def query(archive_dir, start=None, end=None, agent=None, ip=None, src_ip=None, dst_ip=None, columns=None,
+          file_format="parquet"):
+    """Reads the archived flows matching the predicates as an arrow table
+
+    The directories out of the time range and agent are pruned, then the predicates are pushed down
+    to the files: the Parquet row groups whose statistics don't match them are skipped unread. The
+    archives of the nodes of a collector cluster are queried together, their flows merged by end time.
+
+    Args:
+        archive_dir: The directory of the archive, or the list of the directories of the nodes archives
+        start: The time (in seconds since the epoch) from which the flows end, None for no limit
+        end: The time (in seconds since the epoch) before which the flows end, None for no limit
+        agent: The address of the agent which exported the flows
+        ip: An address, the source or destination of the flows
+        src_ip: The source address of the flows
+        dst_ip: The destination address of the flows
+        columns: The list of the columns to read, None for all of them
+        file_format: "parquet" or "arrow", as archived by the collector
+
+    Raises:
+        ValueError: pyarrow is not installed
+    """
+    if pyarrow is None:
+        raise ValueError("The pyarrow package is needed to query the archive")
+    archiver.load_pyarrow()
+    archive_dirs = [archive_dir] if isinstance(archive_dir, str) else archive_dir
+    files = [
+        fn
+        for directory in archive_dirs
+        for fn in archive_files(directory, start, end, agent, file_format)
+    ]
+    dataset = pyarrow.dataset.dataset(files, schema=archiver.schema(), format=DATASET_FORMATS[file_format])
+    field = pyarrow.dataset.field
+    predicates = []
+    if start is not None:
+        predicates.append(field("end_time") >= start)
+    if end is not None:
+        predicates.append(field("end_time") < end)
+    if agent is not None:
+        predicates.append(field("agent") == agent)
+    if ip is not None:
+        predicates.append((field("src_ip") == ip) | (field("dst_ip") == ip))
+    if src_ip is not None:
+        predicates.append(field("src_ip") == src_ip)
+    if dst_ip is not None:
+        predicates.append(field("dst_ip") == dst_ip)
+    expression = None
+    for predicate in predicates:
+        expression = predicate if expression is None else expression & predicate
+    if len(archive_dirs) == 1:
+        return dataset.to_table(columns=columns, filter=expression)
+    table = dataset.to_table(filter=expression).sort_by("end_time")
+    return table.select(columns) if columns is not None else table
+
+
+def print_flows(archive_dir, start=None, end=None, agent=None, ip=None, src_ip=None, dst_ip=None, columns=None,
+                file_format="parquet", limit=None):
+    if pyarrow is None:
+        print("The pyarrow package is needed to query the archive")
+        return
+    try:
+        table = query(archive_dir, parse_time(start), parse_time(end), agent, ip, src_ip, dst_ip, columns,
+                      file_format)
+    except (ValueError, OSError, pyarrow.ArrowException) as e:
+        print(f"Archive {archive_dir} can't be queried: {e}")
+        return
+    if limit is not None:
+        table = table.slice(0, limit)
+    output = csv.writer(sys.stdout)
+    output.writerow(table.column_names)
+    for batch in table.to_batches():
+        output.writerows(zip(*(column.to_pylist() for column in batch.columns)))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+
+import ipaddress
+import socket
+import time
+
+from cryptography.fernet import Fernet
+
+
+class AgentTable:
+    """The agents white list, mapping the agents addresses to their Fernet ciphers
+
+    Built once from the {address or network: Fernet key} configuration and never updated: a reload
+    builds a new table. Addresses are looked up in a hash table. Networks (CIDR) are kept in a hash
+    table per prefix length, looked up from the longest prefix to the shortest, so that the most
+    specific network gives the key.
+    """
+
+    def __init__(self, agents=None):
+        """Initialization
+
+        Args:
+            agents: The {address or network: Fernet key} white list
+
+        Raises:
+            ValueError: An address, a network or a key is not valid
+        """
+        self.exact = {}
+        prefixes = {4: {}, 6: {}}
+        for agent, key in (agents or {}).items():
+            if not isinstance(key, str):
+                raise ValueError(f"Agent {agent} key must be a string")
+            fernet = Fernet(key.encode())
+            network = ipaddress.ip_network(agent, strict=False)
+            if network.prefixlen == network.max_prefixlen:
+                self.exact[str(network.network_address)] = fernet
+            else:
+                shift = network.max_prefixlen - network.prefixlen
+                networks = prefixes[network.version].setdefault(network.prefixlen, {})
+                networks[int(network.network_address) >> shift] = fernet
+        # [(prefix length, shift, {network number: fernet}), ...] by IP version, longest prefixes first
+        self.prefixes = {
+            version: [
+                (length, (32 if version == 4 else 128) - length, networks[length])
+                for length in sorted(networks, reverse=True)
+            ]
+            for version, networks in prefixes.items()
+        }
+        self.networks = sum(len(networks) for by_length in prefixes.values() for networks in by_length.values())
+
+    def __len__(self):
+        return len(self.exact) + self.networks
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def get(self, address):
+        """Returns the Fernet cipher of an agent address, None if it's out of the white list"""
+        fernet = self.exact.get(address)
+        if fernet is not None or not self.networks:
+            return fernet
+        # inet_pton is much cheaper than ipaddress on this path, which spoofed floods go through
+        version, family = (6, socket.AF_INET6) if ":" in address else (4, socket.AF_INET)
+        try:
+            number = int.from_bytes(socket.inet_pton(family, address), "big")
+        except (OSError, ValueError):
+            return None
+        for _, shift, networks in self.prefixes[version]:
+            fernet = networks.get(number >> shift)
+            if fernet is not None:
+                return fernet
+        return None
+
+
+class Rejections:
+    """Counts the data received from sources out of the white list
+
+    Every rejection is counted, but a warning is logged at most every interval seconds, so that a
+    flood from outside the white list doesn't turn into a flood of log messages.
+    """
+
+    def __init__(self, name, messages, counter, what="datagrams", interval=10.):
+        """Initialization
+
+        Args:
+            name: The name of the worker rejecting the data
+            messages: The thread safe FIFO queue to feed with logging messages
+            counter: The rejections counter
+            what: What is rejected (datagrams, connections...), for the log messages
+            interval: The minimum delay between two warnings (in seconds)
+        """
+        self.name = name
+        self.messages = messages
+        self.counter = counter
+        self.what = what
+        self.interval = interval
+        self.pending = 0
+        self.log_at = 0.
+
+    def reject(self, ip):
+        self.counter.inc()
+        self.pending += 1
+        now = time.monotonic()
+        if now >= self.log_at:
+            self.messages.put((
+                "WARNING",
+                f"{self.name}: {self.pending} {self.what} from out of the white list ignored, the last from {ip}...",
+            ))
+            self.pending = 0
+            self.log_at = now + self.interval
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import concurrent.futures
+import queue
+import signal
+
+from myason.collector.agents import Rejections
+from myason.collector.alerter import create_alerter
+from myason.collector.archiver import create_archiver
+from myason.collector.feed import create_feed
+from myason.collector.conf import reconfigure
+from myason.collector.enricher import Enricher
+from myason.collector.enricher import configure_enrichers
+from myason.collector.enricher import enrichment_enabled
+from myason.collector.processor import Processor
+from myason.collector.writer import Writer
+from myason.collector.writer import wal_options
+from myason.helpers import compression
+from myason.helpers import framing
+from myason.helpers import metrics
+from myason.helpers.worker import Tee
+
+
+class DatagramListener(asyncio.DatagramProtocol):
+    """The datagram listener of the asyncio runtime
+
+    Filters the datagrams against the agents white list and queues them as records.
+    """
+    worker_group = "listener"
+    worker_number = 0
+
+    def __init__(self, records, messages):
+        """Initialization
+
+        Args:
+            records: The asyncio queue to feed with received records
+            messages: The thread safe FIFO queue to feed with logging messages
+        """
+        super().__init__()
+        DatagramListener.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.records = records
+        self.messages = messages
+        self.datagrams = metrics.registry.counter(
+            "myason_collector_datagrams_total", "Datagrams received", worker=self.name)
+        self.rejected = Rejections(self.name, messages, metrics.registry.counter(
+            "myason_collector_rejected_datagrams_total", "Datagrams from agents out of the white list",
+            worker=self.name))
+        self.dropped = metrics.registry.counter(
+            "myason_collector_dropped_datagrams_total", "Datagrams dropped as the records queue was full",
+            worker=self.name)
+
+    def connection_made(self, transport):
+        self.messages.put(("INFO", f"{self.name}: up and running..."))
+
+    def datagram_received(self, data, ip):
+        self.datagrams.inc()
+        if ip[0] not in Processor.agents:
+            self.rejected.reject(ip)
+            return
+        try:
+            self.records.put_nowait((data, ip))
+        except asyncio.QueueFull:
+            self.dropped.inc()
+
+    def error_received(self, exc):
+        self.messages.put(("WARNING", f"{self.name}: {exc}..."))
+
+
+class StreamListener(asyncio.Protocol):
+    """A connection of the TCP transport, in the asyncio runtime
+
+    Reassembles the frames into records and acknowledges the last frame queued. While the records
+    queue is full, the connection stops being read, pushing back on the agent.
+    """
+    worker_group = "stream_listener"
+    worker_number = 0
+    # Shared by the connections, so that the warnings are rate limited across them
+    rejections = None
+
+    def __init__(self, records, messages, connections=None):
+        """Initialization
+
+        Args:
+            records: The asyncio queue to feed with received records
+            messages: The thread safe FIFO queue to feed with logging messages
+            connections: The set of the open connections transports, closed when stopping
+        """
+        super().__init__()
+        StreamListener.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.records = records
+        self.messages = messages
+        self.connections = connections
+        self.transport = None
+        self.ip = None
+        self.frames = framing.FrameBuffer()
+        self.pending = None
+        self.frames_received = metrics.registry.counter(
+            "myason_collector_frames_total", "Frames received", worker=self.worker_group)
+        if StreamListener.rejections is None:
+            StreamListener.rejections = Rejections(self.worker_group, messages, metrics.registry.counter(
+                "myason_collector_rejected_connections_total", "Connections from agents out of the white list",
+                worker=self.worker_group), what="connections")
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.ip = transport.get_extra_info("peername")
+        if self.ip[0] not in Processor.agents:
+            StreamListener.rejections.reject(self.ip)
+            transport.close()
+            return
+        if self.connections is not None:
+            self.connections.add(transport)
+        self.messages.put(("INFO", f"{self.name}: connection from {self.ip} accepted..."))
+
+    def connection_lost(self, exc):
+        if self.connections is not None:
+            self.connections.discard(self.transport)
+        if self.pending is not None:
+            self.pending.cancel()
+
+    def data_received(self, data):
+        self.frames.feed(data)
+        self.queue_frames()
+
+    def queue_frames(self):
+        last = None
+        try:
+            frame = self.frames.next_frame()
+        except ValueError as e:
+            self.messages.put(("WARNING", f"{self.name}: connection from {self.ip} closed ({e})..."))
+            self.transport.close()
+            return
+        while frame is not None:
+            number, record = frame
+            try:
+                self.records.put_nowait((record, self.ip))
+            except asyncio.QueueFull:
+                # Stop reading until the record is queued
+                self.transport.pause_reading()
+                self.pending = asyncio.ensure_future(self.queue_frame(number, record))
+                break
+            self.frames_received.inc()
+            last = number
+            frame = self.frames.next_frame()
+        if last is not None:
+            self.transport.write(framing.ACK.pack(last))
+
+    async def queue_frame(self, number, record):
+        await self.records.put((record, self.ip))
+        self.frames_received.inc()
+        self.transport.write(framing.ACK.pack(number))
+        self.pending = None
+        self.transport.resume_reading()
+        self.queue_frames()
+
+
+async def get_batch(fifo, batch_size):
+    """Waits for an item of fifo, then takes the items readily available, up to batch_size"""
+    batch = [await fifo.get()]
+    while len(batch) < batch_size:
+        try:
+            batch.append(fifo.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+async def decode(processor, records, entries, executor, batch_size, enricher=None, copies=None):
+    loop = asyncio.get_running_loop()
+
+    def decode_and_enrich(batch):
+        # Enrich the flows in the same pool thread as they're decoded
+        return enricher.enrich_entries(processor.decode_records(batch))
+
+    if enricher is not None:
+        work = decode_and_enrich
+    else:
+        work = processor.decode_records
+    while True:
+        batch = await get_batch(records, batch_size)
+        try:
+            for entry in await loop.run_in_executor(executor, work, batch):
+                await entries.put(entry)
+                if copies is not None:
+                    copies.put(entry)
+        except Exception as e:
+            # A failed batch is lost, the task goes on with the next one
+            processor.messages.put(("ERROR", f"{processor.name}: {len(batch)} records lost decoding them: {e!r}..."))
+        finally:
+            for _ in batch:
+                records.task_done()
+
+
+async def write(writer, entries, executor, batch_size):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            batch = await asyncio.wait_for(get_batch(entries, batch_size), writer.idle_timeout)
+        except asyncio.TimeoutError:
+            # Let the writer replay its write-ahead log while no entry comes
+            try:
+                await loop.run_in_executor(executor, writer.idle)
+            except Exception as e:
+                writer.messages.put(("ERROR", f"{writer.name}: write-ahead log replay failed: {e!r}..."))
+            continue
+        try:
+            await loop.run_in_executor(executor, writer.process_entries, batch)
+        except Exception as e:
+            # A failed batch is lost, the task goes on with the next one
+            writer.messages.put(("ERROR", f"{writer.name}: {len(batch)} entries lost writing them: {e!r}..."))
+        finally:
+            for _ in batch:
+                entries.task_done()
+
+
+async def serve(collector_conf, messages, reloader=None, bus=None):
+    """Runs the collector on asyncio until SIGINT or SIGTERM
+
+    Decoding and writing are offloaded by batches to thread pools: each pool thread works with its
+    own processor or writer, and every writer keeps its InfluxDB client (and its HTTP connections).
+    On shutdown, the listener is closed first, then the records and entries queues are drained.
+    The reloaded configurations are applied to the processors and writers when a reloader is given.
+    With a prefix table or a resolver, the flows are enriched by the pool threads decoding them.
+    With an archive directory, alerting rules or a live feed (on the bus, when given), the decoded
+    flows are also queued to the archiver, the alerter or the feed thread.
+    """
+    loop = asyncio.get_running_loop()
+    batch_size = collector_conf.get("batch_size", 64)
+    records = asyncio.Queue(maxsize=collector_conf.get("records_queue_size", 10000))
+    entries = asyncio.Queue(maxsize=collector_conf.get("entries_queue_size", 10000))
+    metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=records.qsize,
+                           queue="records")
+    metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue", function=entries.qsize,
+                           queue="entries")
+    dictionaries = compression.load_dictionaries(collector_conf.get("dictionaries"))
+    processors = [
+        Processor(
+            agents=collector_conf.get("agents"),
+            records=None,
+            entries=None,
+            messages=messages,
+            token_ttl=collector_conf.get("token_ttl", 5),
+            dictionaries=dictionaries,
+        )
+        for _ in range(collector_conf.get("processors_number", 1))
+    ]
+    writers = [
+        Writer(
+            entries=None,
+            messages=messages,
+            dbname=collector_conf.get("db_name"),
+            influx_params=collector_conf.get("influx_params"),
+            cache_size=collector_conf.get("writer_cache_size", 65536),
+            node=collector_conf.get("node_name"),
+            **wal_options(collector_conf, n)
+        )
+        for n in range(collector_conf.get("writers_number", 1))
+    ]
+    enrichers = [None] * len(processors)
+    if enrichment_enabled(collector_conf):
+        configure_enrichers(collector_conf)
+        enrichers = [Enricher(None, None, messages) for _ in processors]
+    archive_queue = queue.Queue()
+    archive = create_archiver(collector_conf, archive_queue, messages)
+    archivers = []
+    if archive is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue",
+                               function=archive_queue.qsize, queue="archive")
+        archivers.append(archive)
+        archive.start()
+    alert_queue = queue.Queue()
+    alerter = create_alerter(collector_conf, alert_queue, messages, bus)
+    alerters = []
+    if alerter is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue",
+                               function=alert_queue.qsize, queue="alerts")
+        alerters.append(alerter)
+        alerter.start()
+    feed_queue = queue.Queue()
+    feed = create_feed(collector_conf, feed_queue, messages, bus)
+    feeds = []
+    if feed is not None:
+        metrics.registry.gauge("myason_collector_queue_depth", "Items waiting in a queue",
+                               function=feed_queue.qsize, queue="feed")
+        feeds.append(feed)
+        feed.start()
+    copies = [
+        fifo
+        for fifo, workers in ((archive_queue, archivers), (alert_queue, alerters), (feed_queue, feeds))
+        if workers
+    ]
+    if reloader is not None:
+        running_enrichers = [enricher for enricher in enrichers if enricher is not None]
+        reloader.subscribe(lambda conf: reconfigure(conf, processors, writers, running_enrichers, archivers, alerters))
+    decode_executor = concurrent.futures.ThreadPoolExecutor(len(processors), thread_name_prefix="processor")
+    write_executor = concurrent.futures.ThreadPoolExecutor(len(writers), thread_name_prefix="writer")
+    tasks = [
+        loop.create_task(decode(processor, records, entries, decode_executor, batch_size, enricher,
+                                Tee(*copies) if copies else None))
+        for processor, enricher in zip(processors, enrichers)
+    ] + [
+        loop.create_task(write(writer, entries, write_executor, batch_size))
+        for writer in writers
+    ]
+    address = collector_conf.get("bind_address", "127.0.0.1")
+    port = collector_conf.get("bind_port", 9999)
+    transports = collector_conf.get("transports", ["udp"])
+    transport = None
+    if "udp" in transports:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramListener(records, messages),
+            local_addr=(address, port),
+        )
+    server = None
+    # The transports of the agents connections
+    connections = set()
+    if "tcp" in transports:
+        server = await loop.create_server(lambda: StreamListener(records, messages, connections), address, port)
+    # Wait for a stop signal
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops don't support signal handlers
+            signal.signal(signum, lambda *_: loop.call_soon_threadsafe(stop.set))
+    await stop.wait()
+    messages.put(("DEBUG", "Stop signal received. Stopping collector..."))
+    # Stop receiving, then drain the queues stage by stage
+    if transport is not None:
+        transport.close()
+    if server is not None:
+        server.close()
+        # The server is only closed once its connections are (Python 3.12+), an agent may stay connected
+        for connection in list(connections):
+            connection.close()
+        await server.wait_closed()
+    await records.join()
+    await entries.join()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    decode_executor.shutdown()
+    write_executor.shutdown()
+    for writer in writers:
+        writer.finish()
+    Enricher.set_resolver(None)
+    for archive in archivers:
+        archive.join()
+    for alerter in alerters:
+        alerter.join()
+    for feed in feeds:
+        feed.join()
+    messages.put(("DEBUG", "Collector stopped..."))
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import heapq
+import ipaddress
+import json
+import queue
+import time
+import urllib.request
+
+from myason.collector.prefixes import PrefixIndex
+from myason.collector.rollup import Rollup
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
+
+# The dimensions the flows are rolled up by, and the metrics of the rollups (per second)
+DIMENSIONS = ("agent", "interface", "port", "prefix")
+METRICS = ("bytes", "packets", "flows")
+KINDS = ("threshold", "change", "ewma")
+# The topic of the alerts on the bus, and the alerts retained for the new subscribers
+TOPIC = "alerts"
+RETAINED = 100
+
+
+class SeriesState:
+    """The last seconds of a series watched by a rule, and whether the rule fires on it"""
+    __slots__ = ("history", "recent", "previous", "baseline", "quiet", "firing")
+
+    def __init__(self, window):
+        # The values of the last 2 windows, the sums of the last window and of the one before
+        self.history = collections.deque(maxlen=2 * window)
+        self.recent = 0
+        self.previous = 0
+        self.baseline = None
+        # The seconds since the series had flows
+        self.quiet = 0
+        self.firing = False
+
+
+class Rule:
+    """An alerting rule, evaluated once per second on the rollup of a dimension
+
+    The level of a series is the average of the metric over the last window seconds. The rule fires
+    while the level is at or above minimum and:
+
+    - threshold: the level is above threshold
+    - change: the level is at least change times the average over the window before
+    - ewma: the level is at least factor times its baseline, an exponentially weighted moving
+      average of the past levels (alpha being the weight of the last one)
+
+    A rule with a match watches a single value of its dimension: an agent address, an
+    "agent/interface", a port or a CIDR prefix. Without one, it watches every agent, interface or
+    port seen, each on its own, up to max_series series: the values it starts to follow on a second
+    are the candidates of the second (the largest ones), as long as it has room for them.
+    """
+
+    def __init__(self, name, kind, dimension, metric="bytes", match=None, window=10, threshold=None,
+                 change=2., factor=3., alpha=0.1, minimum=0.):
+        """Initialization
+
+        Raises:
+            ValueError: An argument is not valid
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Rule {name}: kind must be among {', '.join(KINDS)}")
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Rule {name}: dimension must be among {', '.join(DIMENSIONS)}")
+        if metric not in METRICS:
+            raise ValueError(f"Rule {name}: metric must be among {', '.join(METRICS)}")
+        if kind == "threshold" and threshold is None:
+            raise ValueError(f"Rule {name}: a threshold rule needs a threshold")
+        if dimension == "prefix":
+            if match is None:
+                raise ValueError(f"Rule {name}: a prefix rule needs a match")
+            ipaddress.ip_network(match, strict=False)
+        if int(window) < 1 or not 0 < float(alpha) <= 1:
+            raise ValueError(f"Rule {name}: window must be at least 1 and alpha within ]0, 1]")
+        self.name = str(name)
+        self.kind = kind
+        self.dimension = dimension
+        self.metric = metric
+        self.column = METRICS.index(metric)
+        # Ports are read from the flow ids, as strings
+        self.match = None if match is None else str(match)
+        self.window = int(window)
+        self.threshold = None if threshold is None else float(threshold)
+        self.change = float(change)
+        self.factor = float(factor)
+        self.alpha = float(alpha)
+        self.minimum = float(minimum)
+        # {value: SeriesState}
+        self.states = {}
+
+    def evaluate(self, rollup, now, candidates=(), max_series=None):
+        """Adds a second to the series of the rule
+
+        Args:
+            rollup: The second of the dimension of the rule, {value: [bytes, packets, flows]}
+            now: The second
+            candidates: The values of rollup a rule without a match may start to follow
+            max_series: The series a rule without a match follows at most
+
+        Returns:
+            The alerts of the series firing or resolved by this second
+        """
+        alerts = []
+        if self.match is not None:
+            counters = rollup.get(self.match)
+            self.update(self.match, counters[self.column] if counters else 0, now, alerts)
+            return alerts
+        for value in list(self.states):
+            counters = rollup.get(value)
+            self.update(value, counters[self.column] if counters else 0, now, alerts)
+        for value in candidates:
+            if max_series is not None and len(self.states) >= max_series:
+                break
+            if value not in self.states:
+                self.update(value, rollup[value][self.column], now, alerts)
+        return alerts
+
+    def update(self, value, amount, now, alerts):
+        state = self.states.get(value)
+        if state is None:
+            state = self.states[value] = SeriesState(self.window)
+        history = state.history
+        if len(history) == history.maxlen:
+            state.previous -= history[0]
+        if len(history) >= self.window:
+            moved = history[-self.window]
+            state.recent -= moved
+            state.previous += moved
+        history.append(amount)
+        state.recent += amount
+        state.quiet = state.quiet + 1 if amount == 0 else 0
+        level = state.recent / self.window
+        limit = self.limit(state)
+        firing = (
+            limit is not None and 0 < level and self.minimum <= level
+            and (level > limit if self.kind == "threshold" else level >= limit)
+        )
+        if self.kind == "ewma":
+            state.baseline = level if state.baseline is None else self.alpha * level + (1 - self.alpha) * state.baseline
+        if firing != state.firing:
+            state.firing = firing
+            alerts.append({
+                "time": now,
+                "rule": self.name,
+                "state": "firing" if firing else "resolved",
+                "kind": self.kind,
+                "dimension": self.dimension,
+                "value": value,
+                "metric": self.metric,
+                "level": level,
+                "limit": limit,
+            })
+        # The series of a rule watching every value are forgotten once quiet for 2 windows
+        if self.match is None and not state.firing and state.quiet >= 2 * self.window:
+            del self.states[value]
+
+    def limit(self, state):
+        """The level the rule fires from, None while the series is too short to tell"""
+        if self.kind == "threshold":
+            return self.threshold
+        if self.kind == "change":
+            if len(state.history) < state.history.maxlen:
+                return None
+            return self.change * state.previous / self.window
+        if state.baseline is None or len(state.history) < self.window:
+            return None
+        return self.factor * state.baseline
+
+
+class RuleSet:
+    """The rules of the alerter, and what they need rolled up
+
+    Built once and never updated: reloading the rules builds a new rule set, their series starting
+    over.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.dimensions = tuple(
+            dimension for dimension in DIMENSIONS if any(rule.dimension == dimension for rule in self.rules))
+        # The values rolled up by dimension, None for every value (a rule without a match)
+        self.watched = {}
+        for dimension in self.dimensions:
+            matches = [rule.match for rule in self.rules if rule.dimension == dimension]
+            self.watched[dimension] = None if None in matches else frozenset(matches)
+        self.index = None
+        if "prefix" in self.dimensions:
+            # The value of a prefix is every watched prefix holding it, so that nested ones all count a flow
+            networks = {match: ipaddress.ip_network(match, strict=False) for match in self.watched["prefix"]}
+            self.index = PrefixIndex([
+                (network, tuple(
+                    match for match, other in networks.items()
+                    if other.version == network.version and network.subnet_of(other)
+                ))
+                for network in networks.values()
+            ])
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class LogSink:
+    """Logs the alerts through the messenger"""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def send(self, alert):
+        limit = "" if alert["limit"] is None else f" (limit {alert['limit']:.1f}/s)"
+        self.messages.put((
+            "WARNING" if alert["state"] == "firing" else "INFO",
+            f"Alert {alert['rule']} {alert['state']}: {alert['dimension']} {alert['value']}, "
+            f"{alert['metric']} {alert['level']:.1f}/s{limit}",
+        ))
+
+
+class FileSink:
+    """Appends the alerts to a file, a JSON object per line"""
+
+    def __init__(self, messages, path):
+        self.messages = messages
+        self.path = path
+
+    def send(self, alert):
+        with open(self.path, "a") as alerts_file:
+            alerts_file.write(json.dumps(alert) + "\n")
+
+
+class WebhookSink:
+    """Posts each alert as JSON to a URL"""
+
+    def __init__(self, messages, url, timeout=2.):
+        self.messages = messages
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alert):
+        request = urllib.request.Request(
+            self.url, data=json.dumps(alert).encode(), headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+# The sink classes by type: a sink is created with the messages queue and its options, and sends an alert
+SINKS = {
+    "log": LogSink,
+    "file": FileSink,
+    "webhook": WebhookSink,
+}
+
+
+class AlertSender(Worker):
+    """Sends the alerts to the sinks, apart from the alerter
+
+    A sink may block, a webhook waiting for its response up to its timeout: the alerter queues the
+    alerts to a bounded queue consumed by this thread instead of sending them, so that a slow sink
+    never holds the rules back. The alerts which don't fit in the queue are dropped.
+    """
+    worker_group = "alert_sender"
+    worker_number = 0
+
+    def __init__(self, alerts, messages, sinks):
+        """Initialization
+
+        Args:
+            alerts: The bounded thread safe FIFO queue to consume with alerts
+            messages: The thread safe FIFO queue to feed with logging messages
+            sinks: The sinks the alerts are sent to
+        """
+        super().__init__(alerts, messages)
+        self.sinks = sinks
+        self.failures = metrics.registry.counter(
+            "myason_collector_alert_sink_failures_total", "Alerts which couldn't be sent to a sink", worker=self.name)
+
+    def process(self, alert):
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            except (OSError, ValueError) as e:
+                self.failures.inc()
+                self.log("ERROR", f"alert {alert['rule']} not sent to {sink}: {e}...")
+
+
+def create_rules(rules_conf):
+    """Builds the rules of a configuration, a list of the Rule arguments
+
+    Raises:
+        ValueError: A rule is not valid
+    """
+    rules = []
+    for rule_conf in rules_conf or ():
+        try:
+            rules.append(Rule(**rule_conf))
+        except TypeError as e:
+            raise ValueError(f"Rule {rule_conf.get('name')}: {e}")
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("The rule names must be unique")
+    return rules
+
+
+def create_sinks(sinks_conf, messages):
+    """Builds the sinks of a configuration, a list of sink options with their type
+
+    Raises:
+        ValueError: A sink is not valid
+    """
+    sinks = []
+    for sink_conf in sinks_conf or ():
+        options = dict(sink_conf)
+        sink_class = SINKS.get(options.pop("type", None))
+        if sink_class is None:
+            raise ValueError(f"Sink type must be among {', '.join(SINKS)}")
+        try:
+            sinks.append(sink_class(messages, **options))
+        except TypeError as e:
+            raise ValueError(f"Sink {sink_conf.get('type')}: {e}")
+    return sinks
+
+
+class Alerter(Worker):
+    """The alerter
+
+    Rolls the decoded flows up by second, by the dimensions its rules watch, then evaluates the
+    rules on each second once it's over, lateness seconds after its end, for the flows exported
+    after their last packet to count in it. A flow costs a counter update by dimension and second
+    it lasts, whatever the number of rules, and a second costs an update by rule and series,
+    whatever the number of flows: the rules watching every value of a dimension follow max_series
+    series at most, starting with the largest values of a second.
+    The bytes, packets and flows (biflows in both directions) are spread over the seconds of the
+    flows, a long flow being counted once, by its final record. The alerts, a rule starting or
+    stopping to fire on a series, are published on the bus when there's one, and queued to the
+    sender thread of the sinks.
+    """
+    worker_group = "alerter"
+    worker_number = 0
+
+    def __init__(self, entries, messages, rules, sinks, max_series=1000, bus=None, lateness=20, sink_queue_size=1000):
+        """Initialization
+
+        Args:
+            entries: The thread safe FIFO queue to consume with decoded flows
+            messages: The thread safe FIFO queue to feed with logging messages
+            rules: The Rule objects
+            sinks: The sinks the alerts are sent to
+            max_series: The series a rule without a match follows at most
+            bus: The bus the alerts are published on
+            lateness: The seconds a second is evaluated after its end
+            sink_queue_size: The alerts waiting for the sinks at most
+        """
+        super().__init__(entries, messages)
+        self.entries = entries
+        self.ruleset = RuleSet(rules)
+        self.max_series = max_series
+        self.bus = bus
+        if bus is not None:
+            bus.retain(TOPIC, RETAINED)
+        # The open seconds, {(dimension, value): [bytes, packets, flows]} each
+        self.rollup = Rollup(lateness)
+        self.sender = AlertSender(queue.Queue(maxsize=sink_queue_size), messages, sinks)
+        self.alerts = {
+            state: metrics.registry.counter(
+                "myason_collector_alerts_total", "Alerts sent", worker=self.name, state=state)
+            for state in ("firing", "resolved")
+        }
+        self.dropped_alerts = metrics.registry.counter(
+            "myason_collector_alerts_dropped_total", "Alerts not sent, the sinks lagging behind", worker=self.name)
+        self.late_records = metrics.registry.counter(
+            "myason_collector_alert_late_records_total", "Flow records partly dropped, their seconds being over",
+            worker=self.name)
+        self.evaluation_seconds = metrics.registry.histogram(
+            "myason_collector_alert_evaluation_seconds", "Time spent evaluating the rules on a second",
+            worker=self.name)
+        metrics.registry.gauge(
+            "myason_collector_alert_rules", "Alerting rules", function=lambda: len(self.ruleset), worker=self.name)
+        metrics.registry.gauge(
+            "myason_collector_alert_firing", "Series the rules fire on",
+            function=lambda: sum(state.firing for rule in self.ruleset.rules for state in list(rule.states.values())),
+            worker=self.name)
+
+    def configure(self, rules, sinks):
+        """Replaces the rules and the sinks, when reloading"""
+        self.ruleset = RuleSet(rules)
+        self.sender.sinks = sinks
+
+    def start(self):
+        self.sender.start()
+        super().start()
+
+    def process(self, entry):
+        self.tick()
+        self.rollup_entry(entry)
+
+    def idle(self):
+        self.tick()
+
+    def finish(self):
+        # The alerts already queued are sent
+        self.sender.join()
+
+    def rollup_entry(self, entry):
+        ip, flow = entry
+        agent = ip[0]
+        ruleset = self.ruleset
+        for flow_id, values in flow.items():
+            try:
+                flow_id_parts = flow_id.split(",")
+                length = int(values["bytes"]) + int(values.get("rev_bytes") or 0)
+                packets = int(values["packets"]) + int(values.get("rev_packets") or 0)
+                # A long flow is counted by its final record
+                flow_count = 0 if values.get("interim") else 1
+                start_time = float(values["start_time"])
+                end_time = float(values["end_time"])
+                targets = []
+                for dimension in ruleset.dimensions:
+                    if dimension == "agent":
+                        keys = (agent,)
+                    elif dimension == "interface":
+                        keys = (f"{agent}/{flow_id_parts[0]}",)
+                    elif dimension == "port":
+                        keys = {flow_id_parts[4], flow_id_parts[5]}
+                    else:
+                        keys = set(ruleset.index.lookup(flow_id_parts[1]) or ())
+                        keys.update(ruleset.index.lookup(flow_id_parts[2]) or ())
+                    watched = ruleset.watched[dimension]
+                    targets.extend((dimension, key) for key in keys if watched is None or key in watched)
+                if targets and self.rollup.add(targets, start_time, end_time, length, packets, flow_count):
+                    self.late_records.inc()
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                self.messages.put(("WARNING", f"{self.name}: Malformed flow record: {e}..."))
+
+    def tick(self):
+        """Evaluates the rules on the seconds over"""
+        # After a pause, the seconds without flows as many as the longest series needs
+        longest = max((2 * rule.window for rule in self.ruleset.rules), default=1)
+        for second, bucket in self.rollup.close(limit=longest):
+            self.evaluate(second, bucket)
+
+    def evaluate(self, second, bucket):
+        """Evaluates the rules on a second
+
+        Args:
+            second: The second
+            bucket: The rollup of the second, {(dimension, value): [bytes, packets, flows]}
+        """
+        start = time.perf_counter()
+        rollups = {dimension: {} for dimension in DIMENSIONS}
+        for (dimension, value), counters in bucket.items():
+            rollups[dimension][value] = counters
+        alerts = []
+        # The largest values of a dimension by metric, for the rules without a match
+        candidates = {}
+        for rule in self.ruleset.rules:
+            rollup = rollups[rule.dimension]
+            if rule.match is None:
+                key = (rule.dimension, rule.column)
+                if key not in candidates:
+                    candidates[key] = rollup if len(rollup) <= self.max_series else heapq.nlargest(
+                        self.max_series, rollup, key=lambda value: rollup[value][key[1]])
+                alerts.extend(rule.evaluate(rollup, second, candidates[key], self.max_series))
+            else:
+                alerts.extend(rule.evaluate(rollup, second))
+        self.evaluation_seconds.observe(time.perf_counter() - start)
+        for alert in alerts:
+            self.alerts[alert["state"]].inc()
+            if self.bus is not None:
+                self.bus.publish(TOPIC, alert)
+            if not self.sender.sinks:
+                continue
+            try:
+                self.sender.inbox.put_nowait(alert)
+            except queue.Full:
+                self.dropped_alerts.inc()
+                self.log("WARNING", f"alert {alert['rule']} dropped, the sinks lagging behind...")
+
+
+def create_alerter(collector_conf, entries, messages, bus=None):
+    """Returns the alerter of the configuration, None without alerting rules"""
+    if not collector_conf.get("alert_rules"):
+        return None
+    return Alerter(
+        entries=entries,
+        messages=messages,
+        rules=create_rules(collector_conf.get("alert_rules")),
+        sinks=create_sinks(collector_conf.get("alert_sinks", [{"type": "log"}]), messages),
+        max_series=collector_conf.get("alert_max_series", 1000),
+        bus=bus,
+        lateness=collector_conf.get("alert_lateness", 20),
+    )
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import re
+import time
+import uuid
+
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
+
+# Flow columns, as (name, arrow type name), the strings being dictionary encoded
+COLUMNS = (
+    ("agent", "string"),
+    ("ifname", "string"),
+    ("src_ip", "string"),
+    ("dst_ip", "string"),
+    ("proto", "uint8"),
+    ("src_port", "uint16"),
+    ("dst_port", "uint16"),
+    ("tos", "uint8"),
+    ("ethertype", "uint16"),
+    ("bytes", "uint64"),
+    ("packets", "uint64"),
+    ("start_time", "float64"),
+    ("end_time", "float64"),
+    ("flags", "string"),
+    # The reverse direction and round trip time of the biflows, null for the other flows
+    ("rev_bytes", "uint64"),
+    ("rev_packets", "uint64"),
+    ("rev_flags", "string"),
+    ("rtt", "float64"),
+    # Whether the row is an interim record of a long flow (a delta), a flow being counted by its final record
+    ("interim", "bool_"),
+)
+# File extensions of the archive formats
+EXTENSIONS = {
+    "parquet": "parquet",
+    "arrow": "arrow",
+}
+# Rows of a Parquet row group, the unit skipped by the time and address predicates
+ROW_GROUP_SIZE = 65536
+SECONDS_PER_DAY = 86400
+# Imported by load_pyarrow, so that the collectors not archiving flows never load it
+pyarrow = None
+
+
+def load_pyarrow():
+    """Imports pyarrow, once
+
+    Raises:
+        ValueError: pyarrow is not installed
+    """
+    global pyarrow
+    if pyarrow is not None:
+        return
+    try:
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("The pyarrow package is needed to archive flows")
+
+
+def schema():
+    return pyarrow.schema([
+        (name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if kind == "string" else getattr(pyarrow, kind)())
+        for name, kind in COLUMNS
+    ])
+
+
+def partition_name(agent):
+    """The directory name of an agent address (IPv6 colons aren't allowed everywhere)"""
+    return re.sub(r"[^\w.-]", "_", agent)
+
+
+def flows_table(rows):
+    """Builds the arrow table of flow rows, tuples of the COLUMNS values"""
+    columns = list(zip(*rows)) if rows else [[] for _ in COLUMNS]
+    return pyarrow.Table.from_arrays(
+        [
+            pyarrow.array(values, pyarrow.string()).dictionary_encode() if kind == "string"
+            else pyarrow.array(values, getattr(pyarrow, kind)())
+            for values, (_, kind) in zip(columns, COLUMNS)
+        ],
+        schema=schema(),
+    )
+
+
+class Archiver(Worker):
+    """The archiver
+
+    Writes the decoded flows as columnar files (Parquet or Arrow IPC), for long term analytics. The
+    flows are grouped by agent and by time window of their end time, the interim records of the
+    long flows being rows of their own. A window is written once it's closed, delay seconds after
+    its end to let the late flows in, to
+
+        archive_dir/YYYY-MM-DD/agent/flows_HHMMSS_xxxxxxxx.parquet
+
+    Each file holds the flows of a window sorted by end time, its strings dictionary encoded.
+    """
+    worker_group = "archiver"
+    worker_number = 0
+
+    def __init__(self, entries, messages, archive_dir, window=3600, delay=300, file_format="parquet",
+                 compression="zstd", max_rows=500000):
+        """Initialization
+
+        Args:
+            entries: The thread safe FIFO queue to consume with decoded flows
+            messages: The thread safe FIFO queue to feed with logging messages
+            archive_dir: The directory of the archive
+            window: The duration of a time window (in seconds), dividing a day
+            delay: The time a window stays open after its end (in seconds)
+            file_format: "parquet" or "arrow"
+            compression: The compression codec of the files ("zstd", "lz4", "snappy" or None)
+            max_rows: The number of flows of a window beyond which it's written before being closed
+
+        Raises:
+            ValueError: pyarrow is not installed, or the window doesn't divide a day
+        """
+        load_pyarrow()
+        if SECONDS_PER_DAY % window:
+            raise ValueError(f"The archive window ({window}s) must divide a day")
+        super().__init__(entries, messages)
+        self.entries = entries
+        self.archive_dir = archive_dir
+        self.window = window
+        self.delay = delay
+        self.file_format = file_format
+        self.compression = compression
+        self.max_rows = max_rows
+        # {(window start, agent): [row, ...]}
+        self.windows = {}
+        self.checked_at = time.monotonic()
+        self.archived = metrics.registry.counter(
+            "myason_collector_archived_flows_total", "Flows written to the archive, by their final record",
+            worker=self.name)
+        self.files = metrics.registry.counter(
+            "myason_collector_archive_files_total", "Files written to the archive", worker=self.name)
+        self.lost = metrics.registry.counter(
+            "myason_collector_archive_lost_flows_total", "Flows which couldn't be archived", worker=self.name)
+        metrics.registry.gauge(
+            "myason_collector_archive_pending_flows", "Flows of the windows not written yet",
+            function=lambda: sum(len(rows) for rows in list(self.windows.values())), worker=self.name)
+
+    def process(self, entry):
+        self.archive_entry(entry)
+        # Close the windows even when the flows keep coming
+        if time.monotonic() - self.checked_at >= self.idle_timeout:
+            self.close_windows()
+
+    def idle(self):
+        self.close_windows()
+
+    def finish(self):
+        self.close_windows(flush=True)
+
+    def archive_entry(self, entry):
+        ip, flow = entry
+        agent = ip[0]
+        for flow_id, values in flow.items():
+            try:
+                flow_id_parts = flow_id.split(",")
+                row = (
+                    agent,
+                    flow_id_parts[0],
+                    flow_id_parts[1],
+                    flow_id_parts[2],
+                    int(flow_id_parts[3]),
+                    int(flow_id_parts[4]),
+                    int(flow_id_parts[5]),
+                    int(flow_id_parts[6]),
+                    int(flow_id_parts[7]),
+                    int(values["bytes"]),
+                    int(values["packets"]),
+                    float(values["start_time"]),
+                    float(values["end_time"]),
+                    str(values["flags"]),
+                    values.get("rev_bytes"),
+                    values.get("rev_packets"),
+                    values.get("rev_flags"),
+                    values.get("rtt"),
+                    bool(values.get("interim")),
+                )
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                self.lost.inc()
+                self.messages.put(("WARNING", f"{self.name}: Malformed flow record: {e}..."))
+                continue
+            key = (int(row[12] // self.window * self.window), agent)
+            rows = self.windows.setdefault(key, [])
+            rows.append(row)
+            if len(rows) >= self.max_rows:
+                self.write(key, self.windows.pop(key))
+
+    def close_windows(self, flush=False):
+        self.checked_at = time.monotonic()
+        now = time.time()
+        for key in [key for key in self.windows if flush or key[0] + self.window + self.delay <= now]:
+            self.write(key, self.windows.pop(key))
+
+    def write(self, key, rows):
+        window, agent = key
+        directory = os.path.join(
+            self.archive_dir,
+            time.strftime("%Y-%m-%d", time.gmtime(window)),
+            partition_name(agent),
+        )
+        name = f"flows_{time.strftime('%H%M%S', time.gmtime(window))}_{uuid.uuid4().hex[:8]}"
+        name = f"{name}.{EXTENSIONS[self.file_format]}"
+        # Written aside then renamed, so that queries never read a partial file
+        temporary_fn = os.path.join(directory, f".{name}")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            rows.sort(key=lambda row: row[12])
+            table = flows_table(rows)
+            if self.file_format == "arrow":
+                pyarrow.feather.write_feather(table, temporary_fn, compression=self.compression or "uncompressed")
+            else:
+                pyarrow.parquet.write_table(table, temporary_fn, compression=self.compression or "none",
+                                            row_group_size=ROW_GROUP_SIZE)
+            os.replace(temporary_fn, os.path.join(directory, name))
+        except (OSError, pyarrow.ArrowException) as e:
+            self.lost.inc(len(rows))
+            self.messages.put(("ERROR", f"{self.name}: {len(rows)} flows couldn't be archived in {directory}: {e}..."))
+            return
+        self.archived.inc(sum(1 for row in rows if not row[-1]))
+        self.files.inc()
+        self.messages.put(("DEBUG", f"{self.name}: {len(rows)} flows archived in {os.path.join(directory, name)}..."))
+
+
+def create_archiver(collector_conf, entries, messages):
+    """Returns the archiver of the configuration, None if the flows aren't archived"""
+    if collector_conf.get("archive_dir") is None:
+        return None
+    return Archiver(
+        entries=entries,
+        messages=messages,
+        archive_dir=collector_conf.get("archive_dir"),
+        window=collector_conf.get("archive_window", 3600),
+        delay=collector_conf.get("archive_delay", 300),
+        file_format=collector_conf.get("archive_format", "parquet"),
+        compression=collector_conf.get("archive_compression", "zstd"),
+        max_rows=collector_conf.get("archive_max_rows", 500000),
+    )
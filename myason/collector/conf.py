@@ -1,39 +1,85 @@
 # -*- coding: utf-8 -*-
 
 
+import csv
+import importlib.util
 import os
 
 import yaml
 
-from myason.helpers.logging import create_logger
+from myason.collector import archiver
+from myason.collector.alerter import create_rules
+from myason.collector.alerter import create_sinks
+from myason.collector.agents import AgentTable
+from myason.collector.enricher import configure_enrichers
+from myason.collector.prefixes import load_prefixes
+from myason.collector.processor import Processor
+from myason.helpers import compression
+from myason.helpers.conf import COMMON_SCHEMA
+from myason.helpers.conf import ConfError
+from myason.helpers.conf import Option
+from myason.helpers.conf import read_yaml
+from myason.helpers.conf import unknown_items
+from myason.helpers.conf import validate
+from myason.helpers.logging import checks_logger
+from myason.helpers.logging import logger_conf_loader
+from myason.helpers.logging import validate_logger_conf
+
+# The items of the collector configuration, with their types and defaults
+COLLECTOR_SCHEMA = COMMON_SCHEMA + (
+    Option("bind_address", str, "127.0.0.1"),
+    Option("bind_port", int, 9999, minimum=0),
+    Option("transports", list, ["udp"], choices=("udp", "tcp")),
+    Option("receive_batch", int, 64, minimum=1),
+    Option("runtime", str, "threads", choices=("threads", "asyncio")),
+    Option("node_name", str),
+    Option("agents", dict, {}),
+    Option("dictionaries", dict),
+    Option("token_ttl", float, 5, minimum=0),
+    Option("processors_number", int, 1, minimum=1),
+    Option("writers_number", int, 1, minimum=1),
+    Option("writer_cache_size", int, 65536, minimum=0),
+    Option("batch_size", int, 64, minimum=1),
+    Option("records_queue_size", int, 10000, minimum=0),
+    Option("entries_queue_size", int, 10000, minimum=0),
+    Option("db_name", str),
+    Option("influx_params", dict),
+    Option("wal_dir", str),
+    Option("wal_segment_size", int, 16 * 1024 * 1024, minimum=1),
+    Option("wal_max_bytes", int, 1024 * 1024 * 1024, minimum=1),
+    Option("wal_max_age", float, minimum=0),
+    Option("wal_retry_min", float, 1, minimum=0),
+    Option("wal_retry_max", float, 60, minimum=0),
+    Option("wal_batch_points", int, 5000, minimum=1),
+    Option("prefixes_file", str),
+    Option("prefixes_cache_size", int, 65536, minimum=0),
+    Option("enrichers_number", int, 1, minimum=1),
+    Option("resolver_source", str),
+    Option("resolver_concurrency", int, 8, minimum=1),
+    Option("resolver_timeout", float, 2, minimum=0),
+    Option("resolver_ttl", float, 3600, minimum=0),
+    Option("resolver_negative_ttl", float, 300, minimum=0),
+    Option("resolver_cache_size", int, 65536, minimum=0),
+    Option("archive_dir", str),
+    Option("archive_window", int, 3600, minimum=1),
+    Option("archive_delay", float, 300, minimum=0),
+    Option("archive_format", str, "parquet", choices=tuple(archiver.EXTENSIONS)),
+    Option("archive_compression", str, "zstd"),
+    Option("archive_max_rows", int, 500000, minimum=1),
+    Option("alert_rules", list),
+    Option("alert_sinks", list, [{"type": "log"}]),
+    Option("alert_max_series", int, 1000, minimum=1),
+    Option("alert_lateness", int, 20, minimum=0),
+    Option("feed_history", int, minimum=1),
+    Option("feed_lateness", int, 20, minimum=0),
+)
 
 
 def conf_is_ok(collector_logger_conf_fn, collector_conf_fn):
     #
-    # Basic logging configuration
-    #
-    default_logging = {
-        "version": 1,
-        "formatters": {
-            "simple": {
-                "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-            }
-        },
-        "handlers": {
-            "file": {
-                "class": "logging.FileHandler",
-                "level": "DEBUG",
-                "formatter": "simple",
-                'filename': "log/collector_error.log"
-            }
-        },
-        "root": {
-            "level": "DEBUG",
-            "handlers": ["file"]
-        },
-        'disable_existing_loggers': False
-    }
-    log = create_logger('root', default_logging)
+    # Sanity checks logging, the running logger configuration being left alone
+    #
+    log = checks_logger("collector")
     #
     # Configurations sanity chacks
     #
@@ -55,10 +101,8 @@ def conf_is_ok(collector_logger_conf_fn, collector_conf_fn):
     #
     log.info(f"Parsing collector logger configuration file ({collector_logger_conf_fn})...")
     try:
-        with open(collector_logger_conf_fn) as conf_fn:
-            collector_logger_conf = conf_fn.read()
-        collector_logger_conf = yaml.load(collector_logger_conf)
-    except yaml.YAMLError as e:
+        collector_logger_conf = logger_conf_loader(collector_logger_conf_fn)
+    except (OSError, yaml.YAMLError) as e:
         log.error(f"Error parsing collector logger configuration file ({collector_logger_conf_fn})... exiting!")
         log.error(e)
         return False
@@ -68,12 +112,10 @@ def conf_is_ok(collector_logger_conf_fn, collector_conf_fn):
     #
     log.info(f"Verifying if collector logger configuration file ({collector_logger_conf_fn}) is valid...")
     try:
-        create_logger("myason_collector", collector_logger_conf)
+        validate_logger_conf(collector_logger_conf)
     except ValueError as e:
-        log = create_logger('root', default_logging)
         log.error(f"Collector logger configuration file ({collector_logger_conf_fn}): {e}... exiting!")
         return False
-    log = create_logger('root', default_logging)
     log.info(f"Collector logger configuration file ({collector_logger_conf_fn}) is valid...")
     #
     # Collector configuration sanity checks
@@ -92,17 +134,125 @@ def conf_is_ok(collector_logger_conf_fn, collector_conf_fn):
     #
     log.info(f"Parsing collector configuration file ({collector_conf_fn})...")
     try:
-        with open(collector_conf_fn) as conf_fn:
-            collector_conf = conf_fn.read()
-        yaml.load(collector_conf)
-    except yaml.YAMLError as e:
+        content = read_yaml(collector_conf_fn)
+    except (OSError, yaml.YAMLError) as e:
         log.error(f"Error parsing collector configuration file ({collector_conf_fn})... exiting!")
         log.error(e)
         return False
     log.info(f"Successfully parsed collector configuration file ({collector_conf_fn})...")
     #
+    # Check collector configuration items against the schema
+    #
+    log.info(f"Checking collector configuration file ({collector_conf_fn}) items...")
+    try:
+        collector_conf = validate(content, COLLECTOR_SCHEMA)
+    except ConfError as e:
+        log.error(f"Collector configuration file ({collector_conf_fn}), {e}... exiting!")
+        return False
+    for name in unknown_items(content, COLLECTOR_SCHEMA):
+        log.warning(f"Unknown item {name} in collector configuration file ({collector_conf_fn}), ignored...")
+    #
+    # Check the agents white list addresses, networks and keys
+    #
+    log.info(f"Checking collector configuration file ({collector_conf_fn}) item agents...")
+    try:
+        AgentTable(collector_conf.get("agents"))
+    except (ValueError, TypeError, AttributeError) as e:
+        log.error(f"Agents in collector configuration file ({collector_conf_fn}) are not valid... {e}")
+        return False
+    #
+    # Check the prefix table
+    #
+    prefixes_fn = collector_conf.get("prefixes_file")
+    if prefixes_fn is not None:
+        log.info(f"Checking collector configuration file ({collector_conf_fn}) item prefixes_file...")
+        try:
+            load_prefixes(prefixes_fn, cache_size=0)
+        except (OSError, ValueError, csv.Error) as e:
+            log.error(
+                f"Prefix table in collector configuration file ({collector_conf_fn}), {prefixes_fn} is not valid... {e}"
+            )
+            return False
+    #
+    # Check the resolver source
+    #
+    resolver_source = collector_conf.get("resolver_source")
+    if resolver_source not in (None, "system") and not os.path.exists(resolver_source):
+        log.error(
+            f"Resolver source in collector configuration file ({collector_conf_fn}), {resolver_source} doesn't exist..."
+        )
+        return False
+    #
+    # Check the InfluxDB client, imported by the writers with their first write
+    #
+    if importlib.util.find_spec("influxdb") is None:
+        log.error("The influxdb package, needed to write the points, is not installed... exiting!")
+        return False
+    #
+    # Check the flows archive
+    #
+    if collector_conf.get("archive_dir") is not None:
+        log.info(f"Checking collector configuration file ({collector_conf_fn}) archive items...")
+        try:
+            archiver.load_pyarrow()
+        except ValueError:
+            log.error("The pyarrow package, needed to archive flows, is not installed... exiting!")
+            return False
+        archive_window = collector_conf.get("archive_window", 3600)
+        if archiver.SECONDS_PER_DAY % archive_window:
+            log.error(f"Archive window in collector configuration file ({collector_conf_fn}) must divide a day...")
+            return False
+    #
+    # Check the alerting rules and sinks
+    #
+    if collector_conf.get("alert_rules"):
+        log.info(f"Checking collector configuration file ({collector_conf_fn}) alerting items...")
+        try:
+            create_rules(collector_conf.get("alert_rules"))
+            create_sinks(collector_conf.get("alert_sinks"), None)
+        except (ValueError, AttributeError) as e:
+            log.error(f"Alerting in collector configuration file ({collector_conf_fn}) is not valid... {e}")
+            return False
+    #
+    # Check the live feed, streamed by the endpoint
+    #
+    if collector_conf.get("feed_history") is not None and collector_conf.get("endpoint_port") is None:
+        log.warning(f"Live feed in collector configuration file ({collector_conf_fn}) needs an endpoint, disabled...")
+    #
     # Exiting sanity checks with the relevant message
     #
     log.info("Collector configuration checks passed...")
     log.info("Starting the collector...")
     return True
+
+
+def reconfigure(collector_conf, processors, writers, enrichers=(), archivers=(), alerters=()):
+    """Applies a reloaded configuration to the running workers
+
+    The agents white list, their dictionaries, the prefix table, the resolver and the alerting
+    rules and sinks are swapped, and the processors, writers and archiver settings updated. The
+    listening addresses, the runtime, the numbers of workers, the archive directory and turning
+    the enrichment, the archive or the alerting on or off need a restart.
+    """
+    Processor.configure(
+        collector_conf.get("agents"),
+        compression.load_dictionaries(collector_conf.get("dictionaries")),
+    )
+    for processor in processors:
+        processor.token_ttl = collector_conf.get("token_ttl", 5)
+    for writer in writers:
+        writer.retry_min = collector_conf.get("wal_retry_min", 1)
+        writer.retry_max = collector_conf.get("wal_retry_max", 60)
+        writer.batch_points = collector_conf.get("wal_batch_points", 5000)
+    if enrichers:
+        configure_enrichers(collector_conf)
+    for archive in archivers:
+        archive.delay = collector_conf.get("archive_delay", 300)
+        archive.max_rows = collector_conf.get("archive_max_rows", 500000)
+    for alerter in alerters:
+        if collector_conf.get("alert_rules"):
+            alerter.configure(
+                create_rules(collector_conf.get("alert_rules")),
+                create_sinks(collector_conf.get("alert_sinks"), alerter.messages),
+            )
+            alerter.max_series = collector_conf.get("alert_max_series", 1000)
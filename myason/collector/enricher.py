@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+
+import time
+
+from myason.collector.prefixes import PrefixIndex
+from myason.collector.prefixes import load_prefixes
+from myason.collector.resolver import create_resolver
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
+
+
+class Enricher(Worker):
+    """The enricher
+
+    Tags the flows decoded by the processors with the prefix table entries (label, ASN, site) and
+    the hostnames of their source and destination addresses, before they're written. The index of
+    the prefix table and the resolver are shared by the enrichers, and swapped as a whole when the
+    configuration is reloaded. The flows never wait for their hostnames: the hostnames not cached
+    yet are resolved in the background, for the next flows.
+    """
+    worker_group = "enricher"
+    worker_number = 0
+    index = PrefixIndex([])
+    resolver = None
+
+    def __init__(self, flows, entries, messages, index=None):
+        """Initialization
+
+        Args:
+            flows: The thread safe FIFO queue to consume with decoded flows
+            entries: The thread safe FIFO queue to feed with enriched flows
+            messages: The thread safe FIFO queue to feed with logging messages
+            index: The prefix table index, None to keep the one shared by the enrichers
+        """
+        super().__init__(flows, messages)
+        if index is not None:
+            Enricher.configure(index)
+        self.flows = flows
+        self.entries = entries
+        self.enrich_seconds = metrics.registry.histogram(
+            "myason_collector_enrich_seconds", "Time spent enriching a flow entry", worker=self.name)
+        self.enriched = metrics.registry.counter(
+            "myason_collector_enriched_flows_total", "Flows tagged by the enricher", worker=self.name)
+
+    @classmethod
+    def configure(cls, index):
+        cls.index = index
+        metrics.registry.gauge(
+            "myason_collector_prefixes", "Prefixes of the prefix table", function=lambda: len(cls.index))
+        metrics.registry.gauge(
+            "myason_collector_prefix_cache_hits", "Prefix lookups answered by the cache",
+            function=lambda: cls.index.lookup.cache_info().hits)
+        metrics.registry.gauge(
+            "myason_collector_prefix_cache_misses", "Prefix lookups searched in the index",
+            function=lambda: cls.index.lookup.cache_info().misses)
+
+    @classmethod
+    def set_resolver(cls, resolver):
+        """Swaps the resolver, closing the previous one unless it's kept"""
+        previous, cls.resolver = cls.resolver, resolver
+        if previous is not None and previous is not resolver:
+            previous.close()
+
+    def process(self, entry):
+        start = time.perf_counter()
+        self.entries.put(self.enrich_entry(entry))
+        self.enrich_seconds.observe(time.perf_counter() - start)
+
+    def enrich_entries(self, entries):
+        for entry in entries:
+            self.enrich_entry(entry)
+        return entries
+
+    def enrich_entry(self, entry):
+        """Adds the tags of the flows addresses to the flows of an entry, in place"""
+        lookup = Enricher.index.lookup if Enricher.index else None
+        resolver = Enricher.resolver
+        for flow_id, flow in entry[1].items():
+            flow_id_parts = flow_id.split(",")
+            if len(flow_id_parts) < 3:
+                continue
+            src_ip = flow_id_parts[1]
+            dst_ip = flow_id_parts[2]
+            tags = {}
+            if lookup is not None:
+                src = lookup(src_ip)
+                if src is not None:
+                    tags.update(src[0])
+                dst = lookup(dst_ip)
+                if dst is not None:
+                    tags.update(dst[1])
+            if resolver is not None:
+                src_host = resolver.hostname(src_ip)
+                if src_host is not None:
+                    tags["src_host"] = src_host
+                dst_host = resolver.hostname(dst_ip)
+                if dst_host is not None:
+                    tags["dst_host"] = dst_host
+            if tags:
+                flow["tags"] = tags
+                self.enriched.inc()
+        return entry
+
+
+def enrichment_enabled(collector_conf):
+    return collector_conf.get("prefixes_file") is not None or collector_conf.get("resolver_source") is not None
+
+
+def configure_enrichers(collector_conf):
+    """Loads the prefix table and creates the resolver of the configuration, shared by the enrichers
+
+    The resolver in use, and its cache, are kept when the configuration doesn't change it.
+    """
+    if collector_conf.get("prefixes_file") is not None:
+        Enricher.configure(load_prefixes(
+            collector_conf.get("prefixes_file"),
+            cache_size=collector_conf.get("prefixes_cache_size", 65536),
+        ))
+    else:
+        Enricher.configure(PrefixIndex([]))
+    Enricher.set_resolver(create_resolver(collector_conf, Enricher.resolver))
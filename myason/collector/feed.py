@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+
+import time
+
+from myason.collector.rollup import Rollup
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
+
+# The topic of the per second totals on the bus
+TOPIC = "flows"
+# The key of the totals in the rollup
+TOTAL = "total"
+
+
+class Feed(Worker):
+    """The live feed of the dashboard
+
+    Totals the decoded flows by second (flows, bytes and packets, biflows in both directions), spread
+    over the seconds they last as the alerter does, then publishes each second once it's over,
+    lateness seconds after its end, on the bus, as a compact delta {"t", "flows", "bytes",
+    "packets"}: the dashboard appends it to its graphs instead of querying their whole history. The
+    last history seconds are retained for the dashboards connecting afterwards.
+    """
+    worker_group = "feed"
+    worker_number = 0
+
+    def __init__(self, entries, messages, bus, history=300, lateness=20):
+        """Initialization
+
+        Args:
+            entries: The thread safe FIFO queue to consume with decoded flows
+            messages: The thread safe FIFO queue to feed with logging messages
+            bus: The bus the seconds are published on
+            history: The seconds retained for the new subscribers
+            lateness: The seconds a second is published after its end
+        """
+        super().__init__(entries, messages)
+        self.entries = entries
+        self.bus = bus
+        self.history = history
+        self.bus.retain(TOPIC, history)
+        # The open seconds, {TOTAL: [bytes, packets, flows]} each
+        self.rollup = Rollup(lateness)
+        self.late_records = metrics.registry.counter(
+            "myason_collector_feed_late_records_total", "Flow records partly dropped, their seconds being over",
+            worker=self.name)
+
+    def process(self, entry):
+        self.tick()
+        _, flow = entry
+        for values in flow.values():
+            try:
+                length = int(values["bytes"]) + int(values.get("rev_bytes") or 0)
+                packets = int(values["packets"]) + int(values.get("rev_packets") or 0)
+                # A long flow is counted by its final record
+                flow_count = 0 if values.get("interim") else 1
+                if self.rollup.add((TOTAL,), float(values["start_time"]), float(values["end_time"]),
+                                   length, packets, flow_count):
+                    self.late_records.inc()
+            except (KeyError, TypeError, ValueError) as e:
+                self.messages.put(("WARNING", f"{self.name}: Malformed flow record: {e}..."))
+
+    def idle(self):
+        self.tick()
+
+    def finish(self):
+        # The open seconds, the current one included
+        for second, bucket in self.rollup.close(time.time() + self.rollup.lateness + 1, limit=self.history):
+            self.publish(second, bucket)
+
+    def tick(self):
+        """Publishes the seconds over, the ones without flows too"""
+        for second, bucket in self.rollup.close(limit=self.history):
+            self.publish(second, bucket)
+
+    def publish(self, second, bucket):
+        length, packets, flows = bucket.get(TOTAL, (0, 0, 0))
+        self.bus.publish(TOPIC, {"t": second, "flows": round(flows, 3), "bytes": round(length, 3),
+                                 "packets": round(packets, 3)})
+
+
+def create_feed(collector_conf, entries, messages, bus):
+    """Returns the feed of the configuration, None without a bus or a feed history"""
+    if bus is None or collector_conf.get("feed_history") is None:
+        return None
+    return Feed(
+        entries=entries,
+        messages=messages,
+        bus=bus,
+        history=collector_conf.get("feed_history"),
+        lateness=collector_conf.get("feed_lateness", 20),
+    )
@@ -3,35 +3,55 @@
 
 import threading
 import select
+import selectors
+import socket
+
+from myason.collector.agents import Rejections
+from myason.collector.processor import Processor
+from myason.helpers import framing
+from myason.helpers import metrics
 
 
 class Listener(threading.Thread):
+    """The listener of the UDP transport
+
+    Its socket is non-blocking: on each wakeup, the datagrams waiting in the socket buffer are read
+    until none is left, up to batch of them, rather than waiting again for each one. The datagrams
+    are filtered against the agents white list shared with the processors (Processor.configure).
+    """
     worker_group = "listener"
     worker_number = 0
-    agents = {}
 
-    def __init__(self, records, messages, sock, address, port, agents):
+    def __init__(self, records, messages, sock, address, port, batch=64):
         super().__init__()
         Listener.worker_number += 1
-        Listener.agents = agents
         self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
         self.records = records
         self.messages = messages
         self.sock = sock
         self.address = address
         self.port = port
+        self.batch = batch
         self.stop = threading.Event()
+        self.datagrams = metrics.registry.counter(
+            "myason_collector_datagrams_total", "Datagrams received", worker=self.name)
+        self.wakeups = metrics.registry.counter(
+            "myason_collector_listener_wakeups_total", "Wakeups of the listener with datagrams to read",
+            worker=self.name)
+        self.rejected = Rejections(self.name, messages, metrics.registry.counter(
+            "myason_collector_rejected_datagrams_total", "Datagrams from agents out of the white list",
+            worker=self.name))
 
     def run(self):
         self.messages.put(("INFO", f"{self.name}: up and running..."))
         self.sock.bind((self.address, self.port))
+        self.sock.setblocking(False)
         while not self.stop.isSet():
             rlist, wlist, elist = select.select([self.sock], [], [], 1)
             if rlist:
+                self.wakeups.inc()
                 for sock in rlist:
-                    data, ip = sock.recvfrom(1024)
-                    self.messages.put(("DEBUG", f"{self.name}: from {ip} received {data}"))
-                    self.process_data(data, ip)
+                    self.receive(sock)
 
     def join(self, timeout=None):
         self.stop.set()
@@ -39,9 +59,120 @@ class Listener(threading.Thread):
         super().join(timeout)
         self.messages.put(("INFO", f"{self.name}: stopped..."))
 
+    def receive(self, sock):
+        received = 0
+        for _ in range(self.batch):
+            try:
+                data, ip = sock.recvfrom(65535)
+            except BlockingIOError:
+                break
+            received += 1
+            # The record itself is logged by the processor
+            self.messages.put(("DEBUG", f"{self.name}: from {ip} received {len(data)} bytes"))
+            self.process_data(data, ip)
+        # Counted once per wakeup, a counter update being a few percent of the cost of a datagram
+        self.datagrams.inc(received)
+
     def process_data(self, data, ip):
-        if ip[0] in Listener.agents:
+        if ip[0] in Processor.agents:
             self.records.put((data, ip))
         else:
-            self.messages.put(
-                ("WARNING", f"{self.name}: data from {ip} was ignored. Not in {Listener.agents} white list!"))
+            self.rejected.reject(ip)
+
+
+class StreamListener(threading.Thread):
+    """The listener of the TCP transport
+
+    Accepts the connections of the agents in the white list and reassembles the frames they send
+    into records. Once the frames read from a connection are queued, the last one is acknowledged.
+    """
+    worker_group = "stream_listener"
+    worker_number = 0
+
+    def __init__(self, records, messages, address, port, ack_timeout=10.):
+        """Initialization
+
+        Args:
+            records: The thread safe FIFO queue to feed with received records
+            messages: The thread safe FIFO queue to feed with logging messages
+            address: The IP address to listen on
+            port: The TCP port to listen on
+            ack_timeout: The maximum time to wait for an agent to take an acknowledgement (in seconds)
+        """
+        super().__init__()
+        StreamListener.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.records = records
+        self.messages = messages
+        self.address = address
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self.stop = threading.Event()
+        self.selector = selectors.DefaultSelector()
+        self.connections = metrics.registry.counter(
+            "myason_collector_connections_total", "Agent connections accepted", worker=self.name)
+        self.frames = metrics.registry.counter(
+            "myason_collector_frames_total", "Frames received", worker=self.name)
+        self.rejected = Rejections(self.name, messages, metrics.registry.counter(
+            "myason_collector_rejected_connections_total", "Connections from agents out of the white list",
+            worker=self.name), what="connections")
+
+    def run(self):
+        self.messages.put(("INFO", f"{self.name}: up and running..."))
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.address, self.port))
+        server.listen()
+        self.selector.register(server, selectors.EVENT_READ)
+        while not self.stop.isSet():
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj is server:
+                    self.accept(server)
+                else:
+                    self.receive(key.fileobj, *key.data)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def join(self, timeout=None):
+        self.stop.set()
+        self.messages.put(("INFO", f"{self.name}: stopping..."))
+        super().join(timeout)
+        self.messages.put(("INFO", f"{self.name}: stopped..."))
+
+    def accept(self, server):
+        try:
+            connection, ip = server.accept()
+        except OSError as e:
+            # Out of file descriptors, or a connection aborted before being accepted
+            self.messages.put(("WARNING", f"{self.name}: can't accept a connection: {e}..."))
+            return
+        if ip[0] not in Processor.agents:
+            self.rejected.reject(ip)
+            connection.close()
+            return
+        # Reads only happen once the selector reports data: the timeout bounds the acknowledgements sending
+        connection.settimeout(self.ack_timeout)
+        self.selector.register(connection, selectors.EVENT_READ, (ip, framing.FrameBuffer()))
+        self.connections.inc()
+        self.messages.put(("INFO", f"{self.name}: connection from {ip} accepted..."))
+
+    def receive(self, connection, ip, frames):
+        try:
+            data = connection.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed by the agent")
+            frames.feed(data)
+            last = None
+            frame = frames.next_frame()
+            while frame is not None:
+                last, record = frame
+                self.frames.inc()
+                self.records.put((record, ip))
+                frame = frames.next_frame()
+            if last is not None:
+                connection.sendall(framing.ACK.pack(last))
+        except (OSError, ValueError) as e:
+            self.messages.put(("INFO", f"{self.name}: connection from {ip} closed ({e})..."))
+            self.selector.unregister(connection)
+            connection.close()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+
+import bisect
+import csv
+import functools
+import ipaddress
+import socket
+
+# Columns of a prefix table, after the network
+COLUMNS = ("label", "asn", "site")
+
+
+class PrefixIndex:
+    """The longest prefix match index of a prefix table
+
+    The prefixes, nested or not, are flattened into disjoint address ranges, each one labelled
+    with its most specific prefix. A lookup is then a binary search in the sorted starts of the
+    ranges. The results of the last cache_size addresses looked up are cached.
+
+    Built once and never updated: reloading the table builds a new index, with an empty cache.
+    """
+
+    def __init__(self, prefixes, cache_size=65536):
+        """Initialization
+
+        Args:
+            prefixes: A list of (network, value) tuples, network as a string (CIDR)
+            cache_size: The number of addresses whose results are cached
+
+        Raises:
+            ValueError: A network is not valid
+        """
+        ranges = {4: [], 6: []}
+        for network, value in prefixes:
+            network = ipaddress.ip_network(network, strict=False)
+            start = int(network.network_address)
+            ranges[network.version].append((start, start + network.num_addresses - 1, value))
+        self.starts = {}
+        self.values = {}
+        for version, version_ranges in ranges.items():
+            self.starts[version], self.values[version] = flatten(version_ranges)
+        self.prefixes = sum(len(version_ranges) for version_ranges in ranges.values())
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self.search)
+
+    def __len__(self):
+        return self.prefixes
+
+    def search(self, address):
+        """Returns the value of the most specific prefix holding address, None if there's none"""
+        version, family = (6, socket.AF_INET6) if ":" in address else (4, socket.AF_INET)
+        try:
+            number = int.from_bytes(socket.inet_pton(family, address), "big")
+        except (OSError, ValueError):
+            return None
+        i = bisect.bisect_right(self.starts[version], number) - 1
+        return self.values[version][i] if i >= 0 else None
+
+
+def flatten(ranges):
+    """Flattens nested (start, end, value) ranges into the sorted starts of disjoint ranges and their values
+
+    Where ranges overlap, the narrowest one wins. The gaps between ranges have the None value.
+    """
+    starts = []
+    values = []
+
+    def emit(start, value):
+        if starts and starts[-1] == start:
+            values[-1] = value
+        elif not values or values[-1] is not value:
+            starts.append(start)
+            values.append(value)
+
+    # The ranges opened and not closed yet, the narrowest last, as (end, value) tuples
+    opened = []
+    for start, end, value in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while opened and opened[-1][0] < start:
+            closed_end, _ = opened.pop()
+            emit(closed_end + 1, opened[-1][1] if opened else None)
+        emit(start, value)
+        opened.append((end, value))
+    while opened:
+        closed_end, _ = opened.pop()
+        emit(closed_end + 1, opened[-1][1] if opened else None)
+    return starts, values
+
+
+def load_prefixes(prefixes_fn, cache_size=65536):
+    """Loads a CSV prefix table into an index
+
+    The table has a header row and a network column, followed by any of the label, asn and site
+    columns. The value of a prefix is the tags of the flows from (src_...) and to (dst_...) the
+    prefix, as a tuple of two dicts.
+    """
+    prefixes = []
+    with open(prefixes_fn, newline="") as prefixes_file:
+        for row in csv.DictReader(prefixes_file):
+            network = (row.get("network") or "").strip()
+            if not network or network.startswith("#"):
+                continue
+            tags = {column: row[column].strip() for column in COLUMNS if row.get(column)}
+            value = (
+                {f"src_{column}": tag for column, tag in tags.items()},
+                {f"dst_{column}": tag for column, tag in tags.items()},
+            )
+            prefixes.append((network, value))
+    return PrefixIndex(prefixes, cache_size)
@@ -1,89 +1,130 @@
 # -*- coding: utf-8 -*-
 
 
-import threading
-import queue
 import time
 import json
 import base64
 import binascii
-from cryptography.fernet import Fernet
 import cryptography
 
+from myason.collector.agents import AgentTable
+from myason.collector.sequences import SequenceTracker
+from myason.helpers import compression
+from myason.helpers import metrics
+from myason.helpers.worker import Worker
 
-class Processor(threading.Thread):
+# Fields of the biflows exported by the agents in biflow mode, as (name, type)
+BIFLOW_FIELDS = (
+    ("rev_bytes", int),
+    ("rev_packets", int),
+    ("rev_flags", str),
+    ("rtt", float),
+)
+# Optional fields of the flows, as (name, type): the biflow ones, and the marker of the interim records
+# of the long flows (the final record of a flow has none)
+OPTIONAL_FIELDS = BIFLOW_FIELDS + (
+    ("interim", bool),
+)
+
+
+class Processor(Worker):
     worker_group = "processor"
     worker_number = 0
-    agents = {}
+    agents = AgentTable()
+    sequences = SequenceTracker()
+    decompressors = {}
 
-    def __init__(self, agents, records, entries, messages, token_ttl=5, ):
-        super().__init__()
-        Processor.worker_number += 1
-        Processor.agents = agents
+    def __init__(self, agents, records, entries, messages, token_ttl=5, dictionaries=None):
+        super().__init__(records, messages)
+        Processor.configure(agents, dictionaries)
+        self.decompressor = compression.Decompressor()
         self.token_ttl = token_ttl
-        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
         self.records = records
         self.entries = entries
-        self.messages = messages
-        self.stop = threading.Event()
+        self.record_seconds = metrics.registry.histogram(
+            "myason_collector_record_seconds", "Time spent processing a record", worker=self.name)
+        self.decrypt_failures = metrics.registry.counter(
+            "myason_collector_decrypt_failures_total", "Records which couldn't be decrypted", worker=self.name)
+        self.decode_failures = metrics.registry.counter(
+            "myason_collector_decode_failures_total", "Records which couldn't be decoded", worker=self.name)
+        self.flows = metrics.registry.counter(
+            "myason_collector_flows_total", "Flows received, by their final record", worker=self.name)
+        self.interim_records = metrics.registry.counter(
+            "myason_collector_interim_records_total", "Interim records of long flows received", worker=self.name)
+        self.malformed_flows = metrics.registry.counter(
+            "myason_collector_malformed_flows_total", "Malformed flows ignored", worker=self.name)
 
-    def run(self):
-        self.messages.put(("INFO", f"{self.name}: up and running..."))
-        while not self.stop.isSet():
-            try:
-                rec = self.records.get(block=False)
-                if rec is not None:
-                    self.process_record(rec)
-            except queue.Empty:
-                time.sleep(0.5)
+    @classmethod
+    def configure(cls, agents, dictionaries=None):
+        """Sets the agents white list and their compression dictionaries, shared by the processors
 
-    def join(self, timeout=None):
-        self.stop.set()
-        self.messages.put(("INFO", f"{self.name}: stopping..."))
-        self.clean_up()
-        super().join(timeout)
-        self.messages.put(("INFO", f"{self.name}: stopped..."))
+        The tables are replaced rather than updated, so that a reload never exposes a half built table.
+        """
+        cls.decompressors = {
+            agent: compression.Decompressor(dictionary) for agent, dictionary in (dictionaries or {}).items()
+        }
+        cls.agents = AgentTable(agents)
 
-    def clean_up(self):
-        self.messages.put(("INFO", f"{self.name}: processing remaining records..."))
-        while True:
-            try:
-                rec = self.records.get(block=False)
-                if rec is not None:
-                    self.process_record(rec)
-            except queue.Empty:
-                break
+    def process(self, rec):
+        start = time.perf_counter()
+        self.process_record(rec)
+        self.record_seconds.observe(time.perf_counter() - start)
 
     def process_record(self, record):
+        for entry in self.decode_record(record):
+            self.entries.put(entry)
+
+    def decode_records(self, records):
+        entries = []
+        for record in records:
+            entries.extend(self.decode_record(record))
+        return entries
+
+    def decode_record(self, record):
         data, ip = record
+        entries = []
         self.messages.put(("DEBUG", f"{self.name}: Processing record {data} received from {ip}"))
         try:
-            # Uncrypt data
-            key = Processor.agents[ip[0]].encode()
-            fernet = Fernet(key)
+            # Uncrypt data, with the cipher of the agent
+            fernet = Processor.agents.get(ip[0])
+            if fernet is None:
+                raise cryptography.fernet.InvalidToken
             data = fernet.decrypt(data, ttl=self.token_ttl)
         except cryptography.fernet.InvalidToken:
+            self.decrypt_failures.inc()
             self.messages.put(
                 ("WARNING", f"{self.name}: Invalid token. Record {data} received from {ip} was ignored!")
             )
-            return
+            return entries
         except TypeError:
+            self.decrypt_failures.inc()
             self.messages.put(
                 ("WARNING", f"{self.name}: Token TypeError Record {data} received from {ip} was ignored!")
             )
-            return
+            return entries
         try:
-            # Decode base 64
-            data = base64.b64decode(data)
+            if compression.is_compressed(data):
+                # Decompress, with the dictionary of the agent if any
+                data = Processor.decompressors.get(ip[0], self.decompressor).decompress(data)
+            else:
+                # Decode base 64
+                data = base64.b64decode(data)
             # Decode bytes
             data = data.decode()
             # Build a dictionary from json string
-            data = dict(json.loads(data))
-        except (binascii.Error, UnicodeError, json.JSONDecodeError) as e:
+            data = json.loads(data)
+            # Unwrap the flows of a sequenced record
+            if "seq" in data and "flows" in data:
+                Processor.sequences.track(ip[0], data.get("epoch"), data["seq"])
+                data = data["flows"]
+            data = dict(data)
+        except (binascii.Error, UnicodeError, json.JSONDecodeError, TypeError, ValueError) as e:
+            self.decode_failures.inc()
             self.messages.put(("WARNING", f"{self.name}: {e} Record {data} received from {ip} was ignored!"))
-            return
+            return entries
         # Data received sanity checks
         flow_ids = list(data.keys())
+        interim = 0
         for flow_id in flow_ids:
             try:
                 length = int(data[flow_id]["bytes"])
@@ -100,6 +141,18 @@ class Processor(threading.Thread):
                         'flags': flags,
                     }
                 }
-                self.entries.put((ip, flow))
-            except (KeyError, ValueError) as e:
+                # Reverse direction counters and round trip time of a biflow, interim record marker
+                for name, kind in OPTIONAL_FIELDS:
+                    if name in data[flow_id]:
+                        flow[flow_id][name] = kind(data[flow_id][name])
+                entries.append((ip, flow))
+                if flow[flow_id].get("interim"):
+                    interim += 1
+            except (KeyError, TypeError, ValueError) as e:
+                self.malformed_flows.inc()
                 self.messages.put(("WARNING", f"{self.name}: {e} flow {flow_id} received from {ip} was ignored!"))
+        # Counted once per record
+        if interim:
+            self.interim_records.inc(interim)
+        self.flows.inc(len(entries) - interim)
+        return entries
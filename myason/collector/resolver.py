@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import concurrent.futures
+import functools
+import os
+import socket
+import threading
+import time
+
+from myason.helpers import metrics
+
+
+def system_source(address):
+    """Resolves an address with the system resolver (reverse DNS, hosts file...)"""
+    try:
+        return socket.gethostbyaddr(address)[0]
+    except OSError:
+        return None
+
+
+class HostsFile:
+    """Resolves the addresses from a hosts file (address hostname [aliases...] lines)"""
+
+    def __init__(self, hosts_fn):
+        self.hostnames = {}
+        with open(hosts_fn) as hosts_file:
+            for line in hosts_file:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) >= 2:
+                    self.hostnames.setdefault(fields[0], fields[1])
+
+    def __call__(self, address):
+        return self.hostnames.get(address)
+
+
+class Resolver:
+    """The hostnames resolver
+
+    Never blocks: the hostname of an address is returned from the cache, or None while it's being
+    resolved in the background by up to concurrency threads. Resolved hostnames are cached for ttl
+    seconds, failures for negative_ttl seconds, and a lookup taking longer than timeout seconds is
+    given up as a failure. The cache holds the last cache_size addresses. Once closed, the lookups
+    already started still complete, and the addresses no longer cached aren't looked up.
+    """
+
+    def __init__(self, source=system_source, concurrency=8, timeout=2., ttl=3600., negative_ttl=300.,
+                 cache_size=65536, settings=None):
+        """Initialization
+
+        Args:
+            source: The function resolving an address to its hostname, None if it has none
+            concurrency: The maximum number of lookups running at once
+            timeout: The time after which a lookup is given up (in seconds)
+            ttl: The time a hostname is cached (in seconds)
+            negative_ttl: The time a failed lookup is cached (in seconds)
+            cache_size: The maximum number of addresses cached
+            settings: The configuration the resolver was created from, to tell whether a reload changes it
+        """
+        self.source = source
+        self.settings = settings
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix="resolver")
+        # Lookups waiting for a thread, beyond which addresses aren't looked up
+        self.max_pending = concurrency * 4
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        # {address: (hostname, expiration time)}, the least recently used first
+        self.cache = collections.OrderedDict()
+        # {address: deadline} of the running lookups
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.resolved = metrics.registry.counter(
+            "myason_collector_resolver_lookups_total", "Hostname lookups", result="resolved")
+        self.failed = metrics.registry.counter(
+            "myason_collector_resolver_lookups_total", "Hostname lookups", result="failed")
+        self.timeouts = metrics.registry.counter(
+            "myason_collector_resolver_lookups_total", "Hostname lookups", result="timeout")
+        self.skipped = metrics.registry.counter(
+            "myason_collector_resolver_skipped_total", "Lookups not started as too many were pending")
+        metrics.registry.gauge(
+            "myason_collector_resolver_cache_entries", "Addresses in the hostnames cache",
+            function=lambda: len(self.cache))
+
+    def hostname(self, address):
+        """Returns the hostname of address, None if it's not known yet or it has none"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(address)
+            if cached is not None and cached[1] > now:
+                self.cache.move_to_end(address)
+                return cached[0]
+            deadline = self.pending.get(address)
+            if deadline is not None:
+                if now > deadline:
+                    # Give up, a late result still makes it to the cache
+                    del self.pending[address]
+                    self.store(address, None, now)
+                    self.timeouts.inc()
+                return None
+            if len(self.pending) >= self.max_pending:
+                self.skipped.inc()
+                return None
+            self.pending[address] = now + self.timeout
+        try:
+            future = self.executor.submit(self.source, address)
+        except RuntimeError:
+            # Closed, replaced by a reload while the enrichers still hold it
+            with self.lock:
+                self.pending.pop(address, None)
+            return None
+        future.add_done_callback(functools.partial(self.done, address))
+        return None
+
+    def done(self, address, future):
+        try:
+            hostname = future.result()
+        except Exception:
+            hostname = None
+        with self.lock:
+            self.pending.pop(address, None)
+            self.store(address, hostname, time.monotonic())
+        if hostname is None:
+            self.failed.inc()
+        else:
+            self.resolved.inc()
+
+    def store(self, address, hostname, now):
+        self.cache[address] = (hostname, now + (self.ttl if hostname is not None else self.negative_ttl))
+        self.cache.move_to_end(address)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def close(self):
+        """Stops looking addresses up, the running lookups draining in the background"""
+        self.executor.shutdown(wait=False)
+
+
+def create_resolver(collector_conf, current=None):
+    """Returns the resolver of the configuration, None if hostnames aren't resolved
+
+    Args:
+        collector_conf: The collector configuration
+        current: The resolver in use, returned as is when the configuration doesn't change it
+    """
+    source = collector_conf.get("resolver_source")
+    if source is None:
+        return None
+    settings = (
+        # A hosts file is read again once modified
+        source, None if source == "system" else os.path.getmtime(source),
+        collector_conf.get("resolver_concurrency", 8),
+        collector_conf.get("resolver_timeout", 2),
+        collector_conf.get("resolver_ttl", 3600),
+        collector_conf.get("resolver_negative_ttl", 300),
+        collector_conf.get("resolver_cache_size", 65536),
+    )
+    if current is not None and current.settings == settings:
+        return current
+    return Resolver(
+        system_source if source == "system" else HostsFile(source),
+        *settings[2:],
+        settings=settings,
+    )
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+
+import math
+import time
+
+
+class Rollup:
+    """The totals of the flows by second, each flow spread over the seconds it lasts
+
+    A flow adds its bytes, packets and count to keys on every second from its start to its end, each
+    second getting an equal share of them, as the writer spreads its points. The open seconds are a
+    ring of buckets {key: [bytes, packets, flows]}, from the oldest second not over to the current
+    one: a second is over once lateness seconds have passed, so that the flows exported some time
+    after their last packet (aged by the inactive timeout of the agent) still count in it. The shares
+    of a flow falling on seconds already over, or ahead of the clock, are dropped.
+    """
+
+    def __init__(self, lateness, now=None):
+        """Initialization
+
+        Args:
+            lateness: The seconds a second is kept open once over
+            now: The current time, the clock by default
+        """
+        self.lateness = int(lateness)
+        self.size = self.lateness + 1
+        self.buckets = [{} for _ in range(self.size)]
+        # The oldest second not over, the first of the ring
+        self.first = int(time.time() if now is None else now) - self.lateness
+
+    def add(self, keys, start_time, end_time, length, packets, flows):
+        """Adds a flow to keys on each of its open seconds
+
+        Returns:
+            The seconds of the flow dropped, being over or ahead of the clock
+        """
+        start_second = math.floor(start_time)
+        duration = max(math.ceil(end_time) - start_second, 1)
+        first = max(start_second, self.first)
+        last = min(start_second + duration, self.first + self.size)
+        if first >= last:
+            return duration
+        length /= duration
+        packets /= duration
+        flows /= duration
+        buckets = self.buckets
+        for second in range(first, last):
+            bucket = buckets[second % self.size]
+            for key in keys:
+                counters = bucket.get(key)
+                if counters is None:
+                    bucket[key] = [length, packets, flows]
+                else:
+                    counters[0] += length
+                    counters[1] += packets
+                    counters[2] += flows
+        return duration - (last - first)
+
+    def close(self, now=None, limit=None):
+        """Closes the seconds over, the ones without flows too
+
+        Args:
+            now: The current time, the clock by default
+            limit: The seconds returned at most, the older ones (after a pause) being skipped
+
+        Returns:
+            The seconds over, [(second, {key: [bytes, packets, flows]})], the oldest first
+        """
+        end = int(time.time() if now is None else now) - self.lateness
+        seconds = []
+        for second in range(self.first, min(end, self.first + self.size)):
+            index = second % self.size
+            seconds.append((second, self.buckets[index]))
+            self.buckets[index] = {}
+        # The seconds past the ring had no flows
+        empty_start = self.first + self.size
+        if limit is not None:
+            empty_start = max(empty_start, end - limit)
+        seconds.extend((second, {}) for second in range(empty_start, end))
+        self.first = max(self.first, end)
+        if limit is not None:
+            return seconds[-limit:] if limit else []
+        return seconds
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import threading
+
+from myason.helpers import metrics
+
+
+class SequenceTracker:
+    """Counts the records lost, reordered or duplicated on their way from the agents
+
+    Every agent exporter numbers its records from the epoch it draws when it starts: a stream is
+    identified by the agent address and this epoch. A missing sequence number is counted as lost
+    once window records beyond it have been received, and as reordered if it arrives before.
+    Numbers below the first one received from a stream are ignored, as after a collector restart.
+    """
+
+    def __init__(self, window=64, max_streams=1024):
+        """Initialization
+
+        Args:
+            window: The number of records a late record can be received after
+            max_streams: The number of streams tracked, the least recently seen being forgotten
+        """
+        self.window = window
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        # {(agent, epoch): [highest sequence number, {missing sequence number: None}]}
+        self.streams = collections.OrderedDict()
+        self.agent_counters = {}
+
+    def track(self, agent, epoch, seq):
+        seq = int(seq)
+        with self.lock:
+            counters = self.counters(agent)
+            counters["records"].inc()
+            stream = self.streams.get((agent, epoch))
+            if stream is None:
+                self.streams[(agent, epoch)] = [seq, {}]
+                if len(self.streams) > self.max_streams:
+                    self.streams.popitem(last=False)
+                return
+            self.streams.move_to_end((agent, epoch))
+            highest, missing = stream
+            if seq > highest:
+                # Numbers too far behind to be waited for are lost right away
+                first = max(highest + 1, seq - self.window)
+                lost = first - highest - 1
+                for number in range(first, seq):
+                    missing[number] = None
+                stream[0] = seq
+                while missing and next(iter(missing)) <= seq - self.window:
+                    del missing[next(iter(missing))]
+                    lost += 1
+                if lost:
+                    counters["lost"].inc(lost)
+            elif seq in missing:
+                del missing[seq]
+                counters["reordered"].inc()
+            else:
+                counters["duplicated"].inc()
+
+    def counters(self, agent):
+        if agent in self.agent_counters:
+            return self.agent_counters[agent]
+        counters = self.agent_counters[agent] = {
+            "records": metrics.registry.counter(
+                "myason_collector_sequenced_records_total", "Records received with a sequence number", agent=agent),
+            "lost": metrics.registry.counter(
+                "myason_collector_lost_records_total", "Records missing from the agent sequences", agent=agent),
+            "reordered": metrics.registry.counter(
+                "myason_collector_reordered_records_total", "Records received out of order", agent=agent),
+            "duplicated": metrics.registry.counter(
+                "myason_collector_duplicated_records_total", "Records received more than once", agent=agent),
+        }
+        return counters
@@ -1,61 +1,161 @@
 # -*- coding: utf-8 -*-
 
-import queue
-import threading
+import functools
+import json
+import os
+import sys
 import time
 import uuid
 
-import arrow
-import influxdb
 import math
 
+from myason.helpers import metrics
+from myason.helpers.spool import Spool
+from myason.helpers.worker import Worker
 
-class Writer(threading.Thread):
+# The measurement of the flows points
+MEASUREMENT = "activities"
+# The tags of the flow id parts, in their order
+FLOW_ID_TAGS = ("ifname", "src_ip", "dst_ip", "proto", "src_port", "dst_port", "tos", "ethertype")
+# The outcomes of a write: the points are stored, rejected for good, or to be written again
+WRITTEN = "written"
+REJECTED = "rejected"
+FAILED = "failed"
+
+
+def escape_tag(value):
+    """Escapes a tag key or value for the line protocol"""
+    return value.replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace(
+        "\n", "\\n")
+
+
+def parse_flow_id(flow_id):
+    """Parses a flow id into the tuple of its parts, interned as they repeat from flow to flow"""
+    parts = flow_id.split(",")
+    if len(parts) < len(FLOW_ID_TAGS):
+        raise IndexError(f"flow id {flow_id} has {len(parts)} parts")
+    return tuple(sys.intern(part) for part in parts[:len(FLOW_ID_TAGS)])
+
+
+def line_prefix(agent, flow_id_parts, flags, extra_tags):
+    """The line protocol measurement and tags (sorted, escaped) of the points of a flow"""
+    tags = dict(zip(FLOW_ID_TAGS, flow_id_parts))
+    tags["agent"] = agent
+    tags["flags"] = flags
+    tags.update(extra_tags)
+    return MEASUREMENT + "".join(
+        f",{escape_tag(key)}={escape_tag(str(value))}"
+        for key, value in sorted(tags.items())
+        # Empty tag values aren't valid
+        if value != ""
+    )
+
+
+def biflow_fields(flow, duration):
+    """The line protocol fields of the reverse direction of a biflow, spread over its duration"""
+    if "rev_bytes" not in flow:
+        return ""
+    return f",rev_bytes={float(flow['rev_bytes'] / duration)},rev_packets={float(flow['rev_packets'] / duration)}"
+
+
+def is_rejection(error):
+    """Whether InfluxDB rejected the points for good: a client error (4xx) other than 429 Too Many Requests
+
+    Writing them again would fail again (points beyond the retention policy, field type conflicts...).
+    """
+    # Loaded with the client, by the first write
+    exceptions = sys.modules.get("influxdb.exceptions")
+    if exceptions is None or not isinstance(error, exceptions.InfluxDBClientError):
+        return False
+    return isinstance(error.code, int) and 400 <= error.code < 500 and error.code != 429
+
+
+class Writer(Worker):
     worker_group = "writer"
     worker_number = 0
 
-    def __init__(self, entries, messages, dbname, influx_params):
-        super().__init__()
-        Writer.worker_number += 1
-        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+    def __init__(self, entries, messages, dbname, influx_params, wal=None, retry_min=1., retry_max=60.,
+                 batch_points=5000, cache_size=65536, node=None):
+        super().__init__(entries, messages)
         self.entries = entries
-        self.messages = messages
         self.dbname = dbname
         self.influx_user = influx_params.get("user")
         self.influx_password = influx_params.get("password")
         self.influx_host = influx_params.get("host")
         self.influx_port = influx_params.get("port")
         self.influx_dbname = influx_params.get("dbname")
-        self.stop = threading.Event()
+        self.client = None
+        # The collector tag of the points of a cluster node, so that the nodes never overwrite each other's points
+        self.node_tags = (("collector", node),) if node else ()
+        # The parsed flow ids and the line protocol prefixes of the last cache_size tag sets
+        self.parse_flow_id = functools.lru_cache(maxsize=cache_size)(parse_flow_id)
+        self.line_prefix = functools.lru_cache(maxsize=cache_size)(line_prefix)
+        metrics.registry.gauge(
+            "myason_collector_line_prefix_cache_hits", "Point prefixes found in the cache",
+            function=lambda: self.line_prefix.cache_info().hits, worker=self.name)
+        metrics.registry.gauge(
+            "myason_collector_line_prefix_cache_misses", "Point prefixes built",
+            function=lambda: self.line_prefix.cache_info().misses, worker=self.name)
+        self.write_seconds = metrics.registry.histogram(
+            "myason_collector_write_seconds", "InfluxDB write latency", worker=self.name)
+        self.points = metrics.registry.counter(
+            "myason_collector_points_total", "Points written into InfluxDB", worker=self.name)
+        self.write_failures = metrics.registry.counter(
+            "myason_collector_write_failures_total", "Failed InfluxDB writes", worker=self.name)
+        self.rejected_points = metrics.registry.counter(
+            "myason_collector_rejected_points_total", "Points InfluxDB rejected for good, dropped", worker=self.name)
+        # Write-ahead log of the points which couldn't be written yet
+        self.wal = wal
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.retry_delay = retry_min
+        self.retry_at = 0.
+        self.batch_points = batch_points
+        if wal is not None:
+            self.logged_batches = metrics.registry.counter(
+                "myason_collector_wal_batches_total", "Point batches appended to the write-ahead log",
+                worker=self.name)
+            self.wal_retries = metrics.registry.counter(
+                "myason_collector_wal_retries_total", "Failed write-ahead log replays", worker=self.name)
+            metrics.registry.gauge(
+                "myason_collector_wal_bytes", "Disk space used by the write-ahead log", function=wal.size,
+                worker=self.name)
+            metrics.registry.gauge(
+                "myason_collector_wal_dropped_segments", "Write-ahead log segments dropped by the size or age caps",
+                function=lambda: wal.dropped_segments, worker=self.name)
 
-    def run(self):
-        self.messages.put(("INFO", f"{self.name}: up and running..."))
-        while not self.stop.isSet():
-            try:
-                ent = self.entries.get(block=False)
-                if ent is not None:
-                    self.process_entry(ent)
-            except queue.Empty:
-                time.sleep(0.5)
-
-    def join(self, timeout=None):
-        self.stop.set()
-        self.messages.put(("INFO", f"{self.name}: stopping..."))
-        self.clean_up()
-        super().join(timeout)
-        self.messages.put(("INFO", f"{self.name}: stopped..."))
-
-    def clean_up(self):
-        self.messages.put(("INFO", f"{self.name}: processing remaining entries..."))
-        while True:
-            try:
-                ent = self.entries.get(block=False)
-                if ent is not None:
-                    self.process_entry(ent)
-            except queue.Empty:
-                break
+    def process(self, ent):
+        self.process_entry(ent)
+        if self.wal is not None:
+            self.replay()
+
+    def idle(self):
+        if self.wal is not None:
+            self.wal.expire()
+            self.replay()
+
+    def finish(self):
+        self.close()
+        if self.wal is not None:
+            self.wal.close()
 
     def process_entry(self, entry):
+        for points in self.entry_points(entry):
+            self.store(points)
+
+    def process_entries(self, entries):
+        # Store the points of a batch of entries with a single write
+        points = []
+        for entry in entries:
+            for flow_points in self.entry_points(entry):
+                points.extend(flow_points)
+        if points:
+            self.store(points)
+        if self.wal is not None:
+            self.replay()
+
+    def entry_points(self, entry):
+        """Yields the line protocol points of the flows of an entry, one per second of each flow"""
         ip = entry[0]
         flow = entry[1]
         self.messages.put(("DEBUG", f"{self.name}: processing {flow} entry received from {ip}..."))
@@ -63,89 +163,179 @@ class Writer(threading.Thread):
         flow_uuid = str(uuid.uuid4())
         self.messages.put(("DEBUG", f"{self.name}: Generated uuid: {flow_uuid}..."))
         agent_address = ip[0]
-        for flow_id in flow.keys():
+        for flow_id, values in flow.items():
             try:
                 # Data extraction
-                flow_id_parts = flow_id.split(",")
-                ifname = flow_id_parts[0]
-                src_ip = flow_id_parts[1]
-                dst_ip = flow_id_parts[2]
-                proto = flow_id_parts[3]
-                src_port = flow_id_parts[4]
-                dst_port = flow_id_parts[5]
-                tos = flow_id_parts[6]
-                ethertype = flow_id_parts[7]
-                length = flow[flow_id]["bytes"]
-                packets = flow[flow_id]["packets"]
-                start_time = flow[flow_id]["start_time"]
-                end_time = flow[flow_id]["end_time"]
-                flags = flow[flow_id]["flags"]
+                length = values["bytes"]
+                packets = values["packets"]
+                start_time = values["start_time"]
+                end_time = values["end_time"]
+                flags = values["flags"]
+                # Tags added by the enrichers
+                tags = values.get("tags")
+                prefix = self.line_prefix(
+                    agent_address,
+                    self.parse_flow_id(flow_id),
+                    str(flags),
+                    (tuple(sorted(tags.items())) if tags else ()) + self.node_tags,
+                )
                 start_second = math.floor(start_time)
                 end_second = math.ceil(end_time)
-                duration = end_second - start_second
-                # InfluxDB processing
-                json_body = []
-                client = influxdb.InfluxDBClient(
-                    host=self.influx_host,
-                    port=self.influx_port,
-                    username=self.influx_user,
-                    password=self.influx_password,
-                    database=self.influx_dbname
-                )
-                if duration <= 1:
-                    json_body.extend([
-                        {
-                            "measurement": "activities",
-                            "tags": {
-                                "agent": agent_address,
-                                "ifname": ifname,
-                                "src_ip": src_ip,
-                                "dst_ip": dst_ip,
-                                "proto": proto,
-                                "src_port": src_port,
-                                "dst_port": dst_port,
-                                "tos": tos,
-                                "flags": flags,
-                                "ethertype": ethertype,
-                            },
-                            "fields": {
-                                "bytes": float(length),
-                                "packets": float(packets),
-                                "flows": 1.,
-                            },
-                            "time": arrow.get(start_second).format('YYYY-MM-DD HH:mm:ss ZZ')
-                        }
-                    ])
-                else:
-                    for i in range(duration):
-                        json_body.extend([
-                            {
-                                "measurement": "activities",
-                                "tags": {
-                                    "agent": agent_address,
-                                    "ifname": ifname,
-                                    "src_ip": src_ip,
-                                    "dst_ip": dst_ip,
-                                    "proto": proto,
-                                    "src_port": src_port,
-                                    "dst_port": dst_port,
-                                    "tos": tos,
-                                    "flags": flags,
-                                    "ethertype": ethertype,
-                                },
-                                "fields": {
-                                    "bytes": float(length / duration),
-                                    "packets": float(packets / duration),
-                                    "flows": 1.,
-                                },
-                                "time": arrow.get(start_second + i).format('YYYY-MM-DD HH:mm:ss ZZ'),
-                            }
-                        ])
-                if client.write_points(json_body):
-                    self.messages.put(("DEBUG", f"{self.name}: Inserted {json_body} into InfluxDB..."))
-                else:
-                    self.messages.put(("WARNING", f"{self.name}: Couldn't write into InfluxDB..."))
-            except KeyError as e:
+                duration = max(end_second - start_second, 1)
+                # InfluxDB points, the fields spread over the seconds of the flow
+                fields = (f"bytes={float(length / duration)},packets={float(packets / duration)},flows=1.0"
+                          f"{biflow_fields(values, duration)}")
+                rtt = values.get("rtt")
+                # The round trip time of a biflow, once per connection
+                first_fields = f"{fields},rtt={float(rtt)}" if rtt is not None else fields
+                points = [f"{prefix} {first_fields} {start_second}"]
+                points.extend(f"{prefix} {fields} {start_second + i}" for i in range(1, duration))
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
                 self.messages.put(("WARNING", f"{self.name}: Malformed flow record: {e}..."))
-            except Exception as e:
-                self.messages.put(("WARNING", f"{self.name}: Exception raised: {e}..."))
+                continue
+            yield points
+
+    def store(self, points):
+        """Writes points, logging them to be written again when InfluxDB is unavailable
+
+        Returns:
+            The outcome of the write: WRITTEN, REJECTED, or FAILED when the points are logged (or lost
+            without a write-ahead log)
+        """
+        if self.wal is None:
+            return self.write(points)
+        if not self.wal.empty():
+            # Keep the points in order, behind the backlog
+            self.log_points(points)
+            return FAILED
+        outcome = self.write(points)
+        if outcome == FAILED:
+            self.log_points(points)
+            self.retry_at = time.monotonic() + self.retry_delay
+        return outcome
+
+    def log_points(self, points):
+        try:
+            self.wal.append(json.dumps(points).encode())
+        except ValueError as e:
+            self.messages.put(("WARNING", f"{self.name}: {len(points)} points lost: {e}..."))
+            return
+        self.logged_batches.inc()
+
+    def replay(self):
+        """Writes the logged points, merging the logged batches into writes of batch_points points
+
+        After a failed write, replays are delayed by an exponential backoff. When InfluxDB rejects a
+        merged write for good, the logged batches are written again one by one, so that only the
+        rejected ones are dropped and the log moves past them.
+        """
+        while time.monotonic() >= self.retry_at:
+            # (position, points) of the logged batches
+            batches = []
+            count = 0
+            while count < self.batch_points:
+                record = self.wal.read()
+                if record is None:
+                    break
+                position, data = record
+                batches.append((position, json.loads(data.decode())))
+                count += len(batches[-1][1])
+            if not batches:
+                return
+            outcome = self.write([point for _, points in batches for point in points], drop=len(batches) == 1)
+            if outcome == REJECTED and len(batches) > 1:
+                for position, points in batches:
+                    if self.write(points) == FAILED:
+                        self.back_off()
+                        return
+                    self.wal.commit(position)
+            elif outcome == FAILED:
+                self.back_off()
+                return
+            else:
+                self.wal.commit(batches[-1][0])
+            self.retry_delay = self.retry_min
+
+    def back_off(self):
+        """Reads the uncommitted batches again after the retry delay, doubled for the next failure"""
+        self.wal.rewind()
+        self.wal_retries.inc()
+        self.retry_at = time.monotonic() + self.retry_delay
+        self.messages.put(
+            ("WARNING", f"{self.name}: Write-ahead log replay failed, retrying in {self.retry_delay}s..."))
+        self.retry_delay = min(self.retry_delay * 2, self.retry_max)
+
+    def write(self, points, drop=True):
+        """Writes points into InfluxDB
+
+        Args:
+            points: The line protocol points
+            drop: Whether points rejected for good are dropped (counted and logged), rather than split
+                by the caller
+
+        Returns:
+            WRITTEN, REJECTED when InfluxDB rejects them for good (they're dropped), FAILED when they
+            should be written again (connection errors, timeouts, server errors)
+        """
+        try:
+            start = time.perf_counter()
+            written = self.write_points(points)
+            self.write_seconds.observe(time.perf_counter() - start)
+        except Exception as e:
+            self.write_failures.inc()
+            if is_rejection(e):
+                if not drop:
+                    self.messages.put(("DEBUG", f"{self.name}: InfluxDB rejected {len(points)} points: {e}..."))
+                    return REJECTED
+                self.rejected_points.inc(len(points))
+                self.messages.put(("ERROR", f"{self.name}: InfluxDB rejected {len(points)} points, dropped: {e}..."))
+                return REJECTED
+            self.messages.put(("WARNING", f"{self.name}: Exception raised: {e}..."))
+            return FAILED
+        if written:
+            self.points.inc(len(points))
+            self.messages.put(("DEBUG", f"{self.name}: Inserted {points} into InfluxDB..."))
+            return WRITTEN
+        self.write_failures.inc()
+        self.messages.put(("WARNING", f"{self.name}: Couldn't write into InfluxDB..."))
+        return FAILED
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def write_points(self, points):
+        # The client is kept, and so are its pooled HTTP connections
+        if self.client is None:
+            # Imported with the first write, the collector startup doesn't wait for the client and its HTTP stack
+            import influxdb
+            self.client = influxdb.InfluxDBClient(
+                host=self.influx_host,
+                port=self.influx_port,
+                username=self.influx_user,
+                password=self.influx_password,
+                database=self.influx_dbname
+            )
+        return self.client.write_points(points, time_precision="s", protocol="line")
+
+
+def wal_options(collector_conf, n):
+    """Returns the write-ahead log arguments of the nth writer
+
+    Every writer has its own log directory, found again when the collector restarts.
+    """
+    if collector_conf.get("wal_dir") is None:
+        return {}
+    wal = Spool(
+        os.path.join(collector_conf.get("wal_dir"), f"writer_{format(n + 1, '0>3')}"),
+        segment_size=collector_conf.get("wal_segment_size", 16 * 1024 * 1024),
+        max_bytes=collector_conf.get("wal_max_bytes", 1024 * 1024 * 1024),
+        max_age=collector_conf.get("wal_max_age"),
+    )
+    return {
+        "wal": wal,
+        "retry_min": collector_conf.get("wal_retry_min", 1),
+        "retry_max": collector_conf.get("wal_retry_max", 60),
+        "batch_points": collector_conf.get("wal_batch_points", 5000),
+    }
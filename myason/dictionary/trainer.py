@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import queue
+
+from myason.agent.exporter import envelope
+from myason.helpers import compression
+from myason.helpers.spool import read_records
+
+
+def pcap_samples(pcap_fns, batch_flows):
+    """Builds records from the flows of pcap files, as the agent would export them"""
+    from scapy.layers.l2 import Ether
+    from myason.agent.pcap import LINKTYPE_ETHERNET
+    from myason.agent.pcap import read_frames
+    from myason.agent.processor import Processor
+    entries = queue.Queue()
+    processor = Processor(None, entries, queue.Queue(), 1024, 1800, 15, packet_time=True)
+    for pcap_fn in pcap_fns:
+        ifname = os.path.basename(pcap_fn)
+        for timestamp, linktype, data in read_frames(pcap_fn):
+            if linktype != LINKTYPE_ETHERNET:
+                continue
+            pkt = Ether(data)
+            pkt.time = timestamp
+            processor.process_packet((pkt, ifname))
+    processor.age_cache(flush=True)
+    fragments = [json.dumps(entries.get())[1:-1] for _ in range(entries.qsize())]
+    return [
+        envelope(0, seq, fragments[n:n + batch_flows]).encode()
+        for seq, n in enumerate(range(0, len(fragments), batch_flows), 1)
+    ]
+
+
+def spool_samples(spool_dirs):
+    """Reads the records of agent spools, read-only, leaving them in place"""
+    samples = []
+    decompressor = compression.Decompressor()
+    for spool_dir in spool_dirs:
+        if not os.path.isdir(spool_dir):
+            continue
+        for data in read_records(spool_dir):
+            if compression.is_compressed(data):
+                try:
+                    data = decompressor.decompress(data)
+                except ValueError:
+                    # Compressed with a dictionary
+                    data = None
+            if data:
+                samples.append(data)
+    return samples
+
+
+def train(output_fn, codec="zstd", size=16384, pcap_fns=None, spool_dirs=None, batch_flows=1):
+    if not compression.available(codec) or codec not in ("zstd", "zlib"):
+        print(f"Compression codec {codec} can't train dictionaries, or is not available")
+        return
+    samples = pcap_samples(pcap_fns or [], batch_flows) + spool_samples(spool_dirs or [])
+    if not samples:
+        print("No sample record found")
+        return
+    dictionary = compression.train_dictionary(samples, size, codec)
+    with open(output_fn, "wb") as dictionary_file:
+        dictionary_file.write(dictionary)
+    print(f"Trained a {len(dictionary)} bytes {codec} dictionary from {len(samples)} records: {output_fn}")
+    print("Share it with the collector (dictionaries in the collector configuration)")
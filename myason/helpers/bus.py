@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import itertools
+import json
+import queue
+import threading
+
+from myason.helpers import metrics
+
+# Queued to the subscriptions when the bus is closed
+CLOSED = object()
+
+
+class Subscription:
+    """The events of some topics, waiting for a subscriber
+
+    The events are kept in a bounded queue: when a subscriber lags behind, its oldest events are
+    dropped rather than blocking the publishers.
+    """
+
+    def __init__(self, topics, size):
+        self.topics = topics
+        self.events = queue.Queue(maxsize=size)
+
+    def put(self, event):
+        """Queues an event, dropping the oldest one when full
+
+        Returns:
+            The number of events dropped
+        """
+        try:
+            self.events.put_nowait(event)
+            return 0
+        except queue.Full:
+            pass
+        try:
+            self.events.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            pass
+        return 1
+
+    def get(self, timeout=None):
+        """Returns the next event (id, topic, data), None after timeout seconds without one, CLOSED once closed"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Bus:
+    """The in-process publish/subscribe bus
+
+    The workers publish events (dicts) on topics, and every subscription to a topic gets them.
+    Publishing never blocks: it costs a queue put per subscriber, and nothing without one. The last
+    events of a topic are retained, so that a new subscriber starts with them. Each event gets an id,
+    increasing across the topics, for a subscriber resuming after a disconnection to skip those it
+    already got.
+    """
+
+    def __init__(self, app, subscription_size=1024):
+        """Initialization
+
+        Args:
+            app: The application name (agent or collector), used to name the metrics
+            subscription_size: The events a subscription queues at most
+        """
+        self.app = app
+        self.subscription_size = subscription_size
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        # {topic: deque of (id, topic, data)}
+        self.retained = {}
+        self.closed = False
+        self.dropped = metrics.registry.counter(
+            f"myason_{app}_events_dropped_total", "Events dropped, a subscriber lagging behind")
+        metrics.registry.gauge(
+            f"myason_{app}_event_subscribers", "Subscriptions to the bus", function=lambda: len(self.subscriptions))
+
+    def retain(self, topic, size):
+        """Keeps the last size events of topic for the new subscribers"""
+        with self.lock:
+            self.retained[topic] = collections.deque(self.retained.get(topic, ()), maxlen=size)
+
+    def publish(self, topic, data):
+        with self.lock:
+            event = (next(self.ids), topic, data)
+            retained = self.retained.get(topic)
+            if retained is not None:
+                retained.append(event)
+            for subscription in self.subscriptions:
+                if topic in subscription.topics:
+                    self.dropped.inc(subscription.put(event))
+
+    def subscribe(self, topics, last_id=0):
+        """Subscribes to topics, starting with their retained events newer than last_id"""
+        subscription = Subscription(frozenset(topics), self.subscription_size)
+        with self.lock:
+            if self.closed:
+                subscription.put(CLOSED)
+            backlog = [event for topic in subscription.topics for event in self.retained.get(topic, ())]
+            for event in sorted(backlog)[-self.subscription_size:]:
+                if event[0] > last_id:
+                    subscription.put(event)
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def install(self, endpoint=None):
+        if endpoint is not None:
+            endpoint.add_stream("/events", self.stream)
+
+    def stream(self, query, last_event_id=None, keepalive=15.):
+        """Streams the events of the topics of the query as server-sent events
+
+        Args:
+            query: The query parameters, topics being a comma separated list (every retained topic by default)
+            last_event_id: The id of the last event the client got, when it reconnects
+            keepalive: The delay between the comments keeping an idle connection open (in seconds)
+        """
+        topics = query.get("topics")
+        topics = topics.split(",") if topics else list(self.retained)
+        try:
+            last_id = int(last_event_id or 0)
+        except ValueError:
+            last_id = 0
+        subscription = self.subscribe(topics, last_id)
+        try:
+            # How long the client waits before reconnecting (in milliseconds)
+            yield b"retry: 2000\n\n"
+            while True:
+                event = subscription.get(timeout=keepalive)
+                if event is CLOSED:
+                    break
+                if event is None:
+                    yield b": keepalive\n\n"
+                    continue
+                event_id, topic, data = event
+                yield f"id: {event_id}\nevent: {topic}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+        finally:
+            self.unsubscribe(subscription)
+
+    def close(self):
+        """Ends the streams"""
+        with self.lock:
+            self.closed = True
+            for subscription in self.subscriptions:
+                subscription.put(CLOSED)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Markers prefixing the compressed records. Uncompressed records are base 64 encoded json, which
+# never starts with these bytes
+MARKERS = {
+    "zlib": b"\x01",
+    "zstd": b"\x02",
+    "lz4": b"\x03",
+}
+# Largest decompressed record
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+# zlib only looks back 32 KiB: a larger dictionary would be truncated
+MAX_ZLIB_DICTIONARY_SIZE = 32 * 1024
+# Errors raised by the codecs on corrupted data
+ERRORS = (zlib.error,)
+if zstandard is not None:
+    ERRORS += (zstandard.ZstdError,)
+if lz4 is not None:
+    ERRORS += (RuntimeError,)
+
+
+def available(codec):
+    if codec == "zstd":
+        return zstandard is not None
+    if codec == "lz4":
+        return lz4 is not None
+    return codec in ("none", "zlib")
+
+
+def is_compressed(data):
+    return data[:1] in MARKERS.values()
+
+
+def load_dictionary(dictionary_fn):
+    with open(dictionary_fn, "rb") as dictionary_file:
+        return dictionary_file.read()
+
+
+def load_dictionaries(dictionary_fns):
+    """Loads the {agent: dictionary file name} dictionaries"""
+    return {agent: load_dictionary(dictionary_fn) for agent, dictionary_fn in (dictionary_fns or {}).items()}
+
+
+class Compressor:
+    """Compresses the records of an exporter"""
+
+    def __init__(self, codec, dictionary=None, level=None):
+        """Initialization
+
+        Args:
+            codec: "zlib", "zstd" or "lz4"
+            dictionary: The dictionary shared with the collector (bytes), none with lz4
+            level: The compression level, None for the codec default
+
+        Raises:
+            ValueError: The codec is unknown or its package is not installed
+        """
+        if codec not in MARKERS or not available(codec):
+            raise ValueError(f"Compression codec {codec} is not available")
+        self.codec = codec
+        self.marker = MARKERS[codec]
+        self.dictionary = dictionary
+        if codec == "zlib":
+            self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        elif codec == "zstd":
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self.zstd = zstandard.ZstdCompressor(level=3 if level is None else level, dict_data=dict_data)
+        else:
+            self.level = 0 if level is None else level
+
+    def compress(self, data):
+        if self.codec == "zlib":
+            if self.dictionary:
+                compressor = zlib.compressobj(self.level, zdict=self.dictionary[-MAX_ZLIB_DICTIONARY_SIZE:])
+                return self.marker + compressor.compress(data) + compressor.flush()
+            return self.marker + zlib.compress(data, self.level)
+        if self.codec == "zstd":
+            return self.marker + self.zstd.compress(data)
+        return self.marker + lz4.frame.compress(data, compression_level=self.level)
+
+
+class Decompressor:
+    """Decompresses the records of an agent, whatever their codec
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, dictionary=None):
+        """Initialization
+
+        Args:
+            dictionary: The dictionary shared with the agent (bytes)
+        """
+        self.dictionary = dictionary
+        self.zstd_dict = None
+        if dictionary and zstandard is not None:
+            self.zstd_dict = zstandard.ZstdCompressionDict(dictionary)
+
+    def decompress(self, data):
+        """Decompresses a record
+
+        Raises:
+            ValueError: The record is corrupted, too large, or its codec is not available
+        """
+        marker, payload = data[:1], data[1:]
+        try:
+            if marker == MARKERS["zlib"]:
+                if self.dictionary:
+                    decompressor = zlib.decompressobj(zdict=self.dictionary[-MAX_ZLIB_DICTIONARY_SIZE:])
+                else:
+                    decompressor = zlib.decompressobj()
+                data = decompressor.decompress(payload, MAX_RECORD_SIZE)
+                if decompressor.unconsumed_tail:
+                    raise ValueError(f"Record exceeds {MAX_RECORD_SIZE} bytes")
+                return data
+            if marker == MARKERS["zstd"] and zstandard is not None:
+                # Decompressors aren't thread safe: one per record
+                decompressor = zstandard.ZstdDecompressor(dict_data=self.zstd_dict)
+                return decompressor.decompress(payload, max_output_size=MAX_RECORD_SIZE)
+            if marker == MARKERS["lz4"] and lz4 is not None:
+                decompressor = lz4.frame.LZ4FrameDecompressor()
+                data = decompressor.decompress(payload, max_length=MAX_RECORD_SIZE)
+                if not decompressor.eof:
+                    if decompressor.needs_input:
+                        raise ValueError("Truncated record")
+                    raise ValueError(f"Record exceeds {MAX_RECORD_SIZE} bytes")
+                return data
+        except ERRORS as e:
+            raise ValueError(f"{e}")
+        raise ValueError(f"Unavailable compression codec (marker {marker})")
+
+
+def train_dictionary(samples, size, codec="zstd"):
+    """Builds a dictionary from sample records
+
+    zstd trains its own dictionary format. For zlib, the dictionary is made of the most frequent
+    json fragments of the samples, the most frequent last (closest to the data).
+
+    Args:
+        samples: A list of records (bytes)
+        size: The dictionary size (in bytes)
+        codec: "zstd" or "zlib"
+    """
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("Compression codec zstd is not available")
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    size = min(size, MAX_ZLIB_DICTIONARY_SIZE)
+    fragments = collections.Counter()
+    for sample in samples:
+        for fragment in sample.replace(b"{", b",").replace(b"}", b",").split(b","):
+            if len(fragment) > 3:
+                fragments[fragment.strip()] += 1
+    dictionary = b""
+    for fragment, _ in fragments.most_common():
+        if len(dictionary) + len(fragment) + 2 > size:
+            break
+        dictionary = fragment + b", " + dictionary
+    return dictionary
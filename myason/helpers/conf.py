@@ -1,25 +1,181 @@
 # -*- coding: utf-8 -*-
 
 
+import collections.abc
+import os
+import threading
+
 import yaml
 
+# The libyaml parser when PyYAML is built with it. Safe: tags can't build arbitrary Python objects
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# The parsed files, as {absolute file name: ((modification time, size), parsed content)}
+parsed_files = {}
+parsed_files_lock = threading.Lock()
+
+
+class ConfError(ValueError):
+    """A configuration item doesn't match its schema"""
+
+
+class Config(collections.abc.Mapping):
+    """A validated configuration, read-only
+
+    The items are read as from a dict (conf.get("cache_limit")) or as attributes (conf.cache_limit),
+    the missing ones holding the default of their schema option. The lists are frozen into tuples
+    and the mappings into Config objects, so that a configuration shared by the workers, or swapped
+    by a reload, is never modified under them.
+    """
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        object.__setattr__(self, "_items", {key: freeze(value) for key, value in items.items()})
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getattr__(self, name):
+        try:
+            return self._items[name]
+        except KeyError:
+            raise AttributeError(f"No configuration item {name}") from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The configuration is read-only")
+
+    def __repr__(self):
+        return f"Config({self._items!r})"
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return Config(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Option:
+    """An item of a configuration schema"""
+
+    def __init__(self, name, kinds, default=None, choices=None, minimum=None):
+        """Initialization
+
+        Args:
+            name: The name of the item
+            kinds: The type, or tuple of types, of the value (a float item accepts integers too)
+            default: The value of the item when it's missing, None being accepted when it's the default
+            choices: The values accepted, None to accept any value of kinds
+            minimum: The lowest value of a number, None for no limit
+        """
+        self.name = name
+        self.kinds = kinds if isinstance(kinds, tuple) else (kinds,)
+        if float in self.kinds and int not in self.kinds:
+            self.kinds += (int,)
+        self.default = default
+        self.choices = choices
+        self.minimum = minimum
+
+    def check(self, value):
+        """Raises ConfError if value isn't valid for the item"""
+        if value is None and self.default is None:
+            return
+        # Booleans are integers to isinstance, not to the configuration
+        if not isinstance(value, self.kinds) or (isinstance(value, bool) and bool not in self.kinds):
+            kinds = " or ".join(kind.__name__ for kind in self.kinds)
+            raise ConfError(f"{self.name} must be of type {kinds}, not {value!r}")
+        if self.choices is not None:
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                if item not in self.choices:
+                    raise ConfError(f"{self.name} must be among {', '.join(map(str, self.choices))}, not {item!r}")
+        if self.minimum is not None and value < self.minimum:
+            raise ConfError(f"{self.name} must be at least {self.minimum}, not {value!r}")
+
+
+def read_yaml(conf_fn):
+    """Parses a YAML file, once per version of the file
+
+    The content is cached with the modification time and size of the file: the sanity checks, the
+    startup and the reloads parse an unmodified file only once. It's shared, never modify it.
+
+    Raises:
+        OSError: The file can't be read
+        yaml.YAMLError: The file isn't valid YAML
+    """
+    stat = os.stat(conf_fn)
+    version = (stat.st_mtime_ns, stat.st_size)
+    key = os.path.abspath(conf_fn)
+    with parsed_files_lock:
+        cached = parsed_files.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with open(conf_fn) as conf_file:
+        content = yaml.load(conf_file, Loader=Loader)
+    with parsed_files_lock:
+        parsed_files[key] = (version, content)
+    return content
+
+
+def validate(content, schema):
+    """Checks the items of a parsed configuration against a schema
+
+    The items out of the schema are kept as they are.
+
+    Args:
+        content: The parsed configuration
+        schema: The Option objects of the items
+
+    Returns:
+        The Config of the items, the missing ones set to their default
+
+    Raises:
+        ConfError: The configuration isn't a mapping, or an item doesn't match its option
+    """
+    if content is None:
+        content = {}
+    if not isinstance(content, dict):
+        raise ConfError("The configuration must be a mapping of items")
+    items = dict(content)
+    for option in schema:
+        if option.name in items:
+            option.check(items[option.name])
+        else:
+            items[option.name] = option.default
+    return Config(items)
+
+
+def unknown_items(content, schema):
+    """The items of a parsed configuration out of its schema, misspelled or obsolete"""
+    names = {option.name for option in schema}
+    return sorted(name for name in (content or {}) if name not in names)
 
-def collector_conf_loader(collector_conf_fn):
-    with open(collector_conf_fn) as conf_fn:
-        collector_conf = conf_fn.read()
-    collector_conf = yaml.load(collector_conf)
-    return collector_conf
 
+def conf_loader(conf_fn, schema=()):
+    """Loads a configuration file into a Config, validated against schema
 
-def agent_conf_loader(agent_conf_fn):
-    with open(agent_conf_fn) as conf_fn:
-        agent_conf = conf_fn.read()
-    agent_conf = yaml.load(agent_conf)
-    return agent_conf
+    Raises:
+        OSError: The file can't be read
+        yaml.YAMLError: The file isn't valid YAML
+        ConfError: The configuration doesn't match its schema
+    """
+    return validate(read_yaml(conf_fn), schema)
 
 
-def conf_loader(conf_fn):
-    with open(conf_fn) as conf_fn:
-        conf = conf_fn.read()
-    conf = yaml.load(conf)
-    return conf
+# The items of the helpers shared by the agent and the collector: endpoint, reloader and profiler
+COMMON_SCHEMA = (
+    Option("endpoint_address", str, "127.0.0.1"),
+    Option("endpoint_port", int, minimum=0),
+    Option("reload_interval", float, minimum=0),
+    Option("profiler_duration", float, 30, minimum=0),
+    Option("profiler_interval", float, 0.01, minimum=0),
+    Option("profiler_dir", str, "log"),
+    Option("profiler_format", str, "collapsed", choices=("collapsed", "speedscope")),
+)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+
+import http.server
+import threading
+import urllib.parse
+
+from myason.helpers import metrics
+
+
+class Endpoint(threading.Thread):
+    """The local HTTP endpoint
+
+    Serves the metrics in the Prometheus text format on /metrics. Other routes can be added with
+    add_route(), and streams of server-sent events with add_stream().
+    """
+    worker_group = "endpoint"
+    worker_number = 0
+
+    def __init__(self, messages, address, port, registry=None):
+        """Initialization
+
+        Args:
+            messages: The thread safe FIFO queue to feed with logging messages
+            address: The IP address to bind to
+            port: The TCP port to bind to
+            registry: The metrics registry to expose (the process registry by default)
+        """
+        super().__init__()
+        Endpoint.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.daemon = True
+        self.messages = messages
+        self.address = address
+        self.port = port
+        self.registry = registry if registry is not None else metrics.registry
+        self.server = None
+        self.routes = {
+            "/metrics": self.get_metrics,
+        }
+        self.streams = {}
+
+    def add_route(self, path, handler):
+        """Serves path with handler
+
+        The handler is called with the dict of the query parameters and returns a tuple
+        (status code, content type, body bytes).
+        """
+        self.routes[path] = handler
+
+    def add_stream(self, path, handler):
+        """Streams path with handler
+
+        The handler is called with the dict of the query parameters and the Last-Event-ID header of a
+        reconnecting client (None otherwise), and returns a generator of server-sent events bytes. The
+        stream ends with the generator or when the client disconnects.
+        """
+        self.streams[path] = handler
+
+    def run(self):
+        try:
+            self.server = http.server.ThreadingHTTPServer((self.address, self.port), EndpointHandler)
+        except OSError as e:
+            self.messages.put(("ERROR", f"{self.name}: can't listen on ({self.address}, {self.port}): {e}"))
+            return
+        self.server.endpoint = self
+        self.messages.put(("INFO", f"{self.name}: up and running on ({self.address}, {self.port})..."))
+        self.server.serve_forever(poll_interval=0.5)
+
+    def join(self, timeout=None):
+        self.messages.put(("INFO", f"{self.name}: stopping..."))
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        super().join(timeout)
+        self.messages.put(("INFO", f"{self.name}: stopped..."))
+
+    def get_metrics(self, _):
+        return 200, "text/plain; version=0.0.4; charset=utf-8", self.registry.exposition().encode()
+
+
+class EndpointHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = self.server.endpoint
+        if url.path in endpoint.streams:
+            self.stream(endpoint, url)
+            return
+        handler = endpoint.routes.get(url.path)
+        if handler is None:
+            status, content_type, body = 404, "text/plain; charset=utf-8", b"Not found\n"
+        else:
+            query = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                status, content_type, body = handler(query)
+            except Exception as e:
+                endpoint.messages.put(("WARNING", f"{endpoint.name}: {url.path} raised {e}..."))
+                status, content_type, body = 500, "text/plain; charset=utf-8", f"{e}\n".encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, endpoint, url):
+        query = dict(urllib.parse.parse_qsl(url.query))
+        events = endpoint.streams[url.path](query, self.headers.get("Last-Event-ID"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        # Read by the dashboard, served from another port
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            for chunk in events:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            events.close()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        endpoint = self.server.endpoint
+        endpoint.messages.put(("DEBUG", f"{endpoint.name}: {self.address_string()} {format % args}"))
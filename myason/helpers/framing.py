@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+
+import struct
+
+# Frame header: payload length, frame number
+FRAME = struct.Struct("!IQ")
+# Acknowledgement: number of the last frame received, every frame before it included
+ACK = struct.Struct("!Q")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def frame(number, payload):
+    return FRAME.pack(len(payload), number) + payload
+
+
+class FrameBuffer:
+    """Reassembles the length-prefixed frames of a byte stream
+
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        if self.offset:
+            # Compact the buffer before growing it
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """Returns the next complete frame
+
+        Returns:
+            A (number, payload) tuple, None if the frame isn't fully received yet
+
+        Raises:
+            ValueError: The frame length exceeds MAX_FRAME_SIZE
+        """
+        if len(self.buffer) - self.offset < FRAME.size:
+            return None
+        length, number = FRAME.unpack_from(self.buffer, self.offset)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE} bytes")
+        start = self.offset + FRAME.size
+        if len(self.buffer) < start + length:
+            return None
+        self.offset = start + length
+        return number, bytes(self.buffer[start:self.offset])
+
+
+def read_acks(buffer, data):
+    """Adds data to the bytearray buffer and returns the acknowledgements completed"""
+    buffer += data
+    count = len(buffer) // ACK.size
+    acks = [ACK.unpack_from(buffer, n * ACK.size)[0] for n in range(count)]
+    del buffer[:count * ACK.size]
+    return acks
@@ -1,19 +1,94 @@
 # -*- coding: utf-8 -*-
 
 
+import copy
 import logging
 import logging.config
+import os
 
-import yaml
+from myason.helpers.conf import read_yaml
 
-
-def create_logger(name, configuration):
-    logging.config.dictConfig(configuration)
-    return logging.getLogger(name)
+# Format of the sanity checks log
+CHECKS_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
 
 def logger_conf_loader(logger_conf_fn):
-    with open(logger_conf_fn) as conf_fn:
-        logger_conf = conf_fn.read()
-    logger_conf = yaml.load(logger_conf)
-    return logger_conf
+    # A copy of the cached content: dictConfig modifies the configuration it's given
+    return copy.deepcopy(read_yaml(logger_conf_fn))
+
+
+def checks_logger(app):
+    """The logger of the configuration sanity checks of app, writing to log/<app>_error.log
+
+    Its handler is set up once per process, the root logger and the loggers configured by the
+    messenger being left alone: the checks run on every reload.
+    """
+    logger = logging.getLogger(f"myason_{app}_checks")
+    if not logger.handlers:
+        handler = logging.FileHandler(f"log/{app}_error.log")
+        handler.setFormatter(logging.Formatter(CHECKS_FORMAT))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+    # Applying a logger configuration disables the loggers it doesn't name
+    logger.disabled = False
+    return logger
+
+
+def is_level(level):
+    return isinstance(level, int) or isinstance(logging.getLevelName(str(level).upper()), int)
+
+
+def validate_logger_conf(configuration):
+    """Checks a logger configuration (logging.config.dictConfig schema) without applying it
+
+    The sections, the levels, the references between formatters, handlers and loggers, the handler
+    classes and the directories of the log files are checked.
+
+    Raises:
+        ValueError: The configuration is not valid
+    """
+    if not isinstance(configuration, dict):
+        raise ValueError("The logger configuration must be a mapping")
+    if configuration.get("version") != 1:
+        raise ValueError(f"Unsupported logger configuration version {configuration.get('version')!r}")
+    configurator = logging.config.BaseConfigurator({})
+    sections = {}
+    for section in ("formatters", "filters", "handlers", "loggers"):
+        sections[section] = configuration.get(section) or {}
+        if not isinstance(sections[section], dict) or not all(
+                isinstance(item, dict) for item in sections[section].values()):
+            raise ValueError(f"{section} must map names to mappings")
+    for name, formatter in sections["formatters"].items():
+        if "()" in formatter or "class" in formatter:
+            configurator.resolve(formatter.get("()") or formatter["class"])
+            continue
+        try:
+            logging.Formatter(formatter.get("format"), formatter.get("datefmt"), formatter.get("style", "%"))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"formatter {name}: {e}")
+    for name, handler in sections["handlers"].items():
+        if "()" not in handler and "class" not in handler:
+            raise ValueError(f"handler {name} has no class")
+        if isinstance(handler.get("()", handler.get("class")), str):
+            configurator.resolve(handler.get("()") or handler["class"])
+        if "level" in handler and not is_level(handler["level"]):
+            raise ValueError(f"handler {name}: unknown level {handler['level']}")
+        if "formatter" in handler and handler["formatter"] not in sections["formatters"]:
+            raise ValueError(f"handler {name}: unknown formatter {handler['formatter']}")
+        for filter_name in handler.get("filters") or ():
+            if filter_name not in sections["filters"]:
+                raise ValueError(f"handler {name}: unknown filter {filter_name}")
+        if "filename" in handler and not os.path.isdir(os.path.dirname(handler["filename"]) or "."):
+            raise ValueError(f"handler {name}: no directory for {handler['filename']}")
+    loggers = dict(sections["loggers"])
+    if configuration.get("root") is not None:
+        loggers["root"] = configuration["root"]
+    for name, logger in loggers.items():
+        if not isinstance(logger, dict):
+            raise ValueError(f"logger {name} must be a mapping")
+        if "level" in logger and not is_level(logger["level"]):
+            raise ValueError(f"logger {name}: unknown level {logger['level']}")
+        for handler_name in logger.get("handlers") or ():
+            if handler_name not in sections["handlers"]:
+                raise ValueError(f"logger {name}: unknown handler {handler_name}")
@@ -2,51 +2,30 @@
 
 import logging
 import logging.config
-import queue
-import threading
-import time
 
+from myason.helpers.worker import Worker
 
-class Messenger(threading.Thread):
+
+class Messenger(Worker):
     worker_group = "messenger"
     worker_number = 0
 
     def __init__(self, logger_conf, messages):
-        super().__init__()
-        Messenger.worker_number += 1
-        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
-        self.messages = messages
-        self.stop = threading.Event()
+        super().__init__(messages, messages)
+        self.configure(logger_conf)
+
+    def configure(self, logger_conf):
+        """Applies a logger configuration, when starting or reloading"""
         self.logger_conf = logger_conf
         logging.config.dictConfig(self.logger_conf)
         self.logger = logging.getLogger("myason")
 
-    def run(self):
-        self.logger.info(f"{self.name}: up and running...")
-        while not self.stop.isSet():
-            try:
-                msg = self.messages.get(block=False)
-                if msg is not None:
-                    self.process_message(msg)
-            except queue.Empty:
-                time.sleep(0.5)
-
-    def join(self, timeout=None):
-        self.stop.set()
-        self.logger.info(f"{self.name}: stopping...")
-        self.clean_up()
-        super().join(timeout)
-        self.logger.info(f"{self.name}: stopped...")
-
-    def clean_up(self):
-        self.logger.info(f"{self.name}: processing remaining messages...")
-        while True:
-            try:
-                pkt = self.messages.get(block=False)
-                if pkt is not None:
-                    self.process_message(pkt)
-            except queue.Empty:
-                break
+    def process(self, msg):
+        self.process_message(msg)
+
+    def log(self, level, message):
+        # The messenger logs its own messages directly
+        self.process_message((level, f"{self.name}: {message}"))
 
     def process_message(self, msg):
         if "DEBUG" == msg[0]:
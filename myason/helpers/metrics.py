@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+
+import bisect
+import threading
+
+
+class Counter:
+    """A monotonically increasing value"""
+    kind = "counter"
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """A value going up and down, either set by its owner or read from a function at collection time"""
+    kind = "gauge"
+    __slots__ = ("value", "function")
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.get()
+
+
+class Histogram:
+    """A latency histogram with log-linear buckets, as HDR histograms
+
+    Every power of two between lowest and highest is split into sub_buckets linear buckets, so the
+    relative error stays the same whatever the magnitude. Observing a value costs one bisection.
+    """
+    kind = "histogram"
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, lowest=1e-6, highest=60., sub_buckets=2):
+        bounds = []
+        base = lowest
+        while base < highest:
+            bounds.extend(base * (1 + n / sub_buckets) for n in range(sub_buckets))
+            base *= 2
+        bounds.append(base)
+        self.bounds = bounds
+        # The last count is the overflow bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", f"{bound:.6g}"),), cumulative
+        cumulative += self.counts[-1]
+        yield f"{name}_bucket", labels + (("le", "+Inf"),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, cumulative
+
+
+class Registry:
+    """The metrics shared by the workers of a process
+
+    The registry lock is only taken to register or collect metrics. Updating a metric is lock free:
+    each series is meant to be updated by a single worker, which is why the workers label their
+    series with their name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def counter(self, name, documentation, **labels):
+        return self.register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, function=None, **labels):
+        return self.register(Gauge, name, documentation, labels, function)
+
+    def histogram(self, name, documentation, **labels):
+        return self.register(Histogram, name, documentation, labels)
+
+    def register(self, metric_class, name, documentation, labels, *args):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (metric_class, documentation, {}))
+            if family[0] is not metric_class:
+                raise ValueError(f"Metric {name} is already registered as a {family[0].kind}")
+            series = family[2]
+            if key not in series:
+                series[key] = metric_class(*args)
+            return series[key]
+
+    def unregister(self, name, **labels):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self.lock:
+            if name in self.families:
+                self.families[name][2].pop(key, None)
+
+    def exposition(self):
+        """Renders the metrics in the Prometheus text format"""
+        with self.lock:
+            families = [
+                (name, metric_class, documentation, list(series.items()))
+                for name, (metric_class, documentation, series) in sorted(self.families.items())
+            ]
+        lines = []
+        for name, metric_class, documentation, series in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_class.kind}")
+            for labels, metric in series:
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample_name}{format_labels(sample_labels)} {float(value)!r}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{label}="{escape(value)}"' for label, value in labels)
+    return f"{{{pairs}}}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# The registry of the running process
+registry = Registry()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class Profiler(threading.Thread):
+    """The sampling profiler
+
+    Samples the stacks of every other thread at a fixed interval for a given duration, then writes
+    them in the collapsed stacks format (flame graphs) or in the speedscope format. The stacks are
+    rooted at the name of their thread (sniffer_001, processor_002...).
+    """
+    worker_group = "profiler"
+    worker_number = 0
+
+    def __init__(self, messages, duration, interval, output_fn, output_format="collapsed"):
+        """Initialization
+
+        Args:
+            messages: The thread safe FIFO queue to feed with logging messages
+            duration: The sampling duration (in seconds)
+            interval: The sampling interval (in seconds)
+            output_fn: The file to write the profile to
+            output_format: collapsed or speedscope
+        """
+        super().__init__()
+        Profiler.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.daemon = True
+        self.messages = messages
+        self.duration = duration
+        self.interval = interval
+        self.output_fn = output_fn
+        self.output_format = output_format
+        self.stop = threading.Event()
+        self.stacks = collections.Counter()
+
+    def run(self):
+        self.messages.put(("INFO", f"{self.name}: sampling every {self.interval}s for {self.duration}s..."))
+        deadline = time.monotonic() + self.duration
+        while not self.stop.isSet() and time.monotonic() < deadline:
+            self.sample()
+            self.stop.wait(self.interval)
+        self.write()
+        self.messages.put(("INFO", f"{self.name}: profile written to {self.output_fn}..."))
+
+    def join(self, timeout=None):
+        self.stop.set()
+        self.messages.put(("INFO", f"{self.name}: stopping..."))
+        super().join(timeout)
+        self.messages.put(("INFO", f"{self.name}: stopped..."))
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(names.get(ident, str(ident)),) + tuple(stack)] += 1
+
+    def write(self):
+        output_dir = os.path.dirname(self.output_fn)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(self.output_fn, "w") as output_file:
+            if self.output_format == "speedscope":
+                json.dump(self.speedscope(), output_file)
+            else:
+                output_file.write(self.collapsed())
+
+    def collapsed(self):
+        lines = []
+        for (thread_name, *stack), count in sorted(self.stacks.items()):
+            frames = [thread_name] + [frame_label(*frame) for frame in stack]
+            lines.append(f"{';'.join(frame.replace(';', ':') for frame in frames)} {count}")
+        lines.append("")
+        return "\n".join(lines)
+
+    def speedscope(self):
+        frames = []
+        frame_ids = {}
+        profiles = {}
+        for (thread_name, *stack), count in self.stacks.items():
+            sample = []
+            for frame in stack:
+                if frame not in frame_ids:
+                    frame_ids[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                sample.append(frame_ids[frame])
+            profile = profiles.setdefault(thread_name, {
+                "type": "sampled",
+                "name": thread_name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": 0,
+                "samples": [],
+                "weights": [],
+            })
+            profile["samples"].append(sample)
+            profile["weights"].append(count * self.interval)
+            profile["endValue"] += count * self.interval
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [profiles[name] for name in sorted(profiles)],
+            "name": os.path.basename(self.output_fn),
+            "exporter": "myason",
+        }
+
+
+def frame_label(name, filename, line):
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class ProfilerSwitch:
+    """Turns the sampling profiler on and off at runtime
+
+    The profiler is toggled by SIGUSR1 (where available) and by the /profile/start and /profile/stop
+    routes of the local endpoint.
+    """
+
+    def __init__(self, messages, app, duration=30, interval=0.01, output_dir="log", output_format="collapsed"):
+        """Initialization
+
+        Args:
+            messages: The thread safe FIFO queue to feed with logging messages
+            app: The application name (agent or collector), used to name the profiles
+            duration: The default sampling duration (in seconds)
+            interval: The sampling interval (in seconds)
+            output_dir: The directory to write the profiles to
+            output_format: The default output format, collapsed or speedscope
+        """
+        self.messages = messages
+        self.app = app
+        self.duration = duration
+        self.interval = interval
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def install(self, endpoint=None):
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.toggle)
+        if endpoint is not None:
+            endpoint.add_route("/profile/start", self.handle_start)
+            endpoint.add_route("/profile/stop", self.handle_stop)
+
+    def start(self, duration=None, output_format=None):
+        """Starts a profile, unless one is running
+
+        Returns:
+            The file the profile will be written to, None if a profile is already running
+        """
+        with self.lock:
+            if self.profiler is not None and self.profiler.is_alive():
+                return None
+            output_format = output_format or self.output_format
+            extension = "speedscope.json" if output_format == "speedscope" else "collapsed.txt"
+            output_fn = os.path.join(
+                self.output_dir,
+                f"profile_{self.app}_{time.strftime('%Y%m%d_%H%M%S')}.{extension}",
+            )
+            self.profiler = Profiler(
+                self.messages,
+                duration if duration is not None else self.duration,
+                self.interval,
+                output_fn,
+                output_format,
+            )
+            self.profiler.start()
+            return output_fn
+
+    def stop(self):
+        """Stops the running profile, which is then written
+
+        Returns:
+            The file the profile is written to, None if no profile was running
+        """
+        with self.lock:
+            profiler, self.profiler = self.profiler, None
+        if profiler is None or not profiler.is_alive():
+            return None
+        profiler.join()
+        return profiler.output_fn
+
+    def toggle(self, signum=None, frame=None):
+        if self.start() is None:
+            # Don't block the signal handler while the profile is written
+            threading.Thread(target=self.stop, daemon=True).start()
+
+    def handle_start(self, query):
+        output_format = query.get("format")
+        if output_format not in (None, "collapsed", "speedscope"):
+            return 400, "text/plain; charset=utf-8", f"Unknown format {output_format}\n".encode()
+        duration = float(query["duration"]) if "duration" in query else None
+        output_fn = self.start(duration, output_format)
+        if output_fn is None:
+            return 409, "text/plain; charset=utf-8", b"A profile is already running\n"
+        return 200, "text/plain; charset=utf-8", f"Profiling to {output_fn}\n".encode()
+
+    def handle_stop(self, _):
+        output_fn = self.stop()
+        if output_fn is None:
+            return 409, "text/plain; charset=utf-8", b"No profile is running\n"
+        return 200, "text/plain; charset=utf-8", f"Profile written to {output_fn}\n".encode()
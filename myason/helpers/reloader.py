@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import signal
+import threading
+
+from myason.helpers import metrics
+from myason.helpers.conf import conf_loader
+from myason.helpers.logging import logger_conf_loader
+
+
+class Reloader(threading.Thread):
+    """The configuration reloader
+
+    Reloads the configuration on SIGHUP (where available), on /reload through the local endpoint,
+    or when the configuration files are modified. The configuration is checked as on startup, then
+    the logger configuration is applied to the messenger and the configuration is handed to the
+    subscribed callbacks, which update the running workers. An invalid configuration is ignored,
+    the running one is kept.
+    """
+    worker_group = "reloader"
+    worker_number = 0
+
+    def __init__(self, messages, messenger, app, logger_conf_fn, conf_fn, check, interval=None, schema=()):
+        """Initialization
+
+        Args:
+            messages: The thread safe FIFO queue to feed with logging messages
+            messenger: The messenger worker, whose logger configuration is reloaded
+            app: The application name (agent or collector), used to name the metrics
+            logger_conf_fn: The logger configuration file
+            conf_fn: The application configuration file
+            check: The sanity checks of the configuration, called with both files
+            interval: The delay between the checks of the files modification times (in seconds), None not to watch them
+            schema: The Option objects the configuration is validated against
+        """
+        super().__init__()
+        Reloader.worker_number += 1
+        self.name = f"{self.worker_group}_{format(self.worker_number, '0>3')}"
+        self.daemon = True
+        self.messages = messages
+        self.messenger = messenger
+        self.logger_conf_fn = logger_conf_fn
+        self.conf_fn = conf_fn
+        self.check = check
+        self.interval = interval
+        self.schema = schema
+        self.callbacks = []
+        self.mtimes = self.modification_times()
+        self.requested = threading.Event()
+        self.stop = threading.Event()
+        self.applied = metrics.registry.counter(
+            f"myason_{app}_reloads_total", "Configuration reloads", result="applied")
+        self.rejected = metrics.registry.counter(
+            f"myason_{app}_reloads_total", "Configuration reloads", result="rejected")
+
+    def install(self, endpoint=None):
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request)
+        if endpoint is not None:
+            endpoint.add_route("/reload", self.handle_reload)
+
+    def subscribe(self, callback):
+        """Calls callback with the configuration each time it's reloaded"""
+        self.callbacks.append(callback)
+
+    def request(self, signum=None, frame=None):
+        self.requested.set()
+
+    def run(self):
+        self.messages.put(("INFO", f"{self.name}: up and running..."))
+        while True:
+            self.requested.wait(self.interval)
+            if self.stop.isSet():
+                break
+            mtimes = self.modification_times()
+            if self.requested.isSet() or mtimes != self.mtimes:
+                self.requested.clear()
+                self.mtimes = mtimes
+                self.reload()
+
+    def join(self, timeout=None):
+        self.stop.set()
+        self.requested.set()
+        self.messages.put(("INFO", f"{self.name}: stopping..."))
+        super().join(timeout)
+        self.messages.put(("INFO", f"{self.name}: stopped..."))
+
+    def modification_times(self):
+        mtimes = []
+        for conf_fn in (self.logger_conf_fn, self.conf_fn):
+            try:
+                mtimes.append(os.stat(conf_fn).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload(self):
+        self.messages.put(("INFO", f"{self.name}: reloading the configuration..."))
+        ok = self.check(self.logger_conf_fn, self.conf_fn)
+        if not ok:
+            self.rejected.inc()
+            self.messages.put(("ERROR", f"{self.name}: invalid configuration, the running one is kept..."))
+            return
+        self.messenger.configure(logger_conf_loader(self.logger_conf_fn))
+        conf = conf_loader(self.conf_fn, self.schema)
+        failed = False
+        for callback in self.callbacks:
+            # A failing update (a file changed after the checks...) must not end the reloader
+            try:
+                callback(conf)
+            except Exception as e:
+                failed = True
+                self.messages.put(("ERROR", f"{self.name}: configuration partially applied, {e!r}..."))
+        if failed:
+            self.rejected.inc()
+            return
+        self.applied.inc()
+        self.messages.put(("INFO", f"{self.name}: configuration reloaded..."))
+
+    def handle_reload(self, _):
+        self.request()
+        return 200, "text/plain; charset=utf-8", b"Reload requested\n"
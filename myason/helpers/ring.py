@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+
+import bisect
+import hashlib
+
+# Points of a node on the ring, smoothing the share of the keys owned by each node
+REPLICAS = 128
+
+
+def ring_hash(value):
+    """A 64 bits hash of a string, the same in every process (unlike the salted hash())"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def parse_node(node):
+    """Parses an "address:port" collector node ("[address]:port" for IPv6) into an (address, port) tuple
+
+    Raises:
+        ValueError: node isn't an "address:port" string
+    """
+    address, separator, port = str(node).rpartition(":")
+    if not separator or not address:
+        raise ValueError(f"{node} is not an address:port collector")
+    return address.strip("[]"), int(port)
+
+
+class HashRing:
+    """The consistent hashing ring of a collector cluster
+
+    Each node is hashed to REPLICAS points of a 64 bits ring, and a key is owned by the node of the
+    first point following its hash. When a node joins or leaves the ring, only the keys of its
+    points change of node, about one in the number of nodes, the others keeping theirs.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        """Initialization
+
+        Args:
+            nodes: The (address, port) tuples of the nodes
+            replicas: The number of points of a node on the ring
+        """
+        self.nodes = sorted(set(nodes))
+        self.points = sorted(
+            (ring_hash(f"{address}:{port}#{replica}"), (address, port))
+            for address, port in self.nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point[0] for point in self.points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, key, exclude=()):
+        """Returns the node owning key, the next one on the ring when it's excluded, None if none is left"""
+        if not self.points:
+            return None
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for n in range(len(self.points)):
+            node = self.points[(start + n) % len(self.points)][1]
+            if node not in exclude:
+                return node
+        return None
+
+
+def create_ring(agent_conf):
+    """Returns the ring of the collectors of the configuration, None with a single collector"""
+    collectors = agent_conf.get("collectors")
+    if not collectors:
+        return None
+    return HashRing([parse_node(node) for node in collectors])
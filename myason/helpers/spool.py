@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Record header: payload length, append time
+HEADER = struct.Struct("!Id")
+# Cursor file: segment id, offset
+CURSOR = struct.Struct("!QQ")
+
+
+class Spool:
+    """A segmented, append-only, memory-mapped log of records
+
+    Records are appended to fixed-size segment files and read back in order. Reading is
+    two-phased: read() hands out the next record and its position, and commit(position) marks
+    every record up to this one as consumed. Until then, rewind() goes back to the last committed
+    record, so that records which couldn't be delivered are read again. The committed cursor is
+    persisted, so the spool survives restarts.
+
+    Only the segment being written and the segment being read are mapped, whatever the backlog.
+    When the spool would exceed max_bytes, or when its oldest segment is older than max_age, the
+    oldest segment is dropped.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024, max_age=None,
+                 sync_interval=1.):
+        """Initialization
+
+        Args:
+            directory: The directory of the segment files
+            segment_size: The size of a segment file (in bytes)
+            max_bytes: The maximum size of the spool (in bytes)
+            max_age: The maximum age of a segment (in seconds), None for no limit
+            sync_interval: The minimum interval between two writes of the cursor file (in seconds)
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        self.max_age = max_age
+        self.sync_interval = sync_interval
+        self.lock = threading.RLock()
+        self.dropped_segments = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(fn[:-4]) for fn in os.listdir(directory) if fn.endswith(".seg") and fn[:-4].isdigit()
+        )
+        self.cursor_fn = os.path.join(directory, "cursor")
+        self.committed = self.load_cursor()
+        self.synced_at = time.monotonic()
+        self.read_map = None
+        self.read_segment = None
+        self.position = self.committed
+        # Recover the end of the last segment
+        self.write_map = None
+        if self.segments:
+            self.write_segment = self.segments[-1]
+            self.write_map = self.map_segment(self.write_segment)
+            self.write_offset = self.scan_end(self.write_map)
+        else:
+            self.write_segment = -1
+            self.write_offset = self.segment_size
+        self.enforce_limits()
+
+    def size(self):
+        """The number of bytes of the segments not fully consumed yet"""
+        with self.lock:
+            return len(self.segments) * self.segment_size
+
+    def empty(self):
+        """Whether every record has been read"""
+        with self.lock:
+            return (self.position[0], self.position[1]) >= (self.write_segment, self.write_offset)
+
+    def append(self, data):
+        with self.lock:
+            size = HEADER.size + len(data)
+            if size > self.segment_size - HEADER.size:
+                raise ValueError(f"Record of {len(data)} bytes exceeds the spool segment size")
+            if self.write_offset + size > self.segment_size - HEADER.size:
+                self.roll()
+            offset = self.write_offset
+            # Write the payload first: a record is only valid once its header is written
+            self.write_map[offset + HEADER.size:offset + size] = data
+            HEADER.pack_into(self.write_map, offset, len(data), time.time())
+            self.write_offset = offset + size
+
+    def read(self):
+        """Reads the record following the last one read
+
+        Returns:
+            A (position, data) tuple, None if there is no record to read
+        """
+        with self.lock:
+            segment, offset = self.position
+            while True:
+                if segment > self.write_segment:
+                    return None
+                if segment not in self.segments:
+                    # The segment was dropped: skip to the oldest remaining one
+                    following = [n for n in self.segments if n > segment]
+                    if not following:
+                        return None
+                    segment, offset = following[0], 0
+                if self.read_segment != segment:
+                    self.unmap_read()
+                    self.read_map = self.write_map if segment == self.write_segment else self.map_segment(segment)
+                    self.read_segment = segment
+                # append() always leaves room for the header ending a segment
+                length, _ = HEADER.unpack_from(self.read_map, offset)
+                if length:
+                    data = bytes(self.read_map[offset + HEADER.size:offset + HEADER.size + length])
+                    self.position = (segment, offset + HEADER.size + length)
+                    return self.position, data
+                if segment == self.write_segment:
+                    self.position = (segment, offset)
+                    return None
+                # End of a segment: go on with the next one
+                segment, offset = segment + 1, 0
+
+    def commit(self, position):
+        """Marks the records up to position as consumed"""
+        with self.lock:
+            self.committed = position
+            # Delete the consumed segments
+            while self.segments and self.segments[0] < position[0] and self.segments[0] != self.write_segment:
+                self.delete_segment(self.segments[0])
+            if time.monotonic() - self.synced_at >= self.sync_interval:
+                self.save_cursor()
+
+    def rewind(self):
+        """Reads again the records read but not committed"""
+        with self.lock:
+            self.position = self.committed
+
+    def close(self):
+        with self.lock:
+            self.save_cursor()
+            self.unmap_read()
+            if self.write_map is not None:
+                self.write_map.close()
+                self.write_map = None
+
+    def expire(self):
+        """Drops the segments older than max_age"""
+        with self.lock:
+            self.enforce_limits()
+
+    def roll(self):
+        if self.write_map is not None and self.read_segment != self.write_segment:
+            self.write_map.close()
+        self.write_segment += 1
+        self.write_offset = 0
+        segment_fn = self.segment_fn(self.write_segment)
+        with open(segment_fn, "wb") as segment_file:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(segment_file.fileno(), 0, self.segment_size)
+            else:
+                segment_file.truncate(self.segment_size)
+        self.segments.append(self.write_segment)
+        self.write_map = self.map_segment(self.write_segment)
+        self.enforce_limits()
+
+    def enforce_limits(self):
+        while len(self.segments) > self.max_segments:
+            self.drop_oldest()
+        if self.max_age is not None:
+            while len(self.segments) > 1 and time.time() - self.segment_time(self.segments[0]) > self.max_age:
+                self.drop_oldest()
+
+    def drop_oldest(self):
+        segment = self.segments[0]
+        self.delete_segment(segment)
+        self.dropped_segments += 1
+        following = (self.segments[0], 0)
+        if self.committed[0] <= segment:
+            self.committed = following
+        if self.position[0] <= segment:
+            self.position = following
+
+    def delete_segment(self, segment):
+        if self.read_segment == segment:
+            self.unmap_read()
+        self.segments.remove(segment)
+        os.remove(self.segment_fn(segment))
+
+    def segment_time(self, segment):
+        with open(self.segment_fn(segment), "rb") as segment_file:
+            header = segment_file.read(HEADER.size)
+        length, appended_at = HEADER.unpack(header)
+        return appended_at if length else time.time()
+
+    def segment_fn(self, segment):
+        return os.path.join(self.directory, f"{segment:020d}.seg")
+
+    def map_segment(self, segment):
+        with open(self.segment_fn(segment), "r+b") as segment_file:
+            return mmap.mmap(segment_file.fileno(), self.segment_size)
+
+    def unmap_read(self):
+        if self.read_map is not None and self.read_map is not self.write_map:
+            self.read_map.close()
+        self.read_map = None
+        self.read_segment = None
+
+    def scan_end(self, segment_map):
+        offset = 0
+        while offset + HEADER.size <= self.segment_size:
+            length, _ = HEADER.unpack_from(segment_map, offset)
+            if not length:
+                break
+            offset += HEADER.size + length
+        return offset
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_fn, "rb") as cursor_file:
+                return CURSOR.unpack(cursor_file.read(CURSOR.size))
+        except (OSError, struct.error):
+            return (self.segments[0], 0) if self.segments else (0, 0)
+
+    def save_cursor(self):
+        # Write then rename, so that the cursor file is never half written
+        temp_fn = f"{self.cursor_fn}.tmp"
+        with open(temp_fn, "wb") as cursor_file:
+            cursor_file.write(CURSOR.pack(*self.committed))
+        os.replace(temp_fn, self.cursor_fn)
+        self.synced_at = time.monotonic()
+
+
+def read_records(directory):
+    """Reads the records of a spool without opening it, as another process (a running agent) uses it
+
+    The segments are mapped read-only, with the size of their file: neither the cursor nor the
+    segments are modified, and no limit is enforced.
+
+    Yields:
+        The data of the records of every segment, the ones already read by the spool owner included
+    """
+    segments = sorted(int(fn[:-4]) for fn in os.listdir(directory) if fn.endswith(".seg") and fn[:-4].isdigit())
+    for segment in segments:
+        try:
+            segment_file = open(os.path.join(directory, f"{segment:020d}.seg"), "rb")
+        except FileNotFoundError:
+            # Dropped or consumed meanwhile
+            continue
+        with segment_file:
+            size = os.fstat(segment_file.fileno()).st_size
+            if size < HEADER.size:
+                continue
+            with mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ) as segment_map:
+                offset = 0
+                while offset + HEADER.size <= size:
+                    length, _ = HEADER.unpack_from(segment_map, offset)
+                    if not length or offset + HEADER.size + length > size:
+                        break
+                    yield segment_map[offset + HEADER.size:offset + HEADER.size + length]
+                    offset += HEADER.size + length
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+
+import queue
+import threading
+
+# Queued after the last item a worker has to process
+STOP = object()
+
+
+class Worker(threading.Thread):
+    """The base of the workers consuming a queue
+
+    The worker blocks on its inbox instead of polling it. When nothing arrives for idle_timeout
+    seconds, idle() is called. Stopping the worker queues the STOP sentinel behind the pending
+    items: they are all processed before finish() is called and the thread exits.
+    """
+    worker_group = "worker"
+    worker_number = 0
+    idle_timeout = 1.0
+
+    def __init__(self, inbox, messages):
+        """Initialization
+
+        Args:
+            inbox: The thread safe FIFO queue to consume
+            messages: The thread safe FIFO queue to feed with logging messages
+        """
+        super().__init__()
+        worker_class = type(self)
+        worker_class.worker_number += 1
+        self.name = f"{self.worker_group}_{format(worker_class.worker_number, '0>3')}"
+        self.inbox = inbox
+        self.messages = messages
+        self.stop = threading.Event()
+
+    def run(self):
+        self.log("INFO", "up and running...")
+        while True:
+            try:
+                item = self.inbox.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.idle()
+                continue
+            if item is STOP:
+                break
+            if item is not None:
+                self.process(item)
+        self.finish()
+
+    def halt(self):
+        """Asks the worker to stop once the items already queued are processed"""
+        if not self.stop.isSet():
+            self.stop.set()
+            self.log("INFO", "stopping...")
+            self.inbox.put(STOP)
+
+    def join(self, timeout=None):
+        self.halt()
+        super().join(timeout)
+        self.log("INFO", "stopped...")
+
+    def log(self, level, message):
+        self.messages.put((level, f"{self.name}: {message}"))
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def idle(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Tee:
+    """Feeds several queues with the same items, as a queue fed by a worker"""
+
+    def __init__(self, *fifos):
+        self.fifos = fifos
+
+    def put(self, item, block=True, timeout=None):
+        for fifo in self.fifos:
+            fifo.put(item, block, timeout)
+
+
+def stop_workers(workers):
+    """Stops workers sharing the same inbox
+
+    Every worker is asked to stop before any is waited for, so that each of them gets a sentinel.
+    """
+    for worker in workers:
+        worker.halt()
+    for worker in workers:
+        worker.join()
@@ -1,96 +1,92 @@
 # -*- coding: utf-8 -*-
 
+"""Live dashboard of the flows received by the collector
+
+The graphs are fed by the live feed of the collector (feed_history in config/collector.yml), streamed
+as server-sent events on /events of its endpoint: the browser appends each second to the graphs as it
+comes (assets/feed.js), instead of the whole history being queried on each refresh. The scripts and
+styles are served by the dashboard itself, so that it works offline.
+
+Usage:
+
+    python visualize.py [--events URL] [--address ADDRESS] [--port PORT] [--max-points N]
+"""
+
+import argparse
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import sqlite3
-import datetime
-
-
-def get_data():
-    con = sqlite3.connect("database/collector.db")
-    with con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            SELECT
-                seconds,
-                SUM(packets),
-                SUM(bytes),
-                SUM(flows)
-            FROM timeseries
-            GROUP BY seconds
-            ORDER BY seconds
-            """,
-        )
-        timeseries = cur.fetchall()
-        x = []
-        y1 = []
-        y2 = []
-        y3 = []
-        for point in timeseries:
-            dt = datetime.datetime.fromtimestamp(point[0]).strftime('%Y-%m-%d %H:%M:%S')
-            x.append(dt)
-            y1.append(point[1])
-            y2.append(point[2])
-            y3.append(point[3])
-    return x, y1, y2, y3
-
-
-seconds, packets, octets, flows = get_data()
-
-app = dash.Dash()
-app.layout = html.Div(
-    [
-        html.Div(
-            [
-                html.Div(
-                    [
-                        dcc.Graph(
-                            figure={
-                                'data': [{'x': seconds, 'y': flows, 'type': 'line'}],
-                                'layout': {
-                                    'title': 'Flows'
-                                },
-                            }
-                        ),
-                    ],
-                    className="six columns",
-                ),
-                html.Div(
-                    [
-                        dcc.Graph(
-                            figure={
-                                'data': [{'x': seconds, 'y': octets, 'type': 'line'}],
-                                'layout': {
-                                    'title': 'Bytes'
-                                },
-                            }
-                        ),
-                    ],
-                    className="six columns",
-                ),
-                html.Div(
-                    [
-                        dcc.Graph(
-                            figure={
-                                'data': [{'x': seconds, 'y': packets, 'type': 'line'}],
-                                'layout': {
-                                    'title': 'Packets'
-                                },
-                            }
-                        ),
-                    ],
-                    className="six columns",
-                ),
-            ],
-            className="row",
-        )
-    ]
+from dash.dependencies import ClientsideFunction
+from dash.dependencies import Input
+from dash.dependencies import Output
+from dash.dependencies import State
+
+# The metrics of the live feed, and the titles of their graphs
+GRAPHS = (
+    ("flows", "Flows"),
+    ("bytes", "Bytes"),
+    ("packets", "Packets"),
 )
-app.css.append_css({
-    'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'
-})
+
+
+def graph(metric, title):
+    return html.Div(
+        [
+            dcc.Graph(
+                id=f"graph-{metric}",
+                figure={
+                    'data': [{'x': [], 'y': [], 'type': 'line'}],
+                    'layout': {
+                        'title': title
+                    },
+                }
+            ),
+        ],
+        className="six columns",
+    )
+
+
+def create_app(events_url, max_points=3600, refresh=1.):
+    """Returns the dashboard
+
+    Args:
+        events_url: The URL of the collector events stream
+        max_points: The points a graph keeps, the oldest ones being dropped
+        refresh: The delay between the updates of the graphs (in seconds)
+    """
+    app = dash.Dash(__name__)
+    app.layout = html.Div(
+        [
+            dcc.Store(id="feed", data={"url": events_url, "max_points": max_points}),
+            dcc.Interval(id="refresh", interval=int(refresh * 1000)),
+            html.Div(
+                [graph(metric, title) for metric, title in GRAPHS],
+                className="row",
+            )
+        ]
+    )
+    # Runs in the browser: appends the seconds received since the last update
+    app.clientside_callback(
+        ClientsideFunction(namespace="feed", function_name="extend"),
+        [Output(f"graph-{metric}", "extendData") for metric, _ in GRAPHS],
+        [Input("refresh", "n_intervals")],
+        [State("feed", "data")],
+    )
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="visualize")
+    parser.add_argument("-e", "--events", default="http://127.0.0.1:9181/events",
+                        help="events stream of the collector endpoint")
+    parser.add_argument("-a", "--address", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8050)
+    parser.add_argument("-m", "--max-points", type=int, default=3600, help="points kept by each graph")
+    arguments = parser.parse_args()
+    app = create_app(arguments.events, max_points=arguments.max_points)
+    app.run_server(host=arguments.address, port=arguments.port)
+
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    main()